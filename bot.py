@@ -1,6 +1,18 @@
+import os
+import signal
+
 from horsefax.bot.core import HorseFaxBot
 
 bot = HorseFaxBot()
+
+
+def terminate(signum, frame):
+    bot.shutdown()
+    os._exit(0)
+
+
+# Heroku and friends stop us with SIGTERM, which would otherwise skip saving anything.
+signal.signal(signal.SIGTERM, terminate)
 bot.go()
 
 # TODO: some sane way to run the bot forever.
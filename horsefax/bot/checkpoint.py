@@ -0,0 +1,98 @@
+import atexit
+import threading
+import traceback
+from pony.orm import *
+from typing import Iterable, Optional, Set, Tuple
+
+from horsefax.telegram.connections.checkpoint import OffsetStore
+from .db import db, timed_session
+
+
+class UpdateOffset(db.Entity):
+    name = PrimaryKey(str)
+    offset = Required(int, size=64)
+
+
+class HandledUpdate(db.Entity):
+    """An update that was handled out of order, after the one the offset points at."""
+    id = PrimaryKey(int, size=64)
+
+
+class DatabaseOffsetStore(OffsetStore):
+    """
+    Keeps the update offset in the database. Progress is written in batches, every `batch` updates or `interval`
+    seconds, whichever comes first, so at most that many updates can be handled twice after a crash. A clean shutdown
+    loses nothing.
+    """
+    def __init__(self, batch: int = 100, interval: float = 5, name: str = 'telegram') -> None:
+        self.batch = batch
+        self.interval = interval
+        self.name = name
+        self._committed = 0
+        self._handled = set()  # type: Set[int]
+        self._written = set()  # type: Set[int]
+        self._dirty = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    @db_session
+    def load(self) -> Tuple[int, Iterable[int]]:
+        row = UpdateOffset.get(name=self.name)
+        offset = row.offset if row is not None else 0
+        handled = set(select(x.id for x in HandledUpdate if x.id > offset))
+        with self._lock:
+            self._committed = offset
+            self._handled = set(handled)
+            self._written = set(handled)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+        return offset, handled
+
+    def record(self, committed: int, handled: Optional[int] = None) -> None:
+        with self._lock:
+            self._committed = committed
+            if handled is not None and handled > committed:
+                self._handled.add(handled)
+            self._dirty += 1
+            if self._dirty >= self.batch:
+                self._wake.set()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                print("Couldn't save the update offset; will try again:")
+                traceback.print_exc()
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                committed = self._committed
+                self._handled = {x for x in self._handled if x > committed}
+                handled = set(self._handled)
+                dirty, self._dirty = self._dirty, 0
+            try:
+                with timed_session('checkpoint'):
+                    row = UpdateOffset.get(name=self.name)
+                    if row is None:
+                        UpdateOffset(name=self.name, offset=committed)
+                    else:
+                        row.offset = committed
+                    for update_id in handled - self._written:
+                        HandledUpdate(id=update_id)
+                    delete(x for x in HandledUpdate if x.id <= committed)
+            except Exception:
+                # Nothing was saved, so it's all still to do.
+                with self._lock:
+                    self._dirty += dirty
+                raise
+            self._written = handled
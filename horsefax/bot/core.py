@@ -1,30 +1,74 @@
 import importlib
+import time
 from typing import Union, Optional, Dict, List, cast, Callable, Any
 
 from horsefax.telegram.connections.polling import LongPollingConnection
+from horsefax.telegram.connections.webhook import WebhookConnection
+from horsefax.telegram.connections.transport import Transport
 from horsefax.telegram import Telegram
 from horsefax.telegram.types import *
-from horsefax.telegram.services.command import CommandService, Command
+from horsefax.telegram.services.command import CommandService, Command, UnknownCommand
 from horsefax.telegram.services.chat import ChatService
+from horsefax.telegram.events import ExecutionMode
+from horsefax.telegram.events.threaded import set_pool_size
+from horsefax import metrics, tracing
 from .db import prepare_db
+from .checkpoint import DatabaseOffsetStore
 
 import horsefax.bot.config as config
 
+COMMAND_SECONDS = metrics.histogram('horsefax_command_seconds', "Time taken by command handlers.",
+                                    ['command', 'outcome'])
+
 
 class HorseFaxBot:
     def __init__(self) -> None:
-        self.telegram = Telegram(config.token, LongPollingConnection)
+        if not config.token:
+            raise ValueError("No bot token given; set TELEGRAM_TOKEN")
+        tracing.configure(config.trace_file, config.trace_rate)
+        set_pool_size(ExecutionMode.THREAD, config.handler_threads)
+        transport = Transport(pool_size=config.http_pool_size, keep_alive=config.http_keep_alive,
+                              connect_timeout=config.http_connect_timeout, read_timeout=config.http_read_timeout,
+                              retries=config.http_retries)
+        self.checkpoint = checkpoint = DatabaseOffsetStore(batch=config.checkpoint_batch,
+                                                           interval=config.checkpoint_interval)
+        if config.connection == 'webhook':
+            if not config.webhook_url and not config.webhook_secret:
+                raise ValueError("A webhook registered some other way needs HORSEFAX_WEBHOOK_SECRET set")
+            self.telegram = Telegram(config.token, WebhookConnection, url=config.webhook_url,
+                                     host=config.webhook_host, port=config.webhook_port,
+                                     secret=config.webhook_secret, workers=config.dispatch_workers,
+                                     transport=transport, checkpoint=checkpoint)
+        elif config.connection == 'polling':
+            self.telegram = Telegram(config.token, LongPollingConnection, workers=config.dispatch_workers,
+                                     transport=transport, checkpoint=checkpoint)
+        else:
+            raise ValueError(f"Unknown connection type {config.connection!r}")
         self.commands = CommandService(self.telegram)
-        self.chat = ChatService(self.telegram)
+        self.chat = ChatService(self.telegram, workers=config.send_workers)
         self.modules = {}  # type: Dict[str, BaseModule]
         self._module_modules = {}  # type: Dict[str, Any]
+        self.commands.register_handler(CommandService.UNKNOWN_COMMAND, self.unknown_command)
 
     def go(self):
+        if config.metrics_port is not None:
+            metrics.serve(config.metrics_port)
         self.prepare_modules()
         prepare_db()
         self.load_modules()
         self.telegram.connect()
 
+    def shutdown(self):
+        """
+        Stop taking updates and save anything that hasn't been yet.
+        """
+        # This waits for updates that are already being handled, so that whatever they gathered is saved below.
+        self.telegram.connection.disconnect()
+        for module in self.modules.values():
+            module.shutdown()
+        # Only once the modules have saved everything can we safely say the updates were handled.
+        self.checkpoint.flush()
+
     def prepare_modules(self):
         for module_name in config.modules:
             self._module_modules[module_name] = importlib.import_module(f".modules.{module_name}", package='.'.join(__name__.split('.')[:-1]))
@@ -38,10 +82,21 @@ class HorseFaxBot:
                     print(f"loading {module_name}")
                     self.modules[module_name] = thing(self, ModuleTools(self))
 
+    def unknown_command(self, command: UnknownCommand) -> None:
+        # Groups often have other bots in them, so only speak up if we know the command was meant for us.
+        if not command.addressed and command.message.chat.type != Chat.Type.PRIVATE:
+            return
+        suggestions = command.suggestions
+        if not suggestions:
+            return
+        self.message(command.message.chat, f"I don't know /{command.command}. Did you mean "
+                                           f"{' or '.join(f'/{x}' for x in suggestions)}?",
+                     parsing=ChatService.ParseMode.NONE)
+
     def message(self, target: Union[Chat, User, int], message: str,
                 parsing: ChatService.ParseMode = ChatService.ParseMode.MARKDOWN,
                 silent=False, preview=True, reply_to: Optional[Union[int, Message]] = None):
-        self.chat.message(target, message, parsing=parsing, silent=silent, preview=preview, reply_to=reply_to)
+        return self.chat.message(target, message, parsing=parsing, silent=silent, preview=preview, reply_to=reply_to)
 
 
 class ModuleTools:
@@ -49,15 +104,31 @@ class ModuleTools:
         self.bot = bot
         self.cs_handles = {}  # type: Dict[str, Any]
 
-    def register_command(self, command: str, handler: Callable[[Command], Optional[str]]):
+    def register_command(self, command: str, handler: Callable[[Command], Optional[str]],
+                         mode: ExecutionMode = ExecutionMode.INLINE, timeout: Optional[float] = None):
+        """
+        Register a handler for a command. If it returns a string, that is sent back to the chat the command came from.
+
+        Slow handlers, such as anything that makes network requests, should be registered with
+        :attr:`ExecutionMode.THREAD` and a timeout so they don't hold up the rest of the chat. Command handlers can't
+        use :attr:`ExecutionMode.PROCESS`.
+        """
         if command in self.cs_handles:
             self.unregister_command(command)
-        handle = self.bot.commands.register_handler(command, lambda x: self.command_handler(handler, x))
+        handle = self.bot.commands.register_handler(command, lambda x: self.command_handler(handler, x),
+                                                    mode=mode, timeout=timeout)
         self.cs_handles[command] = handle
         return handle
 
     def command_handler(self, handler, command: Command) -> None:
-        result = handler(command)
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            with tracing.span('module handler', command=command.command):
+                result = handler(command)
+            outcome = 'ok'
+        finally:
+            COMMAND_SECONDS.labels(command.command, outcome).observe(time.perf_counter() - start)
         if result is not None:
             self.bot.message(command.message.chat, result)
 
@@ -73,4 +144,8 @@ class ModuleTools:
 
 
 class BaseModule:
-    pass
+    def shutdown(self) -> None:
+        """
+        Called when the bot is about to exit. Modules that hold on to anything before saving it should save it now.
+        """
+        pass
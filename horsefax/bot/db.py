@@ -1,11 +1,24 @@
+import datetime
+import itertools
+import threading
+import time
+from contextlib import contextmanager
 from enum import Enum
+import dateutil.parser
+from dateutil.tz import tzutc
 import horsefax.bot.config as config
+from horsefax import metrics, tracing
 from pony.orm import *
 from pony.orm.dbapiprovider import StrConverter
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+DB_SESSION_SECONDS = metrics.histogram('horsefax_db_session_seconds', "Time spent in database sessions, by purpose.",
+                                       ['name'])
 
 
 class EnumConverter(StrConverter):
-    def validate(self, val):
+    # Newer versions of Pony also pass the entity instance being validated.
+    def validate(self, val, obj=None):
         if not isinstance(val, Enum):
             raise ValueError(f"Must be an Enum.  Got {type(val)}")
         return val
@@ -19,9 +32,122 @@ class EnumConverter(StrConverter):
 
 
 db = Database()
+_sessions = threading.local()
+
+
+@contextmanager
+def timed_session(name: str):
+    """
+    A :func:`db_session` whose duration is recorded in metrics under `name`. Like :func:`db_session`, it can be used
+    as a decorator. Nested sessions are counted as part of the outermost one.
+    """
+    depth = getattr(_sessions, 'depth', 0)
+    _sessions.depth = depth + 1
+    start = time.perf_counter()
+    try:
+        with tracing.span(f'db {name}'), db_session:
+            yield
+    finally:
+        _sessions.depth = depth
+        if depth == 0:
+            DB_SESSION_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+
+def chunks(items: Iterable[Any], size: int = 500) -> Iterator[List[Any]]:
+    """
+    Split `items` into lists of at most `size`, to keep IN (...) clauses under SQLite's limit on query parameters, or
+    to work through a stream a batch at a time.
+    """
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_date(value: Any) -> datetime.datetime:
+    """
+    :return: `value` as a timezone-aware date. Dates may come from the database without a timezone, or from SQLite as
+             the string it stored, or from a record as ISO 8601; they're always UTC.
+    """
+    if isinstance(value, str):
+        value = dateutil.parser.parse(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=tzutc())
+    return value
 
 
-def prepare_db():
-    db.bind(config.db_provider, **config.db_params)
+def to_record(row: db.Entity) -> Dict[str, Any]:
+    """
+    Flatten a row into something that can be written out as JSON and turned back into a row by :func:`from_record`.
+    Related rows are given by primary key, and aren't loaded.
+    """
+    entity = type(row)
+    # Not 'type', which chats have as an attribute.
+    record = {'entity': entity.__name__}
+    for attr in entity._attrs_:
+        if attr.is_collection or attr.is_discriminator:
+            continue
+        # Reading the attribute directly would load related rows to find out their subclass.
+        value = row._vals_.get(attr)
+        if isinstance(value, db.Entity):
+            key = value._get_raw_pkval_()
+            value = key[0] if len(key) == 1 else list(key)
+        elif isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        elif isinstance(value, Enum):
+            value = value.name
+        record[attr.name] = value
+    return record
+
+
+def from_record(record: Dict[str, Any]) -> db.Entity:
+    """
+    Create a row from the output of :func:`to_record`. Rows it refers to must already exist.
+    """
+    entity = db.entities[record['entity']]
+    params = {}
+    for attr in entity._attrs_:
+        if attr.is_collection or attr.is_discriminator or attr.name not in record:
+            continue
+        value = record[attr.name]
+        if value is not None:
+            if attr.is_relation:
+                value = tuple(value) if isinstance(value, list) else value
+            elif attr.py_type is datetime.datetime:
+                value = parse_date(value)
+            elif isinstance(attr.py_type, type) and issubclass(attr.py_type, Enum):
+                value = attr.py_type[value]
+        params[attr.name] = value
+    return entity(**params)
+
+
+def prepare_db(url: Optional[str] = None):
+    """
+    :param url: The database to use, if not the one given by DATABASE_URL.
+    """
+    url = url or config.db_url
+    if url is None:
+        raise ValueError("No database given; set DATABASE_URL")
+    provider, params = config.parse_db_url(url)
+    db.bind(provider, **params)
     db.provider.converter_classes.append((Enum, EnumConverter))
+    _check_schema()
     db.generate_mapping(create_tables=True)
+
+
+def _check_schema() -> None:
+    # Pony doesn't migrate schemas. File messages used to hold their file's details themselves, rather than referring
+    # to a TelegramFile, and a database from then would fail to map with an error that doesn't say why.
+    if 'FileMessage' not in db.entities:
+        return
+    with db_session:
+        if not db.provider.table_exists(db.get_connection(), 'TelegramMessage'):
+            return
+        cursor = db.execute(f'SELECT * FROM {db.provider.quote_name("TelegramMessage")} WHERE 1 = 0')
+        columns = {x[0] for x in cursor.description}
+    if 'file_id' in columns and 'file' not in columns:
+        raise ValueError("This database is from before files were stored in a table of their own, and has to be "
+                         "upgraded: export it with the previous version of horsefax.bot.transfer, then import the "
+                         "export and any archive files into a new database with this one")
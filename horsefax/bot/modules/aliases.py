@@ -42,14 +42,15 @@ class AliasModule(BaseModule):
     @db_session
     def handle_alias(self, command: Command) -> Optional[str]:
         alias = Alias.get(alias=command.command)
-        if not hasattr(command.message, 'alias_origin'):
-            command.message.alias_origin = []
-        if command.command in command.message.alias_origin:
-            return f"Detected command loop: `{' -> '.join(command.message.alias_origin)} -> {command.command}`"
-        command.message.alias_origin.append(command.command)
+        alias_origin = command.message.context.setdefault('alias_origin', [])
+        if command.command in alias_origin:
+            return f"Detected command loop: `{' -> '.join(alias_origin)} -> {command.command}`"
+        alias_origin.append(command.command)
 
         new_message = copy.copy(command.message)
         new_message.text = "/" + alias.command
+        # The entities describe the original text, so they'd point at the wrong place now.
+        new_message.entities = []
         if len(command.args) > 0:
             new_message.text += ' ' + ' '.join(command.args)
         self.bot.commands.handle_message(new_message)
@@ -0,0 +1,280 @@
+import collections
+import contextlib
+import datetime
+import gzip
+import json
+import os
+import threading
+import time
+import traceback
+
+from dateutil.tz import tzutc
+from pony.orm import *
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from horsefax import metrics
+from ..core import HorseFaxBot, ModuleTools, BaseModule
+from ..db import db, timed_session, chunks, to_record, parse_date
+from .tracking import TelegramMessage
+import horsefax.bot.config as config
+
+ARCHIVED = metrics.counter('horsefax_archived_messages_total', "Messages moved out of the database into the archive.")
+
+
+class MessageArchive:
+    """
+    Old messages, as records from :func:`to_record`, in one gzipped NDJSON file per month.
+
+    Files are only ever appended to, each append adding a gzip member. Before a batch is appended, how long each file
+    was is noted in a journal, so that if we crash before the batch is deleted from the database it can be cut off
+    again with :meth:`roll_back`, rather than being archived twice.
+    """
+    JOURNAL = 'pending.json'
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def path(self, month: str) -> str:
+        return os.path.join(self.directory, f'messages-{month}.ndjson.gz')
+
+    def begin(self, months: Iterable[str], probe: Tuple[int, int]) -> None:
+        """
+        Note that a batch is about to be appended to `months`. `probe` is the (chat ID, message ID) of a message in
+        the batch, which will be in the database until the batch is deleted from it.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        sizes = {x: os.path.getsize(self.path(x)) if os.path.exists(self.path(x)) else 0 for x in months}
+        self._write_journal({'sizes': sizes, 'probe': list(probe)})
+
+    def commit(self) -> None:
+        """Note that the batch is safely out of the database."""
+        path = os.path.join(self.directory, self.JOURNAL)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def pending(self) -> Optional[Dict[str, Any]]:
+        """:return: What :meth:`begin` noted, if the batch was never committed."""
+        try:
+            with open(os.path.join(self.directory, self.JOURNAL), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def roll_back(self, journal: Dict[str, Any]) -> None:
+        """Cut off whatever of the batch in `journal` was appended."""
+        for month, size in journal['sizes'].items():
+            if not os.path.exists(self.path(month)):
+                continue
+            if size:
+                with open(self.path(month), 'r+b') as f:
+                    f.truncate(size)
+                    os.fsync(f.fileno())
+            else:
+                os.remove(self.path(month))
+        self.commit()
+
+    def _write_journal(self, journal: Dict[str, Any]) -> None:
+        path = os.path.join(self.directory, self.JOURNAL)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(journal, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def months(self) -> List[str]:
+        """:return: The months that have been archived, oldest first, as YYYY-MM."""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(x[len('messages-'):-len('.ndjson.gz')] for x in os.listdir(self.directory)
+                      if x.startswith('messages-') and x.endswith('.ndjson.gz'))
+
+    def append(self, month: str, records: List[Dict[str, Any]]) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path(month), 'ab') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='ab') as f:
+                for record in records:
+                    f.write(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n')
+            raw.flush()
+            # The rows are deleted as soon as this returns, so it had better really be on disk.
+            os.fsync(raw.fileno())
+
+    def read(self, month: str) -> Iterator[Dict[str, Any]]:
+        try:
+            with gzip.open(self.path(month), 'rt', encoding='utf-8') as f:
+                for line in f:
+                    yield json.loads(line)
+        except EOFError:
+            # A write was cut short; everything before it is fine.
+            pass
+
+
+class ArchiveModule(BaseModule):
+    """
+    Keeps the message log small by moving messages older than `hot_days` out of the database into a
+    :class:`MessageArchive`, every `interval` seconds. :meth:`iter_messages` reads from both. The tracking module must
+    be loaded first.
+    """
+    def __init__(self, bot: HorseFaxBot, util: ModuleTools, hot_days: float = config.archive_hot_days,
+                 directory: str = config.archive_dir, interval: float = config.archive_interval,
+                 batch: int = config.archive_batch) -> None:
+        self.bot = bot
+        self.util = util
+        self.hot_days = hot_days
+        self.archive = MessageArchive(directory)
+        self.interval = interval
+        self.batch = batch
+        tracking = bot.modules.get('tracking')
+        if tracking is None:
+            raise ValueError("The archive module needs the tracking module, listed before it in HORSEFAX_MODULES")
+        # Replies carry a copy of what they reply to, which mustn't go back into the log once it's been archived.
+        tracking.add_log_horizon(lambda: self.cutoff)
+        self._lock = threading.Lock()
+        self._recover()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def cutoff(self) -> datetime.datetime:
+        """Messages from before this are archived."""
+        return datetime.datetime.now(tz=tzutc()) - datetime.timedelta(days=self.hot_days)
+
+    @contextlib.contextmanager
+    def paused(self):
+        """
+        Hold off archiving for the duration of a ``with`` block, so that messages stay where they are.
+        """
+        with self._lock:
+            yield
+
+    def _recover(self) -> None:
+        # If we crashed partway through archiving a batch, it's either still in the database, in which case whatever
+        # was appended of it is cut off to be archived again, or it's gone, in which case it was all appended.
+        journal = self.archive.pending()
+        if journal is None:
+            return
+        chat_id, message_id = journal['probe']
+        with timed_session('archive'):
+            unfinished = exists(m for m in TelegramMessage if m.chat.id == chat_id and m.id == message_id)
+        if unfinished:
+            print("Archiving was interrupted; undoing the last batch to do again.")
+            self.archive.roll_back(journal)
+        else:
+            self.archive.commit()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.archive_old_messages()
+            except Exception:
+                print("Archiving old messages failed:")
+                traceback.print_exc()
+            time.sleep(self.interval)
+
+    def archive_old_messages(self) -> int:
+        """
+        Move everything older than the hot window into the archive, a batch at a time.
+
+        :return: How many messages were archived.
+        """
+        total = 0
+        cutoff = self.cutoff
+        with self._lock:
+            while True:
+                count = self._archive_batch(cutoff)
+                total += count
+                if count < self.batch:
+                    return total
+
+    @timed_session('archive')
+    def _archive_batch(self, cutoff: datetime.datetime) -> int:
+        rows = select(m for m in TelegramMessage if m.date < cutoff).order_by(TelegramMessage.date)[:self.batch]
+        if not rows:
+            return 0
+        by_month = collections.defaultdict(list)  # type: Dict[str, List[Dict[str, Any]]]
+        by_chat = collections.defaultdict(list)  # type: Dict[int, List[int]]
+        for row in rows:
+            record = to_record(row)
+            # The date is written out as ISO 8601, so this is YYYY-MM.
+            by_month[record['date'][:7]].append(record)
+            by_chat[record['chat']].append(record['id'])
+        self.archive.begin(by_month, (rows[0].chat.id, rows[0].id))
+        for month, records in by_month.items():
+            self.archive.append(month, records)
+        self._delete(by_chat)
+        # Until the deletion commits, a crash would leave the batch in the database, to be archived again.
+        commit()
+        self.archive.commit()
+        ARCHIVED.inc(len(rows))
+        return len(rows)
+
+    @staticmethod
+    def _delete(by_chat: Dict[int, List[int]]) -> None:
+        # Deleting through Pony would load each message's replies one query at a time to unlink them. Doing it
+        # ourselves takes two statements per chat.
+        quote = db.provider.quote_name
+        table = quote(TelegramMessage._table_)
+        chat_column = quote(TelegramMessage.chat.columns[0])
+        id_column = quote(TelegramMessage.id.columns[0])
+        reply_chat, reply_id = (quote(x) for x in TelegramMessage.reply_to.columns)
+        for chat_id, message_ids in by_chat.items():
+            for ids in chunks(message_ids):
+                params = {f'id{i}': x for i, x in enumerate(ids)}
+                params['chat'] = chat_id
+                placeholders = ', '.join(f'$id{i}' for i in range(len(ids)))
+                db.execute(f'UPDATE {table} SET {reply_chat} = NULL, {reply_id} = NULL '
+                           f'WHERE {reply_chat} = $chat AND {reply_id} IN ({placeholders})', params)
+                db.execute(f'DELETE FROM {table} WHERE {chat_column} = $chat AND {id_column} IN ({placeholders})',
+                           params)
+
+    def iter_messages(self, chat_id: Optional[int] = None, start: Optional[datetime.datetime] = None,
+                      end: Optional[datetime.datetime] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Read messages from the archive and then the database, as records from :func:`to_record`, oldest first.
+
+        :param chat_id: Only read messages from this chat.
+        :param start: Only read messages from this time on.
+        :param end: Only read messages from before this time.
+        """
+        start = parse_date(start) if start is not None else None
+        end = parse_date(end) if end is not None else None
+        first_month = start.strftime('%Y-%m') if start is not None else None
+        last_month = end.strftime('%Y-%m') if end is not None else None
+        for month in self.archive.months():
+            if (first_month and month < first_month) or (last_month and month > last_month):
+                continue
+            for record in self.archive.read(month):
+                if chat_id is not None and record['chat'] != chat_id:
+                    continue
+                if start is not None or end is not None:
+                    date = parse_date(record['date'])
+                    if (start is not None and date < start) or (end is not None and date >= end):
+                        continue
+                yield record
+        yield from self._iter_hot(chat_id, start, end)
+
+    def _iter_hot(self, chat_id: Optional[int], start: Optional[datetime.datetime],
+                  end: Optional[datetime.datetime]) -> Iterator[Dict[str, Any]]:
+        # Page through with a key rather than an offset, so each page costs the same however far in we are, and
+        # don't hold a session open while the caller works through the results.
+        position = None
+        while True:
+            with timed_session('archive'):
+                query = select(m for m in TelegramMessage)
+                if chat_id is not None:
+                    query = query.filter(lambda m: m.chat.id == chat_id)
+                if start is not None:
+                    query = query.filter(lambda m: m.date >= start)
+                if end is not None:
+                    query = query.filter(lambda m: m.date < end)
+                if position is not None:
+                    date, chat, message = position
+                    query = query.filter(lambda m: m.date > date or (m.date == date and (
+                        m.chat.id > chat or (m.chat.id == chat and m.id > message))))
+                rows = query.order_by(TelegramMessage.date, TelegramMessage.chat, TelegramMessage.id)[:self.batch]
+                records = [to_record(x) for x in rows]
+                if rows:
+                    last = rows[-1]
+                    position = (parse_date(last.date), records[-1]['chat'], last.id)
+            yield from records
+            if len(records) < self.batch:
+                return
@@ -0,0 +1,317 @@
+import collections
+import contextlib
+import datetime
+import re
+import threading
+import traceback
+from dateutil.tz import tzutc
+from pony.orm import *
+from pony import orm
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from horsefax.telegram.events import ExecutionMode
+from horsefax.telegram.services.command import Command
+from horsefax.telegram.types import Chat
+
+from ..core import HorseFaxBot, ModuleTools, BaseModule, ChatService
+from ..db import db, timed_session, chunks, to_record, parse_date
+from .tracking import TelegramFile, TelegramMessage, TelegramUser
+import horsefax.bot.config as config
+
+
+class ChatActivity(db.Entity):
+    """How much one user said in one chat on one day, UTC."""
+    chat = Required(int, size=64)
+    day = Required(datetime.date)
+    user = Required(int, size=64)
+    messages = Required(int)
+    kinds = Required(Json)  # {kind: messages}
+    hours = Required(Json)  # messages in each hour of the day
+    PrimaryKey(chat, day, user)
+
+
+class ChatTally(db.Entity):
+    """How often a sticker or emoji was used in one chat on one day, UTC."""
+    chat = Required(int, size=64)
+    day = Required(datetime.date)
+    kind = Required(str, max_len=16)  # 'sticker' or 'emoji'
+    key = Required(str, max_len=255)  # The sticker's TelegramFile ID, or the emoji
+    label = orm.Optional(str, nullable=True)  # What to show for it
+    uses = Required(int)
+    PrimaryKey(chat, day, kind, key)
+
+
+_KINDS = {'TelegramTextMessage': 'text',
+          'TelegramPhotoMessage': 'photo',
+          'TelegramStickerMessage': 'sticker',
+          'TelegramVideoMessage': 'video',
+          'TelegramVideoNoteMessage': 'video note',
+          'TelegramDocumentMessage': 'document',
+          'TelegramAudioMessage': 'audio'}
+
+# Single code points in the blocks emoji live in, leaving out skin tone modifiers. Not exact, but close enough to
+# find the popular ones.
+_EMOJI = re.compile('[\U0001F000-\U0001F3FA\U0001F400-\U0001FAFF\u2600-\u27BF\u2B50\u2B55]')
+
+
+class _Totals:
+    """Counts for a set of messages, ready to be added to the rollups."""
+    def __init__(self) -> None:
+        # (chat, day, user) -> [messages, {kind: messages}, [messages per hour]]
+        self.activity = {}  # type: Dict[Tuple[int, datetime.date, int], List[Any]]
+        # (chat, day, kind, key) -> [uses, label]
+        self.tallies = {}  # type: Dict[Tuple[int, datetime.date, str, str], List[Any]]
+        # (chat, day, file) for stickers whose emoji are still to be looked up
+        self._stickers = []  # type: List[Tuple[int, datetime.date, str]]
+
+    def add(self, record: Dict[str, Any]) -> None:
+        """Count a message, given as from :func:`to_record`."""
+        date = parse_date(record['date']).astimezone(tzutc())
+        day = date.date()
+        chat = record['chat']
+        activity = self.activity.get((chat, day, record['sender']))
+        if activity is None:
+            activity = self.activity[(chat, day, record['sender'])] = [0, collections.Counter(), [0] * 24]
+        kind = _KINDS.get(record['entity'], 'other')
+        activity[0] += 1
+        activity[1][kind] += 1
+        activity[2][date.hour] += 1
+        if kind == 'sticker':
+            if 'file' in record:
+                self._stickers.append((chat, day, record['file']))
+            else:
+                # Archived before files had a table of their own.
+                self._tally(chat, day, 'sticker', record['file_id'], record.get('emoji'))
+        for emoji in _EMOJI.findall(record.get('text') or record.get('caption') or record.get('emoji') or ''):
+            self._tally(chat, day, 'emoji', emoji, emoji)
+
+    def resolve(self) -> None:
+        """Count the stickers added so far, looking up which emoji go with them. Must be called in a session."""
+        stickers, self._stickers = self._stickers, []
+        emoji = {}  # type: Dict[str, Optional[str]]
+        for ids in chunks({x[2] for x in stickers}):
+            emoji.update(select((x.id, x.emoji) for x in TelegramFile if x.id in ids))
+        for chat, day, file in stickers:
+            self._tally(chat, day, 'sticker', file, emoji.get(file))
+            for found in _EMOJI.findall(emoji.get(file) or ''):
+                self._tally(chat, day, 'emoji', found, found)
+
+    def _tally(self, chat: int, day: datetime.date, kind: str, key: str, label: str) -> None:
+        tally = self.tallies.get((chat, day, kind, key))
+        if tally is None:
+            tally = self.tallies[(chat, day, kind, key)] = [0, label]
+        tally[0] += 1
+
+    def chats(self) -> Dict[int, Tuple[List[Any], List[Any]]]:
+        """:return: This split up by chat, as (activity, tallies)."""
+        chats = collections.defaultdict(lambda: ([], []))  # type: Dict[int, Tuple[List[Any], List[Any]]]
+        for item in self.activity.items():
+            chats[item[0][0]][0].append(item)
+        for item in self.tallies.items():
+            chats[item[0][0]][1].append(item)
+        return chats
+
+
+class _Rebuild:
+    """The progress of a rebuild of the rollups."""
+    def __init__(self) -> None:
+        # The highest (chat ID, message ID) read back from the database so far.
+        self.position = None  # type: Optional[Tuple[int, int]]
+        # Messages logged since the rebuild started, but behind where it had read up to.
+        self.missed = []  # type: List[Dict[str, Any]]
+
+
+class ChatStatsModule(BaseModule):
+    """
+    Keeps per-chat, per-user, per-day counts of messages up to date as the tracking module logs them, so that
+    /chatstats doesn't have to count through the log. The tracking module must be loaded first.
+    """
+    # Messages read per query when rebuilding.
+    REBUILD_BATCH = 1000
+
+    def __init__(self, bot: HorseFaxBot, util: ModuleTools) -> None:
+        self.bot = bot
+        self.util = util
+        self.tracking = bot.modules.get('tracking')
+        if self.tracking is None:
+            raise ValueError("The chatstats module needs the tracking module, listed before it in HORSEFAX_MODULES")
+        self._rebuild = None  # type: Optional[_Rebuild]
+        self._rebuild_lock = threading.Lock()
+        self.tracking.add_log_sink(self.count_messages)
+        self.util.register_command('chatstats', self.chat_stats, mode=ExecutionMode.THREAD, timeout=30)
+        self.util.register_command('rebuildstats', self.rebuild_stats)
+
+    def count_messages(self, rows: List[TelegramMessage]) -> List[Callable[[], None]]:
+        """
+        Add newly logged messages to the rollups. Called by the tracking module in the transaction that logs them.
+        """
+        totals = _Totals()
+        records = [to_record(x) for x in rows]
+        for record in records:
+            totals.add(record)
+        self._apply(totals)
+        if self._rebuild is None:
+            return []
+        return [lambda: self._note_for_rebuild(records)]
+
+    def _note_for_rebuild(self, records: List[Dict[str, Any]]) -> None:
+        # Tracking is paused while a rebuild reads from the database, so this can't happen mid-read: anything at or
+        # below the rebuild's position has been missed by it, and anything above will be read later.
+        rebuild = self._rebuild
+        if rebuild is None or rebuild.position is None:
+            return
+        for record in records:
+            if (record['chat'], record['id']) <= rebuild.position:
+                rebuild.missed.append(record)
+
+    @staticmethod
+    def _apply(totals: _Totals, fresh: bool = False) -> None:
+        """
+        Add `totals` to the rollups. If `fresh` is set, there's nothing there yet for the chats in it. Must be called
+        in a session.
+        """
+        totals.resolve()
+        for chat, (activity, tallies) in totals.chats().items():
+            existing_activity = {}  # type: Dict[Tuple[int, datetime.date, int], ChatActivity]
+            existing_tallies = {}  # type: Dict[Tuple[int, datetime.date, str, str], ChatTally]
+            if not fresh:
+                days = {key[1] for key, _ in activity}
+                for batch in chunks(days):
+                    existing_activity.update(((x.chat, x.day, x.user), x) for x in
+                                             select(x for x in ChatActivity if x.chat == chat and x.day in batch))
+                    existing_tallies.update(((x.chat, x.day, x.kind, x.key), x) for x in
+                                            select(x for x in ChatTally if x.chat == chat and x.day in batch))
+            for key, (messages, kinds, hours) in activity:
+                row = existing_activity.get(key)
+                if row is None:
+                    ChatActivity(chat=key[0], day=key[1], user=key[2], messages=messages, kinds=dict(kinds),
+                                 hours=hours)
+                else:
+                    row.messages += messages
+                    row.kinds = dict(collections.Counter(row.kinds) + kinds)
+                    row.hours = [x + y for x, y in zip(row.hours, hours)]
+            for key, (uses, label) in tallies:
+                row = existing_tallies.get(key)
+                if row is None:
+                    ChatTally(chat=key[0], day=key[1], kind=key[2], key=key[3], label=label, uses=uses)
+                else:
+                    row.uses += uses
+
+    def rebuild_stats(self, command: Command) -> Optional[str]:
+        if command.message.sender.id not in config.admins:
+            return None
+        if not self._rebuild_lock.acquire(blocking=False):
+            return "Already rebuilding chat stats."
+        threading.Thread(target=self._rebuild_and_report, args=(command.message.chat,), daemon=True).start()
+        return "Rebuilding chat stats. I'll let you know when it's done."
+
+    def _rebuild_and_report(self, chat: Chat) -> None:
+        try:
+            count = self.rebuild()
+        except Exception:
+            print("Rebuilding chat stats failed:")
+            traceback.print_exc()
+            self.bot.message(chat, "Rebuilding chat stats failed.", parsing=ChatService.ParseMode.NONE)
+        else:
+            self.bot.message(chat, f"Rebuilt chat stats from {count:,} messages.", parsing=ChatService.ParseMode.NONE)
+        finally:
+            self._rebuild_lock.release()
+
+    def rebuild(self) -> int:
+        """
+        Recount everything from the message log, including any archived messages, and replace the rollups with the
+        result. The archive and the database are each read through once, whatever the number of chats. Messages
+        logged meanwhile are still counted exactly once, without holding up tracking for more than one query at a
+        time.
+
+        :return: How many messages were counted.
+        """
+        archive = self.bot.modules.get('archive')
+        totals = _Totals()
+        count = 0
+        rebuild = _Rebuild()
+        with contextlib.ExitStack() as stack:
+            # Messages being moved out of the database midway would be missed.
+            if archive is not None:
+                stack.enter_context(archive.paused())
+                for month in archive.archive.months():
+                    for record in archive.archive.read(month):
+                        totals.add(record)
+                        count += 1
+            with self.tracking.paused():
+                self._rebuild = rebuild
+            try:
+                while True:
+                    with self.tracking.paused(), timed_session('chatstats'):
+                        query = select(m for m in TelegramMessage)
+                        if rebuild.position is not None:
+                            chat, message = rebuild.position
+                            query = query.filter(lambda m: m.chat.id > chat or (m.chat.id == chat and m.id > message))
+                        rows = query.order_by(TelegramMessage.chat, TelegramMessage.id)[:self.REBUILD_BATCH]
+                        for row in rows:
+                            record = to_record(row)
+                            totals.add(record)
+                        count += len(rows)
+                        if rows:
+                            rebuild.position = (record['chat'], record['id'])
+                        if len(rows) < self.REBUILD_BATCH:
+                            # Nothing more will be logged until we're done, so now is the time to swap in the result.
+                            for record in rebuild.missed:
+                                totals.add(record)
+                            count += len(rebuild.missed)
+                            select(x for x in ChatActivity).delete(bulk=True)
+                            select(x for x in ChatTally).delete(bulk=True)
+                            self._apply(totals, fresh=True)
+                            return count
+            finally:
+                with self.tracking.paused():
+                    self._rebuild = None
+
+    @timed_session('chatstats')
+    def chat_stats(self, command: Command) -> Optional[str]:
+        days = config.chatstats_days
+        chat_id = command.message.chat.id
+        since = datetime.datetime.now(tz=tzutc()).date() - datetime.timedelta(days=days - 1)
+        posters = collections.Counter()  # type: Dict[int, int]
+        per_day = collections.Counter()  # type: Dict[datetime.date, int]
+        kinds = collections.Counter()  # type: Dict[str, int]
+        hours = [0] * 24
+        for row in select(x for x in ChatActivity if x.chat == chat_id and x.day >= since):
+            posters[row.user] += row.messages
+            per_day[row.day] += row.messages
+            kinds.update(row.kinds)
+            hours = [x + y for x, y in zip(hours, row.hours)]
+        total = sum(posters.values())
+        if not total:
+            return f"Nobody's said anything here in the last {days} days."
+        stickers = collections.Counter()  # type: Dict[str, int]
+        emoji = collections.Counter()  # type: Dict[str, int]
+        labels = {}  # type: Dict[str, str]
+        for kind, key, label, uses in select((x.kind, x.key, x.label, sum(x.uses)) for x in ChatTally
+                                             if x.chat == chat_id and x.day >= since):
+            (stickers if kind == 'sticker' else emoji)[key] += uses
+            labels[key] = label or '?'
+
+        top = posters.most_common(config.chatstats_top)
+        ids = [x for x, _ in top]
+        names = {x.id: x.first_name for x in select(x for x in TelegramUser if x.id in ids)}
+        busiest_day, busiest_day_count = max(per_day.items(), key=lambda x: x[1])
+        busiest_hours = sorted(range(24), key=lambda x: hours[x], reverse=True)[:3]
+        lines = [f"In the last {days} days, {len(posters):,} people sent {total:,} messages, "
+                 f"about {total / days:,.0f} a day.",
+                 f"Top posters: {', '.join(f'{names.get(x, x)} ({n:,})' for x, n in top)}",
+                 f"Busiest day: {busiest_day:%Y-%m-%d} ({busiest_day_count:,})",
+                 f"Busiest hours (UTC): {', '.join(f'{x:02}:00 ({hours[x]:,})' for x in busiest_hours if hours[x])}",
+                 f"Mix: {', '.join(f'{k} {n / total:.0%}' for k, n in kinds.most_common())}"]
+        if stickers:
+            lines.append(f"Top stickers: {self._leaders(stickers, labels)}")
+        if emoji:
+            lines.append(f"Top emoji: {self._leaders(emoji, labels)}")
+        self.bot.message(command.message.chat, '\n'.join(lines), parsing=ChatService.ParseMode.NONE)
+        return None
+
+    @staticmethod
+    def _leaders(counts: Dict[str, int], labels: Dict[str, str]) -> str:
+        # Stickers are shown by their emoji, so the same emoji can come up more than once for different stickers.
+        leaders = collections.Counter(counts).most_common(config.chatstats_top)
+        return ', '.join(f'{labels[k]} ×{n:,}' for k, n in leaders)
@@ -1,7 +1,9 @@
+from concurrent.futures import Future
 from typing import cast
 from pony.orm import *
 
 from horsefax.telegram.services.command import Command
+from horsefax.telegram.types import Message, TextMessage
 
 from ..core import HorseFaxBot, ModuleTools, BaseModule, ChatService
 from ..db import db
@@ -53,16 +55,36 @@ class CollectionModule(BaseModule):
 
     @db_session
     def add_item(self, command: Command):
-        if len(command.args) < 2:
+        if len(command.args) < 1:
             return "Syntax: `/additem <collection> <thing to add>`"
         collection_name = command.args[0]
-        thing = ' '.join(command.args[1:])
         collection = Collection.get(name=collection_name)
         if collection is None:
             return "That collection does not exist."
+        if len(command.args) == 1:
+            # Ask for the item, and take the next thing this person says in this chat as the answer.
+            message = command.message
+            reply = self.bot.telegram.expect_event("message", (message.chat.id, message.sender.id), timeout=60)
+            reply.add_done_callback(lambda x: self.add_item_reply(collection_name, x))
+            return f"What should I add to /{collection_name}?"
+        thing = ' '.join(command.args[1:])
         item = collection.items.create(content=thing, added_by=command.message.sender.id)
         return f"Added. {len(collection.items):,} items in /{collection.name}."
 
+    @db_session
+    def add_item_reply(self, collection_name: str, reply: 'Future[Message]'):
+        if reply.exception() is not None:
+            return
+        message = reply.result()
+        # Anything that isn't plain text, including another command, abandons the question.
+        if not isinstance(message, TextMessage) or message.text.startswith('/'):
+            return
+        collection = Collection.get(name=collection_name)
+        if collection is None:
+            return
+        collection.items.create(content=message.text, added_by=message.sender.id)
+        self.bot.message(message.chat, f"Added. {len(collection.items):,} items in /{collection.name}.")
+
     @db_session
     def remove_item(self, command: Command):
         if len(command.args) < 2:
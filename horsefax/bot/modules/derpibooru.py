@@ -1,6 +1,7 @@
 import requests
 
 from ..core import HorseFaxBot, ModuleTools, BaseModule
+from horsefax.telegram.events import ExecutionMode
 from horsefax.telegram.services.command import Command
 
 
@@ -8,7 +9,7 @@ class DerpModule(BaseModule):
     def __init__(self, bot: HorseFaxBot, util: ModuleTools) -> None:
         self.bot = bot
         self.util = util
-        self.util.register_command('derpibooru', self.derp)
+        self.util.register_command('derpibooru', self.derp, mode=ExecutionMode.THREAD, timeout=30)
 
     def derp(self, command: Command) -> str:
         search = ' '.join(command.args)
@@ -17,7 +18,7 @@ class DerpModule(BaseModule):
         result = requests.get("https://derpibooru.org/search.json", {
             'filter_id': 141911,
             'q': search,
-            'sf': 'random'}).json()
+            'sf': 'random'}, timeout=(5, 20)).json()
         if 'search' not in result:
             return "Something broke."
         result = result['search']
@@ -47,7 +47,7 @@ class CollectionModule(BaseModule):
         group = PingGroup.get(name=name)
         if group is None:
             return f"No such group: `{name}`."
-        user = TelegramUser[command.message.sender.id]
+        user = TelegramUser.ensure(command.message.sender)
         if user in group.members:
             return f"You are already a member of the group `{name}`."
         if user.username is None:
@@ -78,7 +78,7 @@ class CollectionModule(BaseModule):
         group = PingGroup.get(name=name)
         if group is None:
             return f"No such group: `{name}`."
-        user = TelegramUser[command.message.sender.id]
+        user = TelegramUser.ensure(command.message.sender)
         if user not in group.members:
             return f"You are not a member of the group `{group.name}`."
         group.members.remove(user)
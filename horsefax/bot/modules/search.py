@@ -0,0 +1,68 @@
+from pony.orm import *
+from typing import Dict, List, Optional
+
+from horsefax.telegram.events import ExecutionMode
+from horsefax.telegram.services.command import Command
+
+from ..core import HorseFaxBot, ModuleTools, BaseModule, ChatService
+from .tracking import TelegramUser
+import horsefax.bot.config as config
+
+
+class SearchModule(BaseModule):
+    """
+    Searches the chat log kept by the tracking module, which must also be loaded.
+    """
+    # Long messages are cut down to this many characters around the first match.
+    SNIPPET_LENGTH = 200
+
+    def __init__(self, bot: HorseFaxBot, util: ModuleTools) -> None:
+        self.bot = bot
+        self.util = util
+        self.util.register_command('search', self.search, mode=ExecutionMode.THREAD, timeout=30)
+
+    def search(self, command: Command) -> Optional[str]:
+        terms = []  # type: List[str]
+        page = 1
+        for arg in command.args:
+            if arg.startswith('page:') and arg[len('page:'):].isdigit():
+                page = max(1, int(arg[len('page:'):]))
+            else:
+                terms.append(arg)
+        if not terms:
+            return "Syntax: `/search <words> [page:<n>]`"
+        tracking = self.bot.modules.get('tracking')
+        if tracking is None or tracking.search_index is None:
+            return "Search isn't available."
+        chat = command.message.chat
+        size = config.search_page_size
+        # Ask for one more than we show to find out if there's another page.
+        hits = tracking.search(chat.id, ' '.join(terms), size + 1, (page - 1) * size)
+        if not hits:
+            return "Nothing found." if page == 1 else "There are no more results."
+        more = len(hits) > size
+        hits = hits[:size]
+        names = self._names(x.sender for x in hits)
+        lines = []
+        for hit in hits:
+            lines.append(f"{names.get(hit.sender, 'Someone')}, {hit.date:%Y-%m-%d %H:%M}: "
+                         f"{self._snippet(hit.text, terms)}")
+        if more:
+            lines.append(f"More: /search {' '.join(terms)} page:{page + 1}")
+        self.bot.message(chat, '\n\n'.join(lines), parsing=ChatService.ParseMode.NONE, preview=False)
+        return None
+
+    @staticmethod
+    @db_session
+    def _names(user_ids) -> Dict[int, str]:
+        ids = set(user_ids)
+        return {x.id: x.first_name for x in select(x for x in TelegramUser if x.id in ids)}
+
+    def _snippet(self, text: str, terms: List[str]) -> str:
+        if len(text) <= self.SNIPPET_LENGTH:
+            return text
+        lowered = text.lower()
+        found = [i for i in (lowered.find(x.lower()) for x in terms) if i >= 0]
+        start = max(0, min(found) - self.SNIPPET_LENGTH // 4) if found else 0
+        end = start + self.SNIPPET_LENGTH
+        return ('…' if start > 0 else '') + text[start:end].strip() + ('…' if end < len(text) else '')
@@ -0,0 +1,43 @@
+from horsefax import metrics
+from horsefax.telegram.services.command import Command
+
+from ..core import HorseFaxBot, ModuleTools, BaseModule, ChatService
+import horsefax.bot.config as config
+
+
+class StatsModule(BaseModule):
+    # Telegram won't send more than 4096 characters in one message, so only the busiest series are shown.
+    MAX_LINES = 40
+
+    def __init__(self, bot: HorseFaxBot, util: ModuleTools) -> None:
+        self.bot = bot
+        self.util = util
+        self.util.register_command('stats', self.stats)
+
+    def stats(self, command: Command):
+        if command.message.sender.id not in config.admins:
+            return None
+        lines = []
+        for metric in metrics.registry.metrics():
+            for values, series in metric.series():
+                name = metric.name + (f"{{{','.join(values)}}}" if values else '')
+                if isinstance(metric, metrics.Histogram):
+                    if not series.count:
+                        continue
+                    lines.append((series.count, f"{name}: {series.count:,} × p50 {self._format(series.quantile(0.5))}, "
+                                                f"p95 {self._format(series.quantile(0.95))}"))
+                elif series.value:
+                    lines.append((series.value, f"{name}: {series.value:,.0f}"))
+        if not lines:
+            return "Nothing has been measured yet."
+        lines.sort(key=lambda x: x[0], reverse=True)
+        text = '\n'.join(x for _, x in lines[:self.MAX_LINES])
+        if len(lines) > self.MAX_LINES:
+            text += f"\n…and {len(lines) - self.MAX_LINES:,} more."
+        self.bot.message(command.message.chat, text, parsing=ChatService.ParseMode.NONE)
+
+    @staticmethod
+    def _format(seconds: float) -> str:
+        if seconds >= 1:
+            return f"{seconds:.1f}s"
+        return f"{seconds * 1000:.1f}ms"
@@ -1,14 +1,29 @@
+import atexit
+import collections
+import contextlib
 import datetime
+import functools
+import threading
+import time
+import traceback
+import typing
+from dateutil.tz import tzutc
 from pony.orm import *
 from pony import orm
-from typing import Optional, Dict, Union
+from typing import Optional, Dict, Union, Any, Callable, Iterable, List, Tuple
 
 
+from horsefax import metrics
+from horsefax.telegram.cache import LRUCache, RotatingBloomFilter
+from horsefax.telegram.connections.transport import Backoff
 from ..core import HorseFaxBot, ModuleTools, BaseModule
-from ..db import db
+from ..db import db, timed_session, chunks
+from ..search import SearchHit, create_index
+import horsefax.bot.config as config
 from horsefax.telegram.types import (Message, User, Chat, UsersJoinedMessage, UserLeftMessage, ChatMigrateFromIDMessage,
                                      MessagePinnedMessage, TextMessage, TextEntity, PhotoMessage, StickerMessage,
-                                     VideoMessage, VideoNoteMessage, DocumentMessage, AudioMessage, PhotoSize)
+                                     VideoMessage, VideoNoteMessage, DocumentMessage, AudioMessage, PhotoSize,
+                                     AnimationMessage)
 
 
 class TelegramUser(db.Entity):
@@ -24,6 +39,17 @@ class TelegramUser(db.Entity):
     # for groups module
     ping_groups = Set('PingGroup')
 
+    @classmethod
+    def ensure(cls, user: User) -> 'TelegramUser':
+        """
+        :return: The row for `user`, creating it if tracking hasn't got round to it yet.
+        """
+        row = cls.get(id=user.id)
+        if row is None:
+            row = cls(id=user.id, username=user.username, first_name=user.first_name, last_name=user.last_name,
+                      language_code=user.language_code)
+        return row
+
     def to_user(self):
         return User({'id': self.id,
                      'username': self.username,
@@ -59,21 +85,38 @@ class TelegramTextMessage(TelegramMessage):
     entities = Required(Json)
 
 
-class FileMessage(TelegramMessage):
+class TelegramFile(db.Entity):
+    """
+    A file, however many times it's been sent. Files are identified by their file_unique_id where Telegram gives one,
+    and otherwise by their file_id.
+    """
+    id = PrimaryKey(str, max_len=255)
+    # The most recent file_id seen, which is what to use to send it again.
     file_id = Required(str)
     mime_type = orm.Optional(str, nullable=True)
     file_size = orm.Optional(int)
-    caption = orm.Optional(str, nullable=True)
     thumbnail = orm.Optional(str, nullable=True)
+    width = orm.Optional(int, nullable=True)
+    height = orm.Optional(int, nullable=True)
+    duration = orm.Optional(int, nullable=True)
+    emoji = orm.Optional(str, nullable=True)
+    file_name = orm.Optional(str, nullable=True)
+    performer = orm.Optional(str, nullable=True)
+    title = orm.Optional(str, nullable=True)
+    messages = Set('FileMessage')
+
+
+class FileMessage(TelegramMessage):
+    file = Required(TelegramFile)
+    caption = orm.Optional(str, nullable=True)
 
 
 class VisualMessage(FileMessage):
-    width = Required(int)
-    height = Required(int)
+    pass
 
 
 class LongMessage(FileMessage):
-    duration = Required(int)
+    pass
 
 
 class TelegramPhotoMessage(VisualMessage):
@@ -81,7 +124,7 @@ class TelegramPhotoMessage(VisualMessage):
 
 
 class TelegramStickerMessage(VisualMessage):
-    emoji = orm.Optional(str, nullable=True)
+    pass
 
 
 class TelegramVideoMessage(LongMessage, VisualMessage):
@@ -92,116 +135,569 @@ class TelegramVideoNoteMessage(LongMessage, VisualMessage):
     pass
 
 class TelegramDocumentMessage(FileMessage):
-    file_name = orm.Optional(str, nullable=True)
+    pass
 
 class TelegramAudioMessage(LongMessage):
-    performer = orm.Optional(str, nullable=True)
-    title = orm.Optional(str, nullable=True)
+    pass
+
+
+# What we know about a file, as sent in a message. `id` is what it's stored under; see TelegramFile.
+FileInfo = collections.namedtuple('FileInfo', ['id', 'file_id', 'mime_type', 'file_size', 'thumbnail', 'width',
+                                               'height', 'duration', 'emoji', 'file_name', 'performer', 'title'])
+FileInfo.__new__.__defaults__ = (None,) * 10
+
+
+def searchable_text(row: TelegramMessage) -> Optional[str]:
+    """:return: The text of a logged message, or its caption."""
+    if isinstance(row, TelegramTextMessage):
+        return row.text
+    if isinstance(row, FileMessage):
+        return row.caption
+    return None
+
+
+CACHE_LOOKUPS = metrics.counter('horsefax_tracking_cache_total',
+                                "Users, chats and files seen that were unchanged since they were last saved (hit) "
+                                "or not (miss).", ['kind', 'result'])
+TRACKING_DROPPED = metrics.counter('horsefax_tracking_dropped_total',
+                                   "Messages that were never logged, because they kept failing to save (failed) or "
+                                   "arrived while too many were waiting on a failing database (overflow).",
+                                   ['reason'])
+
+# Errors that say the database can't be reached right now, rather than that something about the data is wrong.
+_TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+
+class _Batch:
+    """
+    Tracking data waiting to be written. Users and chats are kept as the latest version seen of each; membership
+    changes are kept in the order they happened.
+    """
+    def __init__(self) -> None:
+        self.users = {}  # type: Dict[int, User]
+        self.chats = {}  # type: Dict[int, Chat]
+        # ('add' | 'remove', chat id, user id) or ('migrate', old chat id, new chat id)
+        self.memberships = []  # type: List[Tuple[str, int, int]]
+        self.pins = {}  # type: Dict[int, int]
+        self.messages = collections.OrderedDict()  # type: Dict[Tuple[int, int], Message]
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def empty(self) -> bool:
+        return not (self.users or self.chats or self.memberships or self.pins or self.messages)
+
+    def merge(self, newer: '_Batch') -> None:
+        """Fold a batch gathered after this one into it."""
+        self.users.update(newer.users)
+        self.chats.update(newer.chats)
+        self.memberships.extend(newer.memberships)
+        self.pins.update(newer.pins)
+        for key, message in newer.messages.items():
+            self.messages.setdefault(key, message)
 
 
 class TrackingModule(BaseModule):
-    def __init__(self, bot: HorseFaxBot, util: ModuleTools) -> None:
+    """
+    Logs every message we see, along with the users and chats involved.
+
+    Nothing is written as messages arrive. Instead they are gathered up and written in a single transaction every
+    `batch` messages or `interval` seconds, whichever comes first. If `max_pending` messages are waiting to be written,
+    message handling waits for them, so at most that many messages can be lost in a crash. A clean shutdown loses
+    nothing.
+
+    If the database can't be reached, writes are retried with backoff, and once `max_pending` messages are waiting any
+    more are dropped rather than held up. If a batch fails for any other reason, its messages are retried one per
+    transaction so that one bad message can't hold up the rest; a message that fails `max_attempts` times is given up
+    on and kept in :attr:`dead_letters`.
+
+    If `search` is set, the text of each message is added to a full-text index as it's logged; see :meth:`search`.
+    """
+    # How many messages given up on to keep.
+    DEAD_LETTERS = 100
+
+    def __init__(self, bot: HorseFaxBot, util: ModuleTools, batch: int = config.tracking_batch,
+                 interval: float = config.tracking_interval, max_pending: int = config.tracking_max_pending,
+                 dedupe_window: float = config.tracking_dedupe_window, search: bool = config.tracking_search,
+                 max_attempts: int = config.tracking_max_attempts) -> None:
         self.bot = bot
         self.util = util
+        self.batch = batch
+        self.interval = interval
+        self.max_pending = max(batch, max_pending)
+        self.max_attempts = max_attempts
+        # How many times each message that's failed to save has done so.
+        self._attempts = {}  # type: Dict[Tuple[int, int], int]
+        # The most recent messages given up on, for inspection.
+        self.dead_letters = collections.deque(maxlen=self.DEAD_LETTERS)  # type: typing.Deque[Message]
+        self._failures = 0
+        self._retry_at = 0.0
+        self._dropping = False
+        self._backoff = Backoff(base=1, cap=60)
+        # What we last saved for each user and chat, so we can skip saving it again when nothing has changed.
+        self._saved_users = LRUCache(config.tracking_cache_size)  # type: LRUCache[int, tuple]
+        self._saved_chats = LRUCache(config.tracking_cache_size)  # type: LRUCache[int, tuple]
+        self._saved_files = LRUCache(config.tracking_cache_size)  # type: LRUCache[str, tuple]
+        # Who we know to be in each chat.
+        self._members = LRUCache(config.tracking_member_chats)  # type: LRUCache[int, typing.Set[int]]
+        # Which messages we've logged lately, so that new ones can be told apart without asking the database.
+        self.dedupe_window = dedupe_window
+        self._recent = RotatingBloomFilter(config.tracking_dedupe_capacity)
+        self.search_index = None
+        if search:
+            with timed_session('tracking'):
+                self.search_index = create_index()
+        self._sinks = []  # type: List[Callable[[List[TelegramMessage]], List[Callable[[], None]]]]
+        self._horizons = []  # type: List[Callable[[], datetime.datetime]]
+        self._pending = _Batch()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
         self.bot.telegram.register_handler("message", self.handle_message)
 
-    @db_session
+    def shutdown(self) -> None:
+        self.flush()
+
+    def add_log_sink(self, sink: Callable[[List[TelegramMessage]], List[Callable[[], None]]]) -> None:
+        """
+        Have `sink` called with each batch of newly logged messages, in the transaction that logs them. Like
+        :meth:`log_messages`, it returns what to do once the transaction commits. Sinks should be added before any
+        messages arrive.
+        """
+        self._sinks.append(sink)
+
+    def add_log_horizon(self, horizon: Callable[[], datetime.datetime]) -> None:
+        """
+        Leave messages dated before whatever `horizon` returns unlogged, because they've been moved out of the log and
+        are only turning up again as what something replies to. Their senders and chats are still saved.
+        """
+        self._horizons.append(horizon)
+
+    @contextlib.contextmanager
+    def paused(self):
+        """
+        Hold off writing anything for the duration of a ``with`` block. Messages are still gathered meanwhile.
+        """
+        with self._flush_lock:
+            yield
+
     def handle_message(self, message: Message) -> None:
+        with self._lock:
+            if self._failures and len(self._pending) >= self.max_pending:
+                # Waiting for the database wouldn't help, and would hold up everything else.
+                TRACKING_DROPPED.labels('overflow').inc()
+                if not self._dropping:
+                    print(f"{self.max_pending} tracked messages are waiting to be saved; dropping any more.")
+                    self._dropping = True
+                return
+            self._gather(message, self._pending)
+            pending = len(self._pending)
+        if pending >= self.max_pending and not self._backing_off():
+            self.flush()
+        elif pending >= self.batch:
+            self._wake.set()
+
+    def _gather(self, message: Message, batch: _Batch) -> None:
         # Track members
         origin = message.sender
-        self.update_user(origin)
+        batch.users[origin.id] = origin
         if message.forward_from and isinstance(message.forward_from, User):
-            self.update_user(message.forward_from)
+            batch.users[message.forward_from.id] = message.forward_from
         if message.reply_to_message:
-            self.handle_message(message.reply_to_message)
+            self._gather(message.reply_to_message, batch)
 
         if isinstance(message, TextMessage):
             for entity in message.entities:
                 if entity.user is not None:
-                    self.update_user(entity.user)
+                    batch.users[entity.user.id] = entity.user
 
         # Track chats
-        self.update_chat(message.chat)
-        TelegramChat[message.chat.id].users.add(TelegramUser[origin.id])
+        batch.chats[message.chat.id] = message.chat
+        batch.memberships.append(('add', message.chat.id, origin.id))
 
         if isinstance(message, UsersJoinedMessage):
             for user in message.users:
-                self.update_user(user)
-                TelegramChat[message.chat.id].users.add(TelegramUser[user.id])
+                batch.users[user.id] = user
+                batch.memberships.append(('add', message.chat.id, user.id))
 
         if isinstance(message, UserLeftMessage):
-            self.update_user(message.user)
-            TelegramChat[message.chat.id].users.remove(TelegramUser[message.user.id])
+            batch.users[message.user.id] = message.user
+            batch.memberships.append(('remove', message.chat.id, message.user.id))
 
         if isinstance(message, MessagePinnedMessage):
-            TelegramChat[message.chat.id].pinned_message = message.message.message_id
+            batch.pins[message.chat.id] = message.message.message_id
 
         if isinstance(message, ChatMigrateFromIDMessage):
-            TelegramChat[message.chat.id].users.add(TelegramChat[message.id].users)
-            TelegramChat[message.id].users.clear()
-
-        if TelegramMessage.get(id=message.message_id):
-            return
-        # Handle logging
+            batch.memberships.append(('migrate', message.id, message.chat.id))
+
+        batch.messages.setdefault((message.chat.id, message.message_id), message)
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if not self._backing_off():
+                self.flush()
+
+    def _backing_off(self) -> bool:
+        return time.monotonic() < self._retry_at
+
+    def flush(self) -> None:
+        """
+        Write everything gathered so far. Whatever can't be written yet is kept to try again later.
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch = self._pending
+                self._pending = _Batch()
+            if batch.empty():
+                return
+            retry = self._write_all(batch)
+            with self._lock:
+                if retry.empty():
+                    self._failures = 0
+                    self._retry_at = 0.0
+                    self._dropping = False
+                    return
+                retry.merge(self._pending)
+                self._pending = retry
+                self._failures += 1
+                self._retry_at = time.monotonic() + self._backoff.delay(self._failures)
+
+    def _write_all(self, batch: _Batch) -> _Batch:
+        # :return: Whatever should be tried again later.
+        try:
+            self._commit(batch)
+            return _Batch()
+        except _TRANSIENT_ERRORS:
+            print(f"Couldn't save {len(batch)} tracked message(s); will try again:")
+            traceback.print_exc()
+            return batch
+        except Exception:
+            print(f"Failed to save {len(batch)} tracked message(s); trying them one at a time:")
+            traceback.print_exc()
+        retry = _Batch()
+        messages = list(batch.messages.items())
+        for i, (key, message) in enumerate(messages):
+            single = _Batch()
+            self._gather(message, single)
+            try:
+                self._commit(single)
+            except _TRANSIENT_ERRORS:
+                # Not this message's fault, so leave it and the rest for next time as they are.
+                for _, later in messages[i:]:
+                    self._gather(later, retry)
+                return retry
+            except Exception:
+                attempts = self._attempts.get(key, 0) + 1
+                if attempts < self.max_attempts:
+                    self._attempts[key] = attempts
+                    retry.merge(single)
+                    continue
+                del self._attempts[key]
+                print(f"Giving up on saving message {key[1]} in chat {key[0]} after {attempts} attempts:")
+                traceback.print_exc()
+                self.dead_letters.append(message)
+                TRACKING_DROPPED.labels('failed').inc()
+            else:
+                self._attempts.pop(key, None)
+        return retry
+
+    def _commit(self, batch: _Batch) -> None:
+        with timed_session('tracking'):
+            saved = self._write(batch)
+        # Only now that they're committed can we rely on these being in the database.
+        for remember in saved:
+            remember()
+
+    def _write(self, batch: _Batch) -> List[Callable[[], None]]:
+        saved = self.update_users(batch.users.values())
+        saved += self.update_chats(batch.chats.values())
+
+        saved += self.update_memberships(batch.memberships)
+
+        for chat_id, message_id in batch.pins.items():
+            TelegramChat[chat_id].pinned_message = message_id
+
+        saved += self.log_messages(batch.messages)
+        return saved
+
+    def log_messages(self, messages: Dict[Tuple[int, int], Message]) -> List[Callable[[], None]]:
+        """
+        Log whichever of the given messages, keyed by (chat ID, message ID), haven't been logged already.
+
+        :return: What to remember about the messages once the transaction commits.
+        """
+        if not self._recent.covers(time.time()):
+            self._warm_recent()
+        # Anything the filter says it hasn't seen, and that's recent enough for it to know about, is definitely new.
+        # Everything else has to be checked, a query per chat.
+        unsure = collections.defaultdict(list)  # type: Dict[int, List[int]]
+        for (chat_id, message_id), message in messages.items():
+            if self._recent.covers(message.date.timestamp()) and (chat_id, message_id) not in self._recent:
+                CACHE_LOOKUPS.labels('message', 'hit').inc()
+            else:
+                CACHE_LOOKUPS.labels('message', 'miss').inc()
+                unsure[chat_id].append(message_id)
+        logged = set()  # type: typing.Set[Tuple[int, int]]
+        for chat_id, message_ids in unsure.items():
+            for ids in chunks(message_ids):
+                logged.update((chat_id, x) for x in select(m.id for m in TelegramMessage
+                                                           if m.chat.id == chat_id and m.id in ids))
+        horizon = max((x() for x in self._horizons), default=None)
+        if horizon is not None:
+            # Anything older that isn't logged has been moved out of the log, and mustn't come back.
+            messages = collections.OrderedDict((k, v) for k, v in messages.items()
+                                               if k in logged or v.date >= horizon)
+
+        # Files have to exist before the messages that refer to them.
+        files = {}  # type: Dict[Tuple[int, int], FileInfo]
+        for key, message in messages.items():
+            if key not in logged:
+                info = self._file_info(message)
+                if info is not None:
+                    files[key] = info
+        created = self.update_files(files.values())
+        rows = []  # type: List[TelegramMessage]
+        indexed = []  # type: List[Tuple[int, int, int, datetime.datetime, str]]
+        for key, message in messages.items():
+            if key in logged:
+                continue
+            reply_to = None
+            if message.reply_to_message is not None:
+                # Replies are always to messages in the same chat. Whatever was replied to was gathered before the
+                # reply, so if it could be logged it has been by now.
+                reply_key = (message.chat.id, message.reply_to_message.message_id)
+                if reply_key in logged:
+                    reply_to = reply_key
+            row = self._log_message(message, reply_to, files.get(key))
+            if row is None:
+                continue
+            logged.add(key)
+            rows.append(row)
+            created.append(functools.partial(self._recent.add, key, message.date.timestamp()))
+            text = searchable_text(row)
+            if text:
+                indexed.append((message.chat.id, message.message_id, message.sender.id, message.date, text))
+        if self.search_index is not None and indexed:
+            self.search_index.add(indexed)
+        if rows:
+            for sink in self._sinks:
+                created += sink(rows)
+        return created
+
+    def _warm_recent(self) -> None:
+        # Fill the filter with everything logged recently, so that it can answer for messages from then on.
+        since = time.time() - self.dedupe_window
+        cutoff = datetime.datetime.fromtimestamp(since, tz=tzutc())
+        now = time.time()
+        for chat_id, message_id in select((m.chat.id, m.id) for m in TelegramMessage if m.date >= cutoff):
+            self._recent.add((chat_id, message_id), now)
+        self._recent.start(since)
+
+    def _log_message(self, message: Message, reply_to: Optional[Tuple[int, int]],
+                     file: Optional[FileInfo]) -> Optional[TelegramMessage]:
+        # Users, chats, replies and files are given by primary key, which Pony accepts without having to load them.
         log_params = {'id': message.message_id,
-                      'sender': TelegramUser[message.sender.id],
+                      'sender': message.sender.id,
                       'date': message.date,
-                      'chat': TelegramChat[message.chat.id],
-                      'forward_from': TelegramUser[message.forward_from.id] if message.forward_from else None,
-                      'reply_to': TelegramMessage.get(id=message.reply_to_message.message_id) if message.reply_to_message is not None else None,
+                      'chat': message.chat.id,
+                      'forward_from': message.forward_from.id if message.forward_from else None,
+                      'reply_to': reply_to,
                       'edit_date': message.edit_date}
         if isinstance(message, TextMessage):
-            TelegramTextMessage(text=message.text,
-                                entities=[self._json_from_entity(x) for x in message.entities],
-                                **log_params)
-        elif isinstance(message, PhotoMessage):
+            return TelegramTextMessage(text=message.text,
+                                       entities=[self._json_from_entity(x) for x in message.entities],
+                                       **log_params)
+        if file is None:
+            return None
+        log_params['file'] = file.id
+        if isinstance(message, PhotoMessage):
+            return TelegramPhotoMessage(caption=message.caption, **log_params)
+        elif isinstance(message, StickerMessage):
+            return TelegramStickerMessage(**log_params)
+        elif isinstance(message, VideoMessage):
+            return TelegramVideoMessage(caption=message.caption, **log_params)
+        elif isinstance(message, VideoNoteMessage):
+            return TelegramVideoNoteMessage(**log_params)
+        elif isinstance(message, (DocumentMessage, AnimationMessage)):
+            # Animations used to arrive as plain documents, so keep logging them that way.
+            return TelegramDocumentMessage(caption=message.caption, **log_params)
+        elif isinstance(message, AudioMessage):
+            return TelegramAudioMessage(**log_params)
+        return None
+
+    @staticmethod
+    def _file_info(message: Message) -> Optional[FileInfo]:
+        """:return: The file sent in `message`, if it's a kind of message we log files for."""
+        if isinstance(message, PhotoMessage):
             big_photo = max(message.photo, key=lambda x: x.width * x.height)  # type: PhotoSize
             if len(message.photo) > 1:
                 small_photo = min(message.photo, key=lambda x: x.width * x.height)  # type: PhotoSize
                 thumb = small_photo.file_id
             else:
                 thumb = None
-            TelegramPhotoMessage(file_id=big_photo.file_id, file_size=big_photo.file_size, width=big_photo.width,
-                                 height=big_photo.height, caption=message.caption, mime_type="image/jpeg",
-                                 thumbnail=thumb, **log_params)
-        elif isinstance(message, StickerMessage):
-            TelegramStickerMessage(file_id=message.file_id, file_size=message.file_size, mime_type="image/webp",
-                                   width=message.width, height=message.height, emoji=message.emoji, **log_params)
+            return FileInfo(big_photo.file_unique_id or big_photo.file_id, big_photo.file_id,
+                            file_size=big_photo.file_size, width=big_photo.width, height=big_photo.height,
+                            mime_type="image/jpeg", thumbnail=thumb)
+        if not isinstance(message, (StickerMessage, VideoMessage, VideoNoteMessage, DocumentMessage,
+                                    AnimationMessage, AudioMessage)):
+            return None
+        key = message.file_unique_id or message.file_id
+        if isinstance(message, StickerMessage):
+            return FileInfo(key, message.file_id, file_size=message.file_size, mime_type="image/webp",
+                            width=message.width, height=message.height, emoji=message.emoji)
         elif isinstance(message, VideoMessage):
-            TelegramVideoMessage(file_id=message.file_id, file_size=message.file_size, mime_type=message.mime_type,
-                                 width=message.width, height=message.height, duration=message.duration,
-                                 thumbnail=message.thumbnail.file_id if message.thumbnail else None,
-                                 caption=message.caption, **log_params)
+            return FileInfo(key, message.file_id, file_size=message.file_size, mime_type=message.mime_type,
+                            width=message.width, height=message.height, duration=message.duration,
+                            thumbnail=message.thumbnail.file_id if message.thumbnail else None)
         elif isinstance(message, VideoNoteMessage):
-            TelegramVideoNoteMessage(file_id=message.file_id, file_size=message.file_size, mime_type="video/mp4",
-                                     width=message.length, height=message.length,
-                                     thumbnail=message.thumbnail.file_id if message.thumbnail else None,
-                                     duration=message.duration, **log_params)
-        elif isinstance(message, DocumentMessage):
-            TelegramDocumentMessage(file_id=message.file_id, file_size=message.file_size, mime_type=message.mime_type,
-                                    thumbnail=message.thumbnail.file_id if message.thumbnail else None,
-                                    caption=message.caption, file_name=message.file_name, **log_params)
-        elif isinstance(message, AudioMessage):
-            TelegramAudioMessage(file_id=message.file_id, file_size=message.file_size, mime_type=message.mime_type,
-                                 performer=message.performer, title=message.title, **log_params)
+            return FileInfo(key, message.file_id, file_size=message.file_size, mime_type="video/mp4",
+                            width=message.length, height=message.length, duration=message.duration,
+                            thumbnail=message.thumbnail.file_id if message.thumbnail else None)
+        elif isinstance(message, (DocumentMessage, AnimationMessage)):
+            return FileInfo(key, message.file_id, file_size=message.file_size, mime_type=message.mime_type,
+                            thumbnail=message.thumbnail.file_id if message.thumbnail else None,
+                            file_name=message.file_name)
+        return FileInfo(key, message.file_id, file_size=message.file_size, mime_type=message.mime_type,
+                        performer=message.performer, title=message.title)
+
+    def update_files(self, files: Iterable[FileInfo]) -> List[Callable[[], None]]:
+        """
+        Create or update whichever of the given files have changed since we last saved them, in as few queries as
+        possible. A file sent again usually comes with the same details, so this is mostly free.
+
+        :return: What to remember about the files once the transaction commits.
+        """
+        changed = self._changed(self._saved_files, files, 'file', tuple)
+        rows = {}  # type: Dict[str, TelegramFile]
+        for ids in chunks(changed):
+            rows.update((x.id, x) for x in select(x for x in TelegramFile if x.id in ids))
+        for info, _ in changed.values():
+            values = info._asdict()
+            del values['id']
+            if info.id in rows:
+                rows[info.id].set(**values)
+            else:
+                TelegramFile(id=info.id, **values)
+        return [functools.partial(self._saved_files.put, k, fingerprint) for k, (_, fingerprint) in changed.items()]
+
+    def update_chats(self, chats: Iterable[Chat]) -> List[Callable[[], None]]:
+        """
+        Create or update whichever of the given chats have changed since we last saved them, in as few queries as
+        possible.
+
+        :return: What to remember about the chats once the transaction commits.
+        """
+        changed = self._changed(self._saved_chats, chats, 'chat',
+                                lambda x: (x.type, x.title, x.all_members_are_administrators))
+        rows = {}  # type: Dict[int, TelegramChat]
+        for ids in chunks(changed):
+            rows.update((x.id, x) for x in select(x for x in TelegramChat if x.id in ids))
+        for chat, _ in changed.values():
+            if chat.id in rows:
+                rows[chat.id].set(title=chat.title, type=chat.type,
+                                  all_members_are_administrators=chat.all_members_are_administrators)
+            else:
+                TelegramChat(id=chat.id, type=chat.type, title=chat.title,
+                             all_members_are_administrators=chat.all_members_are_administrators)
+        return [functools.partial(self._saved_chats.put, k, fingerprint) for k, (_, fingerprint) in changed.items()]
+
+    def update_users(self, users: Iterable[User]) -> List[Callable[[], None]]:
+        """
+        Create or update whichever of the given users have changed since we last saved them, in as few queries as
+        possible.
+
+        :return: What to remember about the users once the transaction commits.
+        """
+        changed = self._changed(self._saved_users, users, 'user',
+                                lambda x: (x.username, x.first_name, x.last_name, x.language_code))
+        rows = {}  # type: Dict[int, TelegramUser]
+        for ids in chunks(changed):
+            rows.update((x.id, x) for x in select(x for x in TelegramUser if x.id in ids))
+        for user, _ in changed.values():
+            if user.id in rows:
+                rows[user.id].set(username=user.username, first_name=user.first_name,
+                                  last_name=user.last_name, language_code=user.language_code)
+            else:
+                TelegramUser(id=user.id, username=user.username, first_name=user.first_name,
+                             last_name=user.last_name, language_code=user.language_code)
+        return [functools.partial(self._saved_users.put, k, fingerprint) for k, (_, fingerprint) in changed.items()]
+
+    def update_memberships(self, memberships: Iterable[Tuple[str, int, int]]) -> List[Callable[[], None]]:
+        """
+        Apply membership changes, skipping any that are already true. Each chat's members are loaded the first time
+        they're needed and remembered, so in the usual case of someone talking in a chat they're known to be in, this
+        makes no queries at all.
+
+        :return: What to remember about the chats' members once the transaction commits.
+        """
+        working = {}  # type: Dict[int, typing.Set[int]]
+        copied = set()  # type: typing.Set[int]
+
+        def members(chat_id: int, modify: bool = False) -> typing.Set[int]:
+            if chat_id not in working:
+                cached = self._members.get(chat_id)
+                if cached is None:
+                    cached = set(select(u.id for c in TelegramChat for u in c.users if c.id == chat_id))
+                    copied.add(chat_id)
+                working[chat_id] = cached
+            if modify and chat_id not in copied:
+                # The cached set may be shared with whoever's reading it, so never change it in place.
+                working[chat_id] = set(working[chat_id])
+                copied.add(chat_id)
+            return working[chat_id]
+
+        for op, chat_id, other_id in memberships:
+            if op == 'add':
+                if other_id in members(chat_id):
+                    CACHE_LOOKUPS.labels('membership', 'hit').inc()
+                    continue
+                CACHE_LOOKUPS.labels('membership', 'miss').inc()
+                TelegramChat[chat_id].users.add(TelegramUser[other_id])
+                members(chat_id, modify=True).add(other_id)
+            elif op == 'remove':
+                if other_id not in members(chat_id):
+                    continue
+                TelegramChat[chat_id].users.remove(TelegramUser[other_id])
+                members(chat_id, modify=True).discard(other_id)
+            elif op == 'migrate':
+                if not members(chat_id):
+                    continue
+                old_chat = TelegramChat[chat_id]
+                TelegramChat[other_id].users.add(old_chat.users)
+                old_chat.users.clear()
+                members(other_id, modify=True).update(members(chat_id))
+                members(chat_id, modify=True).clear()
+        return [functools.partial(self._members.put, k, v) for k, v in working.items() if k in copied]
+
+    @staticmethod
+    def _changed(cache: LRUCache, things: Iterable[Any], kind: str,
+                 fingerprint: Callable[[Any], tuple]) -> Dict[Any, Tuple[Any, tuple]]:
+        # Compare what we'd save against what we last saved, so we only go to the database for what's new.
+        changed = {}
+        for thing in things:
+            current = fingerprint(thing)
+            if cache.get(thing.id) == current:
+                CACHE_LOOKUPS.labels(kind, 'hit').inc()
+            else:
+                CACHE_LOOKUPS.labels(kind, 'miss').inc()
+                changed[thing.id] = (thing, current)
+        return changed
 
-    def update_chat(self, chat: Chat):
-        try:
-            TelegramChat[chat.id].set(title=chat.title, type=chat.type,
-                                      all_members_are_administrators=chat.all_members_are_administrators)
-        except ObjectNotFound:
-            TelegramChat(id=chat.id, type=chat.type, title=chat.title,
-                         all_members_are_administrators=chat.all_members_are_administrators)
+    @timed_session('search')
+    def search(self, chat_id: int, terms: str, limit: int = 10, offset: int = 0) -> List[SearchHit]:
+        """
+        Find logged messages in a chat containing every word in `terms`, best matches first.
 
-    @db_session
-    def update_user(self, user: User):
-        try:
-            TelegramUser[user.id].set(username=user.username, first_name=user.first_name,
-                                      last_name=user.last_name, language_code=user.language_code)
-        except ObjectNotFound:
-            TelegramUser(id=user.id, username=user.username,
-                         first_name=user.first_name, last_name=user.last_name,
-                         language_code=user.language_code)
+        :return: Up to `limit` matches, skipping the first `offset`. Nothing if search isn't available.
+        """
+        if self.search_index is None:
+            return []
+        return self.search_index.search(chat_id, terms, limit, offset)
 
     @db_session
     def user_by_username(self, username: str) -> Optional[User]:
@@ -211,8 +707,13 @@ class TrackingModule(BaseModule):
         return user.to_user()
 
     def _json_from_entity(self, entity: TextEntity) -> Dict[str, Union[str, int]]:
+        try:
+            entity_type = entity.type.value
+        except ValueError:
+            # A kind of entity added to Telegram since we last looked, so keep whatever it's called.
+            entity_type = entity.raw_type
         ret = {
-            'type': entity.type.value,
+            'type': entity_type,
             'offset': entity.offset,
             'length': entity.length,
         }
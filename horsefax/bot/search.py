@@ -0,0 +1,200 @@
+"""
+Full-text search over logged messages, using whatever the database offers: FTS5 on SQLite, a GIN-indexed tsvector
+on Postgres and a FULLTEXT index on MySQL.
+
+The index lives in a table of its own, which Pony doesn't know about, holding each message's text along with enough
+to show it in results. It's only ever added to, so messages stay searchable after being archived.
+"""
+import collections
+import datetime
+import re
+from abc import ABCMeta, abstractmethod
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from dateutil.tz import tzutc
+
+from .db import db, chunks, parse_date
+
+SearchHit = collections.namedtuple('SearchHit', ['chat', 'id', 'sender', 'date', 'text'])
+
+# Words, as the databases' own tokenizers would roughly see them. Only used to build queries.
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+class SearchIndex(metaclass=ABCMeta):
+    """
+    A full-text index of message text. Use :func:`create_index` to get the right one for the database.
+    """
+    TABLE = 'SearchIndex'
+    # Rows per INSERT. Each takes five parameters, which keeps well under SQLite's limit of 999.
+    INSERT_BATCH = 100
+
+    def __init__(self) -> None:
+        self.table = db.provider.quote_name(self.TABLE)
+
+    @classmethod
+    def available(cls) -> bool:
+        """:return: Whether the database supports this kind of index. Must be called in a session."""
+        return True
+
+    @abstractmethod
+    def create(self) -> None:
+        """Create the index if it doesn't already exist. Must be called in a session."""
+        pass
+
+    def add(self, entries: Iterable[Tuple[int, int, int, datetime.datetime, str]]) -> None:
+        """
+        Index messages, given as (chat ID, message ID, sender ID, date, text). Must be called in a session; the
+        messages are only searchable once it commits.
+        """
+        for batch in chunks(entries, self.INSERT_BATCH):
+            # The same message twice in one statement would clash with itself, so only the last is kept.
+            batch = list(collections.OrderedDict(((x[0], x[1]), x) for x in batch).values())
+            params = {}  # type: Dict[str, Any]
+            for i, (chat, message, sender, date, text) in enumerate(batch):
+                params.update({f'c{i}': chat, f'm{i}': message, f's{i}': sender, f'd{i}': self._date_to_sql(date),
+                               f't{i}': text})
+            self._add_batch(len(batch), params)
+
+    def _add_batch(self, size: int, params: Dict[str, Any]) -> None:
+        # Each entry's values are in `params` as c0, m0, s0, d0, t0 and so on.
+        db.execute(self._insert_sql(', '.join(self._row_sql(i) for i in range(size))), params)
+
+    def search(self, chat_id: int, terms: str, limit: int, offset: int = 0) -> List[SearchHit]:
+        """
+        Find messages in a chat containing every word in `terms`, best matches first. Must be called in a session.
+        """
+        words = _WORD.findall(terms)
+        if not words:
+            return []
+        sql, params = self._search_sql(words)
+        params.update(chat=chat_id, limit=limit, offset=offset)
+        return [SearchHit(chat, message, sender, parse_date(date), text)
+                for chat, message, sender, date, text in db.select(sql, params)]
+
+    def _row_sql(self, i: int) -> str:
+        return f'($c{i}, $m{i}, $s{i}, $d{i}, $t{i})'
+
+    def _insert_sql(self, rows: str) -> str:
+        return f'INSERT INTO {self.table} (chat, id, sender, date, text) VALUES {rows}'
+
+    @abstractmethod
+    def _search_sql(self, words: List[str]) -> Tuple[str, Dict[str, Any]]:
+        pass
+
+    @staticmethod
+    def _date_to_sql(date: datetime.datetime) -> Any:
+        return date
+
+
+class SQLiteSearchIndex(SearchIndex):
+    """
+    FTS5 tables can't have a primary key, so each message's row in the index is found through a table of its own
+    that does, which is also where rows get their rowids from.
+    """
+    KEYS = 'SearchIndexKeys'
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.keys = db.provider.quote_name(self.KEYS)
+
+    @classmethod
+    def available(cls) -> bool:
+        # FTS5 is an optional part of SQLite, and some builds leave it out.
+        return bool(db.select("sqlite_compileoption_used('ENABLE_FTS5')")[0])
+
+    def create(self) -> None:
+        # Only the text is tokenized; the rest is just carried along.
+        db.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} USING fts5(text, chat UNINDEXED, id UNINDEXED, "
+                   f"sender UNINDEXED, date UNINDEXED, tokenize='unicode61')")
+        if db.provider.table_exists(db.get_connection(), self.KEYS):
+            return
+        db.execute(f'CREATE TABLE {self.keys} (entry INTEGER PRIMARY KEY, chat INTEGER NOT NULL, id INTEGER NOT NULL, '
+                   f'UNIQUE (chat, id))')
+        # An index from before there were keys may have a message in it more than once. Keep the latest of each.
+        db.execute(f'INSERT OR IGNORE INTO {self.keys} (entry, chat, id) '
+                   f'SELECT rowid, chat, id FROM {self.table} ORDER BY rowid DESC')
+        db.execute(f'DELETE FROM {self.table} WHERE rowid NOT IN (SELECT entry FROM {self.keys})')
+
+    def _add_batch(self, size: int, params: Dict[str, Any]) -> None:
+        # Replace whatever's there for each message, which is what the other databases' primary keys amount to.
+        keys = ' OR '.join(f'(chat = $c{i} AND id = $m{i})' for i in range(size))
+        db.execute(f'DELETE FROM {self.table} WHERE rowid IN (SELECT entry FROM {self.keys} WHERE {keys})', params)
+        db.execute(f'DELETE FROM {self.keys} WHERE {keys}', params)
+        db.execute(f"INSERT INTO {self.keys} (chat, id) VALUES {', '.join(f'($c{i}, $m{i})' for i in range(size))}",
+                   params)
+        rows = ', '.join(f'((SELECT entry FROM {self.keys} WHERE chat = $c{i} AND id = $m{i}), '
+                         f'$c{i}, $m{i}, $s{i}, $d{i}, $t{i})' for i in range(size))
+        db.execute(f'INSERT INTO {self.table} (rowid, chat, id, sender, date, text) VALUES {rows}', params)
+
+    def _search_sql(self, words: List[str]) -> Tuple[str, Dict[str, Any]]:
+        # Quoting each word stops anything in it being read as FTS5 syntax. Listing them means all must match.
+        query = ' '.join(f'"{x}"' for x in words)
+        return (f'SELECT chat, id, sender, date, text FROM {self.table} '
+                f'WHERE {self.table} MATCH $query AND chat = $chat ORDER BY rank LIMIT $limit OFFSET $offset',
+                {'query': query})
+
+    @staticmethod
+    def _date_to_sql(date: datetime.datetime) -> Any:
+        return date.isoformat()
+
+
+class PostgresSearchIndex(SearchIndex):
+    def create(self) -> None:
+        db.execute(f'CREATE TABLE IF NOT EXISTS {self.table} (chat BIGINT NOT NULL, id BIGINT NOT NULL, '
+                   f'sender BIGINT NOT NULL, date TIMESTAMP WITH TIME ZONE NOT NULL, text TEXT NOT NULL, '
+                   f'document TSVECTOR NOT NULL, PRIMARY KEY (chat, id))')
+        db.execute(f'CREATE INDEX IF NOT EXISTS {db.provider.quote_name("idx_searchindex__document")} '
+                   f'ON {self.table} USING GIN (document)')
+
+    def _row_sql(self, i: int) -> str:
+        return f"($c{i}, $m{i}, $s{i}, $d{i}, $t{i}, to_tsvector('simple', $t{i}))"
+
+    def _insert_sql(self, rows: str) -> str:
+        return f'INSERT INTO {self.table} (chat, id, sender, date, text, document) VALUES {rows} ON CONFLICT DO NOTHING'
+
+    def _search_sql(self, words: List[str]) -> Tuple[str, Dict[str, Any]]:
+        # The chat is part of the primary key, but the GIN index finds matches across every chat. Matching first
+        # and filtering after is still far cheaper than reading every message in a chat.
+        return (f"SELECT chat, id, sender, date, text FROM {self.table}, plainto_tsquery('simple', $query) q "
+                f"WHERE document @@ q AND chat = $chat ORDER BY ts_rank(document, q) DESC, date DESC "
+                f"LIMIT $limit OFFSET $offset",
+                {'query': ' '.join(words)})
+
+
+class MySQLSearchIndex(SearchIndex):
+    def create(self) -> None:
+        db.execute(f'CREATE TABLE IF NOT EXISTS {self.table} (chat BIGINT NOT NULL, id BIGINT NOT NULL, '
+                   f'sender BIGINT NOT NULL, date DATETIME NOT NULL, text TEXT NOT NULL, PRIMARY KEY (chat, id), '
+                   f'FULLTEXT (text)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4')
+
+    def _insert_sql(self, rows: str) -> str:
+        return f'INSERT IGNORE INTO {self.table} (chat, id, sender, date, text) VALUES {rows}'
+
+    def _search_sql(self, words: List[str]) -> Tuple[str, Dict[str, Any]]:
+        # Boolean mode decides what matches, with every word required; natural language mode ranks it.
+        return (f'SELECT chat, id, sender, date, text FROM {self.table} '
+                f'WHERE MATCH (text) AGAINST ($required IN BOOLEAN MODE) AND chat = $chat '
+                f'ORDER BY MATCH (text) AGAINST ($query) DESC, date DESC LIMIT $limit OFFSET $offset',
+                {'required': ' '.join(f'+"{x}"' for x in words), 'query': ' '.join(words)})
+
+    @staticmethod
+    def _date_to_sql(date: datetime.datetime) -> Any:
+        # DATETIME columns don't take a timezone.
+        return date.astimezone(tzutc()).replace(tzinfo=None)
+
+
+def create_index() -> Optional[SearchIndex]:
+    """
+    :return: A search index for the database, created if need be, or None if the database has no full-text search
+             we know how to use. Must be called in a session.
+    """
+    index_class = {'SQLite': SQLiteSearchIndex,
+                   'PostgreSQL': PostgresSearchIndex,
+                   'MySQL': MySQLSearchIndex}.get(db.provider.dialect)
+    if index_class is None or not index_class.available():
+        print(f"This {db.provider.dialect} database has no full-text search we can use; search is off.")
+        return None
+    index = index_class()
+    index.create()
+    return index
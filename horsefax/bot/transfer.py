@@ -0,0 +1,492 @@
+"""
+Move the tracking database in and out, for switching databases or offline analysis::
+
+    python -m horsefax.bot.transfer export tracking.ndjson.gz
+    python -m horsefax.bot.transfer import tracking.ndjson.gz archive/messages-2017-*.ndjson.gz
+    python -m horsefax.bot.transfer import-desktop --chat-id -1001234567890 result.json
+
+Exports are gzipped NDJSON, one record from :func:`to_record` per line: users, then chats, then who's in which chat,
+then files, then messages. Everything is read and written a batch at a time, so nothing needs to fit in memory.
+Monthly archive files are in the same format and can be imported the same way.
+
+Importing skips anything that's already there, so it's safe to run again if interrupted. Telegram Desktop's "Export
+chat history" JSON can be imported too, to fill in history from before the bot joined; it's read a message at a time
+as well. It has no Telegram file IDs, so media is logged with the path it was exported to.
+
+Messages from before files had a table of their own, with each file's details stored on the message, are converted
+as they're imported. Pony won't change the schema of an existing database, so to upgrade one, export it with the
+previous version and import the export and any archive files into a new database.
+
+The database is given by ``--db`` or DATABASE_URL. Run ``/rebuildstats`` afterwards if the chatstats module is used.
+"""
+import argparse
+import collections
+import datetime
+import gzip
+import json
+import sys
+import time
+from dateutil.tz import tzutc
+from pony.orm import *
+from typing import Any, Dict, IO, Iterable, Iterator, List, Optional, Tuple
+
+from horsefax.telegram.types import Chat
+
+from .db import db, timed_session, chunks, to_record, from_record, parse_date, prepare_db
+from .search import SearchIndex, create_index
+from .modules.tracking import TelegramUser, TelegramChat, TelegramFile, TelegramMessage, FileInfo, searchable_text
+# Users refer to ping groups, so they have to be mapped too.
+from .modules import groups
+import horsefax.bot.config as config
+
+MEMBERSHIP = 'membership'
+_MESSAGE_ENTITIES = {x.__name__ for x in db.entities.values() if issubclass(x, TelegramMessage)}
+# What file messages used to carry themselves, before files had a table of their own.
+_FILE_FIELDS = set(FileInfo._fields) - {'id'}
+
+
+def export_records(batch: int = 5000) -> Iterator[Dict[str, Any]]:
+    """
+    Read out everything tracked, as records. Each batch is read in its own session, paging through with a key rather
+    than an offset so that every batch costs the same.
+    """
+    yield from _keyset(TelegramUser, batch)
+    chat_ids = []  # type: List[int]
+    for record in _keyset(TelegramChat, batch):
+        chat_ids.append(record['id'])
+        yield record
+    for ids in chunks(chat_ids, batch):
+        with timed_session('transfer'):
+            members = select((c.id, u.id) for c in TelegramChat for u in c.users if c.id in ids)[:]
+        for chat_id, user_id in sorted(members):
+            yield {'entity': MEMBERSHIP, 'chat': chat_id, 'user': user_id}
+    yield from _keyset(TelegramFile, batch)
+    position = None
+    while True:
+        with timed_session('transfer'):
+            query = select(m for m in TelegramMessage)
+            if position is not None:
+                chat, message = position
+                query = query.filter(lambda m: m.chat.id > chat or (m.chat.id == chat and m.id > message))
+            records = [to_record(x) for x in query.order_by(TelegramMessage.chat, TelegramMessage.id)[:batch]]
+        yield from records
+        if len(records) < batch:
+            return
+        position = (records[-1]['chat'], records[-1]['id'])
+
+
+def _keyset(entity, batch: int) -> Iterator[Dict[str, Any]]:
+    last = None
+    while True:
+        with timed_session('transfer'):
+            query = select(x for x in entity)
+            if last is not None:
+                query = query.filter(lambda x: x.id > last)
+            records = [to_record(x) for x in query.order_by(entity.id)[:batch]]
+        yield from records
+        if len(records) < batch:
+            return
+        last = records[-1]['id']
+
+
+def import_records(records: Iterable[Dict[str, Any]], batch: int = 5000) -> collections.Counter:
+    """
+    Write records to the database, `batch` to a transaction, skipping anything already there. Users, chats
+    and files must come before anything that refers to them, as they do in an export.
+
+    :return: How many of each kind of record were written, and how many were skipped.
+    """
+    counts = collections.Counter()  # type: collections.Counter
+    with timed_session('transfer'):
+        index = create_index() if config.tracking_search else None
+    for records in chunks(records, batch):
+        with timed_session('transfer'):
+            _import_batch(records, index, counts)
+    return counts
+
+
+def _import_batch(records: List[Dict[str, Any]], index: Optional[SearchIndex], counts: collections.Counter) -> None:
+    users = {}  # type: Dict[int, Dict[str, Any]]
+    chats = {}  # type: Dict[int, Dict[str, Any]]
+    members = collections.defaultdict(set)  # type: Dict[int, set]
+    files = {}  # type: Dict[str, Dict[str, Any]]
+    messages = {}  # type: Dict[Tuple[int, int], Dict[str, Any]]
+    for record in records:
+        entity = record.get('entity')
+        if entity == TelegramUser.__name__:
+            users[record['id']] = record
+        elif entity == TelegramChat.__name__:
+            chats[record['id']] = record
+        elif entity == MEMBERSHIP:
+            members[record['chat']].add(record['user'])
+        elif entity == TelegramFile.__name__:
+            files[record['id']] = record
+        elif entity in _MESSAGE_ENTITIES:
+            if 'file_id' in record and 'file' not in record:
+                file, record = _split_file(record)
+                files.setdefault(file['id'], file)
+            messages[(record['chat'], record['id'])] = record
+        else:
+            counts['unknown'] += 1
+
+    created, skipped = _create_missing(TelegramUser, users)
+    counts[TelegramUser.__name__] += created
+    counts['skipped'] += skipped
+    created, skipped = _create_missing(TelegramChat, chats)
+    counts[TelegramChat.__name__] += created
+    counts['skipped'] += skipped
+    # Messages can refer to users we haven't been given, such as the senders of forwarded messages.
+    unknown = {}  # type: Dict[int, Dict[str, Any]]
+    for message in messages.values():
+        for user_id in (message['sender'], message.get('forward_from')):
+            if user_id is not None and user_id not in users:
+                unknown[user_id] = {'entity': TelegramUser.__name__, 'id': user_id, 'first_name': 'Unknown'}
+    counts[TelegramUser.__name__] += _create_missing(TelegramUser, unknown)[0]
+    created, skipped = _create_missing(TelegramFile, files)
+    counts[TelegramFile.__name__] += created
+    counts['skipped'] += skipped
+    # Archive files only refer to files, which are in the export. If that wasn't imported first, the best we can do is
+    # a file we know nothing about.
+    unknown_files = {}  # type: Dict[str, Dict[str, Any]]
+    for message in messages.values():
+        if message.get('file') is not None and message['file'] not in files:
+            unknown_files[message['file']] = {'entity': TelegramFile.__name__, 'id': message['file'],
+                                        'file_id': message['file']}
+    counts[TelegramFile.__name__] += _create_missing(TelegramFile, unknown_files)[0]
+
+    for chat_id, user_ids in members.items():
+        existing = set(select(u.id for c in TelegramChat for u in c.users if c.id == chat_id))
+        new = user_ids - existing
+        if new:
+            # Load them all at once, rather than one at a time as they're added.
+            select(u for u in TelegramUser if u.id in new)[:]
+            TelegramChat[chat_id].users.add([TelegramUser[x] for x in new])
+        counts[MEMBERSHIP] += len(new)
+        counts['skipped'] += len(user_ids) - len(new)
+
+    by_chat = collections.defaultdict(set)  # type: Dict[int, set]
+    for chat_id, message_id in messages:
+        by_chat[chat_id].add(message_id)
+    for reply in messages.values():
+        if reply.get('reply_to'):
+            by_chat[reply['reply_to'][0]].add(reply['reply_to'][1])
+    known_chats = set(chats)
+    for ids in chunks(by_chat):
+        known_chats.update(select(c.id for c in TelegramChat if c.id in ids))
+    existing = set()  # type: set
+    for chat_id, ids in by_chat.items():
+        if chat_id not in known_chats:
+            raise ValueError(f"Messages in chat {chat_id} need the chat to be imported first")
+        for batch in chunks(ids):
+            existing.update((chat_id, x) for x in select(m.id for m in TelegramMessage
+                                                         if m.chat.id == chat_id and m.id in batch))
+    indexed = []
+    # In order, so whatever is replied to is created before the reply.
+    for key in sorted(messages):
+        if key in existing:
+            counts['skipped'] += 1
+            continue
+        record = dict(messages[key])
+        reply_to = record.get('reply_to')
+        if reply_to and tuple(reply_to) not in existing:
+            # Whatever was replied to was never logged, or was archived.
+            record['reply_to'] = None
+        row = from_record(record)
+        existing.add(key)
+        counts[record['entity']] += 1
+        text = searchable_text(row)
+        if text:
+            indexed.append((key[0], key[1], record['sender'], parse_date(record['date']), text))
+    if index is not None and indexed:
+        index.add(indexed)
+
+
+def _create_missing(entity, records: Dict[Any, Dict[str, Any]]) -> Tuple[int, int]:
+    # :return: How many were created, and how many were already there.
+    existing = set()  # type: set
+    for ids in chunks(records):
+        existing.update(select(x.id for x in entity if x.id in ids))
+    for key, record in records.items():
+        if key not in existing:
+            from_record(record)
+    return len(records) - len(existing), len(existing)
+
+
+def _split_file(record: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Split a message record with its file's details in it, as they were stored before files had a table of their own,
+    into a file record and a message record referring to it. With no file_unique_id to go on, the file is identified
+    by its file_id.
+
+    :return: (file, message)
+    """
+    file = {x: record.get(x) for x in _FILE_FIELDS}
+    file.update(entity=TelegramFile.__name__, id=record['file_id'])
+    message = {k: v for k, v in record.items() if k not in _FILE_FIELDS}
+    message['file'] = file['id']
+    return file, message
+
+
+# Telegram Desktop's chat types, and how they map to the Bot API's.
+_DESKTOP_CHAT_TYPES = {'personal_chat': Chat.Type.PRIVATE,
+                       'bot_chat': Chat.Type.PRIVATE,
+                       'private_group': Chat.Type.GROUP,
+                       'private_supergroup': Chat.Type.SUPERGROUP,
+                       'public_supergroup': Chat.Type.SUPERGROUP,
+                       'private_channel': Chat.Type.CHANNEL,
+                       'public_channel': Chat.Type.CHANNEL}
+
+
+class _JSONReader:
+    """
+    Reads a JSON document from a file a piece at a time, so that its long arrays needn't be held in memory at once.
+    Objects and arrays can be walked through member by member, and anything else is decoded whole.
+    """
+    # Characters read at a time, at least.
+    SIZE = 1 << 16
+
+    def __init__(self, f: IO[str]) -> None:
+        self.f = f
+        self.buffer = ''
+        self.position = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        # Read more, keeping only what hasn't been used yet. Reading at least as much as is kept means a long value
+        # that takes several tries to decode is still only decoded a few times.
+        data = self.f.read(max(self.SIZE, len(self.buffer) - self.position))
+        self.buffer = self.buffer[self.position:] + data
+        self.position = 0
+        return bool(data)
+
+    def _peek(self) -> str:
+        # The next character that isn't whitespace, or '' at the end.
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in ' \t\r\n':
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                return ''
+
+    def _expect(self, char: str) -> None:
+        found = self._peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} in JSON, but found {found or 'the end'!r}")
+        self.position += 1
+
+    def value(self) -> Any:
+        """Decode the next value whole."""
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number could go on in what hasn't been read yet.
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.position = end
+            return value
+
+    def members(self) -> Iterator[str]:
+        """Walk through the next object, giving each key. Its value must be read before asking for the next one."""
+        self._expect('{')
+        if self._peek() == '}':
+            self.position += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(':')
+            yield key
+            if self._peek() == '}':
+                self.position += 1
+                return
+            self._expect(',')
+
+    def elements(self) -> Iterator[None]:
+        """Walk through the next array. Each element must be read before asking for the next one."""
+        self._expect('[')
+        if self._peek() == ']':
+            self.position += 1
+            return
+        while True:
+            yield None
+            if self._peek() == ']':
+                self.position += 1
+                return
+            self._expect(',')
+
+    def values(self) -> Iterator[Any]:
+        """Decode the elements of the next array one at a time."""
+        for _ in self.elements():
+            yield self.value()
+
+
+def desktop_records(f: IO[str], chat_id: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Turn a Telegram Desktop JSON export, of either one chat or everything, into records that can be imported. The file
+    is read as the records are used, a message at a time, so a large export needn't fit in memory.
+
+    :param chat_id: The Bot API ID of the chat, if exporting one chat. Otherwise it's worked out from the chat's type,
+                    which Telegram Desktop doesn't always get right.
+    """
+    yield from _desktop_object(_JSONReader(f), chat_id)
+
+
+def _desktop_object(reader: _JSONReader, chat_id: Optional[int]) -> Iterator[Dict[str, Any]]:
+    # Either one chat, or everything with lists of chats in it. Telegram Desktop writes each chat's name, type and ID
+    # before its messages.
+    chat = {}  # type: Dict[str, Any]
+    for key in reader.members():
+        if key == 'messages':
+            yield from _desktop_chat(chat, reader.values(), chat_id)
+        elif key in ('chats', 'left_chats'):
+            for inner in reader.members():
+                if inner == 'list':
+                    for _ in reader.elements():
+                        yield from _desktop_object(reader, None)
+                else:
+                    reader.value()
+        else:
+            chat[key] = reader.value()
+
+
+def _desktop_chat(export: Dict[str, Any], messages: Iterator[Dict[str, Any]],
+                  chat_id: Optional[int]) -> Iterator[Dict[str, Any]]:
+    chat_type = _DESKTOP_CHAT_TYPES.get(export.get('type'))
+    if chat_type is None:
+        print(f"Skipping {export.get('name')!r}, a {export.get('type')} chat")
+        # Still to be read past.
+        collections.deque(messages, maxlen=0)
+        return
+    if chat_id is None:
+        chat_id = export['id']
+        if chat_type == Chat.Type.GROUP:
+            chat_id = -chat_id
+        elif chat_type in (Chat.Type.SUPERGROUP, Chat.Type.CHANNEL):
+            chat_id = int(f'-100{chat_id}')
+    yield {'entity': TelegramChat.__name__, 'id': chat_id, 'type': chat_type.name, 'title': export.get('name'),
+           'all_members_are_administrators': False}
+    users = set()  # type: set
+    for message in messages:
+        if message.get('type') != 'message':
+            continue
+        sender = message.get('from_id')
+        if isinstance(sender, str):
+            if not sender.startswith('user'):
+                # Posted as a channel, which we have no user for.
+                continue
+            sender = int(sender[len('user'):])
+        if sender is None:
+            continue
+        if sender not in users:
+            users.add(sender)
+            yield {'entity': TelegramUser.__name__, 'id': sender,
+                   'first_name': message.get('from') or 'Deleted Account'}
+        record = _desktop_message(message)
+        if record is None:
+            continue
+        reply_to = message.get('reply_to_message_id')
+        record.update(id=message['id'], chat=chat_id, sender=sender, date=_desktop_date(message, 'date'),
+                      edit_date=_desktop_date(message, 'edited'), reply_to=[chat_id, reply_to] if reply_to else None)
+        if 'file_id' in record:
+            file, record = _split_file(record)
+            yield file
+        yield record
+
+
+def _desktop_date(message: Dict[str, Any], name: str) -> Optional[str]:
+    # Newer exports give the time as a timestamp; older ones only in the exporter's local time, which we take as UTC.
+    if f'{name}_unixtime' in message:
+        return datetime.datetime.fromtimestamp(int(message[f'{name}_unixtime']), tz=tzutc()).isoformat()
+    if name in message:
+        return parse_date(message[name]).isoformat()
+    return None
+
+
+def _desktop_message(message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    text = message.get('text', '')
+    if isinstance(text, list):
+        text = ''.join(x if isinstance(x, str) else x.get('text', '') for x in text)
+    media = message.get('media_type')
+    path = message.get('photo') or message.get('file')
+    if path is None and media is None:
+        if not text:
+            return None
+        return {'entity': 'TelegramTextMessage', 'text': text, 'entities': []}
+    record = {'file_id': f'desktop:{path or "missing"}', 'file_size': message.get('file_size'),
+              'mime_type': message.get('mime_type'), 'caption': text or None}
+    size = {'width': message.get('width', 0), 'height': message.get('height', 0)}
+    duration = message.get('duration_seconds', 0)
+    if 'photo' in message:
+        record.update(entity='TelegramPhotoMessage', mime_type='image/jpeg', **size)
+    elif media == 'sticker':
+        record.update(entity='TelegramStickerMessage', emoji=message.get('sticker_emoji'), caption=None, **size)
+    elif media == 'video_file':
+        record.update(entity='TelegramVideoMessage', duration=duration, **size)
+    elif media == 'video_message':
+        record.update(entity='TelegramVideoNoteMessage', duration=duration, mime_type='video/mp4', **size)
+    elif media in ('audio_file', 'voice_message'):
+        record.update(entity='TelegramAudioMessage', duration=duration, performer=message.get('performer'),
+                      title=message.get('title'))
+    else:
+        # Including animations, which tracking logs as documents too.
+        record.update(entity='TelegramDocumentMessage', file_name=(path or '').rsplit('/', 1)[-1] or None)
+    return record
+
+
+def write_records(records: Iterable[Dict[str, Any]], f: IO[str]) -> int:
+    count = 0
+    for record in records:
+        f.write(json.dumps(record, separators=(',', ':'), ensure_ascii=False) + '\n')
+        count += 1
+    return count
+
+
+def read_records(path: str) -> Iterator[Dict[str, Any]]:
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog='python -m horsefax.bot.transfer',
+                                     description="Export and import the tracking database.")
+    parser.add_argument('--db', help="Database URL, if not DATABASE_URL")
+    parser.add_argument('--batch', type=int, default=5000, help="Records per query or transaction")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    export_parser = commands.add_parser('export', help="Write everything tracked to a gzipped NDJSON file")
+    export_parser.add_argument('path')
+    import_parser = commands.add_parser('import', help="Read exports or archive files into the database")
+    import_parser.add_argument('paths', nargs='+')
+    desktop_parser = commands.add_parser('import-desktop', help="Read a Telegram Desktop JSON export")
+    desktop_parser.add_argument('--chat-id', type=int, help="The chat's Bot API ID, if exporting one chat")
+    desktop_parser.add_argument('path')
+    args = parser.parse_args(argv)
+
+    prepare_db(args.db)
+    start = time.time()
+    if args.command == 'export':
+        with gzip.open(args.path, 'wt', encoding='utf-8') as f:
+            count = write_records(export_records(args.batch), f)
+        print(f"Exported {count:,} records in {time.time() - start:.0f}s.")
+        return
+    if args.command == 'import':
+        counts = collections.Counter()  # type: collections.Counter
+        for path in args.paths:
+            counts.update(import_records(read_records(path), args.batch))
+    else:
+        with open(args.path, encoding='utf-8') as f:
+            counts = import_records(desktop_records(f, args.chat_id), args.batch)
+    print(f"Imported in {time.time() - start:.0f}s: "
+          f"{', '.join(f'{n:,} {kind}' for kind, n in sorted(counts.items())) or 'nothing'}.")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
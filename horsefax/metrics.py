@@ -0,0 +1,273 @@
+"""
+A small, thread-safe metrics registry, cheap enough to leave on all the time, and an HTTP endpoint exposing it in the
+Prometheus text format.
+
+Metrics are created once at import time::
+
+    REQUESTS = metrics.counter('horsefax_requests_total', "Requests sent.", ['endpoint'])
+    REQUESTS.labels('sendMessage').inc()
+
+Each metric keeps at most `max_series` distinct label combinations. Anything beyond that is counted under the label
+value ``other``, so a stray source of label values can't grow memory without bound.
+"""
+import bisect
+import http.server
+import math
+import socketserver
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Seconds. Covers everything from a dict lookup to a slow HTTP request.
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                   5, 10, 30)
+
+OTHER = 'other'
+
+
+class _CounterSeries:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class _HistogramSeries:
+    __slots__ = ('bounds', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, bounds: Sequence[float]) -> None:
+        self.bounds = bounds
+        # One count per bucket, plus one for anything above the largest bound.
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> '_Timer':
+        """Observe how long a ``with`` block takes."""
+        return _Timer(self)
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile by interpolating within the bucket it falls in. Only as precise as the buckets are.
+        """
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+        if total == 0:
+            return math.nan
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if i == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                return lower + (self.bounds[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+
+class _Timer:
+    __slots__ = ('series', 'start')
+
+    def __init__(self, series: _HistogramSeries) -> None:
+        self.series = series
+
+    def __enter__(self) -> '_Timer':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.series.observe(time.perf_counter() - self.start)
+
+
+class _Metric(metaclass=ABCMeta):
+    kind = None  # type: str
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str], max_series: int) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.max_series = max_series
+        self._series = {}  # type: Dict[Tuple[str, ...], object]
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """
+        :return: The series for the given label values, in the order the label names were given.
+        """
+        series = self._series.get(values)
+        if series is not None:
+            return series
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {values}")
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                if len(self._series) >= self.max_series:
+                    values = (OTHER,) * len(self.labelnames)
+                    series = self._series.get(values)
+                if series is None:
+                    series = self._series[values] = self._new_series()
+            return series
+
+    def series(self) -> List[Tuple[Tuple[str, ...], object]]:
+        with self._lock:
+            return sorted(self._series.items())
+
+    @abstractmethod
+    def _new_series(self):
+        pass
+
+    def _label_text(self, values: Tuple[str, ...], extra: str = '') -> str:
+        pairs = [f'{k}="{_escape(v)}"' for k, v in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_series(self) -> _CounterSeries:
+        return _CounterSeries()
+
+    def inc(self, amount: float = 1) -> None:
+        """Increment an unlabelled counter."""
+        self.labels().inc(amount)
+
+    def render(self) -> Iterator[str]:
+        for values, series in self.series():
+            yield f'{self.name}{self._label_text(values)} {series.value}'
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str], max_series: int,
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames, max_series)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_series(self) -> _HistogramSeries:
+        return _HistogramSeries(self.buckets)
+
+    def observe(self, value: float) -> None:
+        """Record a value in an unlabelled histogram."""
+        self.labels().observe(value)
+
+    def time(self) -> _Timer:
+        """Time a ``with`` block into an unlabelled histogram."""
+        return self.labels().time()
+
+    def render(self) -> Iterator[str]:
+        for values, series in self.series():
+            with series._lock:
+                counts = list(series.counts)
+                total, count = series.sum, series.count
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                cumulative += n
+                le = 'le="+Inf"' if bound == math.inf else f'le="{float(bound)!r}"'
+                yield f'{self.name}_bucket{self._label_text(values, le)} {cumulative}'
+            yield f'{self.name}_sum{self._label_text(values)} {total}'
+            yield f'{self.name}_count{self._label_text(values)} {count}'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics = {}  # type: Dict[str, _Metric]
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"Metric {metric.name} is already registered differently")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                max_series: int = 200) -> Counter:
+        return self._register(Counter(name, documentation, labelnames, max_series))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), max_series: int = 200,
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, max_series, buckets))
+
+    def metrics(self) -> List[_Metric]:
+        with self._lock:
+            return sorted(self._metrics.values(), key=lambda x: x.name)
+
+    def render(self) -> str:
+        """:return: Every metric, in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+counter = registry.counter
+histogram = registry.histogram
+
+
+class _MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, registry: Registry) -> None:
+        super().__init__(address, _MetricsRequestHandler)
+        self.registry = registry
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    server = None  # type: _MetricsServer
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int, host: str = '0.0.0.0', source: Optional[Registry] = None) -> _MetricsServer:
+    """
+    Expose metrics over HTTP on a background thread, for Prometheus to scrape.
+
+    :return: The server, which can be shut down with :meth:`shutdown`.
+    """
+    server = _MetricsServer((host, port), source or registry)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,16 +1,33 @@
-from typing import Type, Dict, Any, Optional
+import time
+from typing import Type, Dict, Any, Optional, List
 
+from horsefax import metrics, tracing
 from .connections import TelegramConnection
 from .events.mixin import EventSourceMixin
 from .types import *
 
 
+# Events we broadcast, and the kind of update each is derived from.
+_UPDATE_EVENTS = {
+    'message': 'message',
+    'edited_message': 'edited_message',
+}
+
+INGEST_LAG_SECONDS = metrics.histogram('horsefax_ingest_lag_seconds',
+                                       "How long after being sent messages start being handled.", ['kind'],
+                                       buckets=(0.5, 1, 2, 5, 10, 30, 60, 300, 900, 3600, 86400))
+
+
 class Telegram(EventSourceMixin):
-    def __init__(self, token: str, connection: Type[TelegramConnection]) -> None:
+    def __init__(self, token: str, connection: Type[TelegramConnection], **connection_args) -> None:
         self.token = token
-        self.connection = connection(token, self._handle_message)
+        self.connection = connection(token, self._handle_message, subscriptions=self.allowed_updates,
+                                     **connection_args)
         self.user = None  # type: Optional[User]
         super().__init__()
+        # Conversations wait for the next message from a particular person in a particular chat.
+        self._set_event_key("message", self._message_key)
+        self._set_event_key("edited_message", self._message_key)
 
     def connect(self):
         self.connection.connect()
@@ -20,12 +37,36 @@ class Telegram(EventSourceMixin):
     def connected(self):
         return self.connection.connected
 
+    def allowed_updates(self) -> Optional[List[str]]:
+        """
+        :return: The kinds of update that someone is listening for, or None if all of them are wanted.
+        """
+        events = self._registered_events()
+        if 'update' in events:
+            return None
+        wanted = sorted(_UPDATE_EVENTS[x] for x in events if x in _UPDATE_EVENTS)
+        # Telegram treats an empty list as asking for everything, which is the opposite of what we want.
+        return wanted or ['message']
+
+    @staticmethod
+    def _message_key(message: Message):
+        return message.chat.id, message.sender.id
+
     def _handle_message(self, update: Dict[str, Any]) -> None:
         self._broadcast_event("update", update)
         if 'message' in update:
-            self._broadcast_event("message", Message.from_update(update['message']))
+            # Telegram only gives us whole seconds, so lag under a second or so is noise.
+            INGEST_LAG_SECONDS.labels('message').observe(time.time() - update['message']['date'])
+            with tracing.span('decode'):
+                message = Message.from_update(update['message'])
+            with tracing.span('handle message', kind=type(message).__name__):
+                self._broadcast_event("message", message)
         elif 'edited_message' in update:
-            self._broadcast_event("edited_message", Message.from_update(update['edited_message']))
+            INGEST_LAG_SECONDS.labels('edited_message').observe(time.time() - update['edited_message']['edit_date'])
+            with tracing.span('decode'):
+                message = Message.from_update(update['edited_message'])
+            with tracing.span('handle edited_message', kind=type(message).__name__):
+                self._broadcast_event("edited_message", message)
 
     def _request_info(self):
         self.user = User(self.connection.send("getMe", {}))
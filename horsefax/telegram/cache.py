@@ -0,0 +1,137 @@
+import collections
+import math
+import threading
+from typing import Deque, Generic, Hashable, Iterator, Optional, TypeVar
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class LRUCache(Generic[K, V]):
+    """
+    A thread-safe mapping that holds at most `maxsize` entries, forgetting the least recently used ones first.
+    """
+    def __init__(self, maxsize: int = 1024) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()  # type: collections.OrderedDict
+        self._lock = threading.Lock()
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: K, value: V) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, key: K) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class BloomFilter:
+    """
+    A set that can only be added to and only answers membership questions, in a fixed and small amount of memory. It
+    never forgets anything that was added, but falsely claims to contain something else about `error_rate` of the time
+    once it holds `capacity` items.
+    """
+    def __init__(self, capacity: int, error_rate: float = 0.01) -> None:
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _indexes(self, key: Hashable) -> Iterator[int]:
+        # Double hashing: k indexes from two hashes are as good as k independent hashes.
+        first = hash(key)
+        second = hash((first, 0x5bd1e995)) | 1
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, key: Hashable) -> None:
+        for i in self._indexes(key):
+            self._bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+    def __contains__(self, key: Hashable) -> bool:
+        bits = self._bits
+        return all(bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(key))
+
+
+class _Generation:
+    __slots__ = ('filter', 'latest')
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        self.filter = BloomFilter(capacity, error_rate)
+        self.latest = -math.inf
+
+
+class RotatingBloomFilter:
+    """
+    A :class:`BloomFilter` over a moving window of recent items, each added with a timestamp. Once the newest
+    generation has `capacity` items a fresh one is started, and the oldest of `generations` is forgotten.
+
+    A negative answer is only meaningful for items timestamped at or after :attr:`since`. Before that, items may have
+    been forgotten or were never added. Until :meth:`start` is called nothing is covered.
+    """
+    def __init__(self, capacity: int, error_rate: float = 0.01, generations: int = 2) -> None:
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.since = math.inf
+        # Items timestamped before this may have been forgotten.
+        self._forgotten = -math.inf
+        self._generations = collections.deque(maxlen=generations)  # type: Deque[_Generation]
+        self._generations.append(_Generation(capacity, error_rate))
+        self._lock = threading.Lock()
+
+    def start(self, since: float) -> None:
+        """
+        Declare that everything timestamped at or after `since` has been added. If adding it all meant forgetting
+        some of it, coverage starts later.
+        """
+        with self._lock:
+            self.since = max(since, self._forgotten)
+
+    def covers(self, when: float) -> bool:
+        return when >= self.since
+
+    def add(self, key: Hashable, when: float) -> None:
+        with self._lock:
+            current = self._generations[-1]
+            if current.filter.count >= self.capacity:
+                if len(self._generations) == self._generations.maxlen:
+                    forgotten = self._generations[0]
+                    # Anything as old as the newest item we're forgetting could now be missing.
+                    self._forgotten = max(self._forgotten, forgotten.latest + 1e-6)
+                    self.since = max(self.since, self._forgotten)
+                current = _Generation(self.capacity, self.error_rate)
+                self._generations.append(current)
+            current.filter.add(key)
+            current.latest = max(current.latest, when)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return any(key in x.filter for x in self._generations)
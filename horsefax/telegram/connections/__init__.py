@@ -1,16 +1,29 @@
 from abc import ABC, abstractmethod, abstractproperty
-import requests
-from typing import Optional, Any, Callable
+from typing import Optional, Any, Callable, List
+
+from .checkpoint import OffsetStore
+from .dispatch import UpdateDispatcher
+from .transport import Transport
+from ..exceptions import RateLimitedError
 
 
 MessageHandler = Callable[[dict], None]
+SubscriptionProvider = Callable[[], Optional[List[str]]]
 
 
 class TelegramConnection(ABC):
-    def __init__(self, token: str, handler: MessageHandler) -> None:
+    # Whether Telegram pushes updates to us, in no particular order, rather than us polling for them.
+    PUSHED = False
+
+    def __init__(self, token: str, handler: MessageHandler, workers: int = 4,
+                 transport: Optional[Transport] = None, checkpoint: Optional[OffsetStore] = None,
+                 subscriptions: Optional[SubscriptionProvider] = None) -> None:
         self.token = token
         self.handler = handler
-        self.session = requests.Session()
+        self.subscriptions = subscriptions or (lambda: None)
+        self.transport = transport or Transport()
+        self.session = self.transport.session
+        self.dispatcher = UpdateDispatcher(handler, workers=workers, checkpoint=checkpoint, pushed=self.PUSHED)
 
     def send(self, endpoint: str, message: dict) -> dict:
         return self.request(endpoint, json=message)
@@ -25,6 +38,8 @@ class TelegramConnection(ABC):
         pass
 
     def request(self, endpoint: str, **kwargs) -> dict:
-        result = self.session.post(f"https://api.telegram.org/bot{self.token}/{endpoint}", **kwargs)
+        result = self.transport.post(f"https://api.telegram.org/bot{self.token}/{endpoint}", endpoint, **kwargs)
+        if result.status_code == 429:
+            raise RateLimitedError(result.json().get('parameters', {}).get('retry_after', 1))
         result.raise_for_status()
         return result.json()['result']
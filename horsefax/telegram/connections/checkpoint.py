@@ -0,0 +1,28 @@
+from typing import Iterable, Optional, Tuple
+
+
+class OffsetStore:
+    """
+    Remembers how far through the update stream we've got, so that a restart neither skips nor repeats updates.
+
+    This implementation remembers nothing; subclasses persist the offset somewhere durable.
+    """
+    def load(self) -> Tuple[int, Iterable[int]]:
+        """
+        :return: The update ID up to which everything has been handled, and the IDs of any later updates that have also
+                 been handled.
+        """
+        return 0, ()
+
+    def record(self, committed: int, handled: Optional[int] = None) -> None:
+        """
+        Note that everything up to `committed` has been handled, as has `handled` if given. This is called for every
+        update, so it should be cheap.
+        """
+        pass
+
+    def flush(self) -> None:
+        """
+        Persist anything recorded so far.
+        """
+        pass
@@ -0,0 +1,161 @@
+import collections
+import queue
+import threading
+import traceback
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from horsefax import tracing
+from .checkpoint import OffsetStore
+
+
+def _shard_key(update: Dict[str, Any]) -> int:
+    """
+    Works out which chat an update belongs to, so that updates for the same chat always land on the same worker.
+    Updates without a chat are keyed on their sender, and failing that on the update itself.
+    """
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get('chat')
+        if chat is None and isinstance(value.get('message'), dict):
+            chat = value['message'].get('chat')
+        if chat is not None:
+            return chat['id']
+        if 'from' in value:
+            return value['from']['id']
+    return update['update_id']
+
+
+class UpdateDispatcher:
+    """
+    Hands updates to a pool of worker threads, sharded by chat. Updates for any one chat are handled in the order they
+    were submitted; updates for different chats are handled in parallel.
+
+    :param handler: Called with each update.
+    :param workers: How many worker threads to run. With zero workers, updates are handled inline by :meth:`submit`.
+    :param backlog: How many updates each worker may have queued before :meth:`submit` blocks.
+    :param checkpoint: Where to record progress, and to resume from on :meth:`start`.
+    :param pushed: Updates are pushed to us, as by a webhook, rather than polled for. They can then arrive in any
+                   order, so an update from before everything handled so far may still be new.
+    """
+    # How many handled updates to remember when they're pushed to us, to recognise them if they're delivered again.
+    REMEMBER = 10000
+
+    def __init__(self, handler: Callable[[dict], None], workers: int = 4, backlog: int = 100,
+                 checkpoint: Optional[OffsetStore] = None, pushed: bool = False) -> None:
+        self.handler = handler
+        self.checkpoint = checkpoint or OffsetStore()
+        self.pushed = pushed
+        self._queues = [queue.Queue(maxsize=backlog) for _ in range(workers)]  # type: List[queue.Queue]
+        self._threads = []  # type: List[threading.Thread]
+        self._progress = threading.Condition()
+        self._pending = set()  # type: Set[int]
+        self._handled = set()  # type: Set[int]
+        self._recent = collections.OrderedDict()  # type: Dict[int, None]
+        self._highest = 0
+        self._stopped = False
+        self.committed = 0
+
+    def start(self) -> None:
+        if self._threads:
+            return
+        committed, handled = self.checkpoint.load()
+        with self._progress:
+            self._stopped = False
+            self.committed = self._highest = max(self.committed, committed)
+            self._handled.update(x for x in handled if x > self.committed)
+        for q in self._queues:
+            thread = threading.Thread(target=self._work, args=(q,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        """
+        Stop taking updates, and wait for those already taken to be handled. Anything submitted after this is left for
+        Telegram to deliver again. The checkpoint isn't flushed, as whatever handled the updates may have to save what
+        it gathered first.
+        """
+        with self._progress:
+            if self._stopped:
+                return
+            self._stopped = True
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, update: Dict[str, Any]) -> bool:
+        """
+        :return: Whether the update was taken, or had been already. Once stopped, nothing is.
+        """
+        update_id = update['update_id']
+        with self._progress:
+            if self._stopped:
+                return False
+            if self._seen(update_id):
+                # We've seen this one before, probably before a restart.
+                self._highest = max(self._highest, update_id)
+                self._advance()
+                self.checkpoint.record(self.committed)
+                return True
+            self._pending.add(update_id)
+            self._highest = max(self._highest, update_id)
+        if not self._queues:
+            self._handle(update)
+            return True
+        self._queues[hash(_shard_key(update)) % len(self._queues)].put((update, tracing.capture()))
+        return True
+
+    def _seen(self, update_id: int) -> bool:
+        if update_id in self._handled or update_id in self._pending:
+            return True
+        if self.pushed:
+            return update_id in self._recent
+        # Polling always asks for what comes after what we've committed, so anything before it is a repeat.
+        return update_id <= self.committed
+
+    def wait_for_progress(self, timeout: float) -> None:
+        """
+        Block until some outstanding update finishes, or `timeout` seconds pass.
+        """
+        with self._progress:
+            if self._pending:
+                self._progress.wait(timeout)
+
+    def _work(self, q: queue.Queue) -> None:
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            update, context = item
+            with tracing.resume(context, 'dispatch queue'):
+                self._handle(update)
+
+    def _handle(self, update: Dict[str, Any]) -> None:
+        try:
+            self.handler(update)
+        except Exception:
+            print(f"Something went terribly wrong processing update {update['update_id']}:")
+            traceback.print_exc()
+        finally:
+            with self._progress:
+                self._pending.discard(update['update_id'])
+                self._handled.add(update['update_id'])
+                if self.pushed:
+                    self._recent[update['update_id']] = None
+                    if len(self._recent) > self.REMEMBER:
+                        self._recent.popitem(last=False)
+                self._advance()
+                self.checkpoint.record(self.committed, update['update_id'])
+
+    def _advance(self) -> None:
+        # Only move past updates once everything before them has finished too.
+        committed = min(self._pending) - 1 if self._pending else self._highest
+        # Pushed updates can be older than what's already committed; that doesn't undo what's been handled since.
+        committed = max(committed, self.committed)
+        if committed != self.committed:
+            self.committed = committed
+            if self._handled:
+                self._handled = {x for x in self._handled if x > committed}
+        self._progress.notify_all()
@@ -1,16 +1,31 @@
 import requests
 import threading
 import time
-import traceback
 
+from horsefax import metrics, tracing
 from . import TelegramConnection, MessageHandler
+from .transport import Backoff
+from ..exceptions import CircuitOpenError, RateLimitedError
+
+POLL_SECONDS = metrics.histogram('horsefax_get_updates_seconds', "Round trip time of getUpdates requests.",
+                                 buckets=metrics.DEFAULT_BUCKETS + (60, 90))
+POLL_FAILURES = metrics.counter('horsefax_get_updates_failures_total', "getUpdates requests that failed.")
+POLL_UPDATES = metrics.counter('horsefax_get_updates_received_total', "Updates received by long polling.")
 
 
 class LongPollingConnection(TelegramConnection):
-    def __init__(self, token: str, handler: MessageHandler) -> None:
-        super().__init__(token, handler)
+    MIN_LIMIT = 10
+    MAX_LIMIT = 100
+
+    def __init__(self, token: str, handler: MessageHandler, poll_timeout: int = 60, **kwargs) -> None:
+        super().__init__(token, handler, **kwargs)
         self._connected = False
-        self.latest_update = 0
+        self._last_submitted = 0
+        self.poll_timeout = poll_timeout
+        self.limit = self.MIN_LIMIT
+        self._batch_size = 0.0
+        self._backlogged = False
+        self.backoff = Backoff(base=1, cap=60)
         self.thread = threading.Thread(target=self.run)
 
     def connect(self):
@@ -20,26 +35,74 @@ class LongPollingConnection(TelegramConnection):
     def connected(self) -> bool:
         return self._connected
 
+    @property
+    def latest_update(self) -> int:
+        """The newest update ID for which it and every earlier update have finished being handled."""
+        return self.dispatcher.committed
+
     def disconnect(self):
         self._connected = False
+        self.dispatcher.stop()
+
+    def _poll_params(self):
+        params = {"offset": self.latest_update + 1,
+                  "limit": self.limit,
+                  # If the last batch was full there's more waiting, so there's no point asking Telegram to hold on.
+                  "timeout": 0 if self._backlogged else self.poll_timeout}
+        allowed_updates = self.subscriptions()
+        if allowed_updates is not None:
+            params["allowed_updates"] = allowed_updates
+        return params
+
+    def _observe(self, count: int) -> None:
+        # Keep batches a comfortable margin above what we usually get, so bursts are picked up in one round trip.
+        self._backlogged = count >= self.limit
+        self._batch_size = 0.8 * self._batch_size + 0.2 * count
+        if self._backlogged:
+            self.limit = min(self.MAX_LIMIT, self.limit * 2)
+        else:
+            self.limit = int(min(self.MAX_LIMIT, max(self.MIN_LIMIT, self._batch_size * 2)))
 
     def run(self):
         self._connected = True
+        self.dispatcher.start()
+        self._last_submitted = self.latest_update
+        failures = 0
         while self.connected:
+            start = time.perf_counter()
             try:
-                updates = self.request("getUpdates", json={"offset": self.latest_update + 1, "timeout": 60}, timeout=70)
-            except requests.RequestException as e:
+                # Telegram keeps returning anything we haven't confirmed, so in-flight updates will come back here
+                # until they finish. Those are skipped below rather than dispatched twice.
+                updates = self.request("getUpdates", json=self._poll_params(),
+                                       timeout=(self.transport.default_timeout[0], self.poll_timeout + 10))
+            except RateLimitedError as e:
+                # Telegram has told us exactly how long to wait, so there's no need to guess.
+                POLL_FAILURES.inc()
+                print(e)
+                time.sleep(e.retry_after)
+                continue
+            except (requests.RequestException, CircuitOpenError) as e:
+                POLL_FAILURES.inc()
                 print(e)
-                time.sleep(10)
+                time.sleep(self.backoff.delay(failures))
+                failures += 1
                 continue
+            end = time.perf_counter()
+            POLL_SECONDS.observe(end - start)
+            POLL_UPDATES.inc(len(updates))
+            failures = 0
+            self._observe(len(updates))
             if not updates:
                 continue
             updates = sorted(updates, key=lambda x: x['update_id'])
-            for update in updates:
-                # doing this per message ensures that we don't drop messages if we crash out.
-                self.latest_update = update['update_id']
-                try:
-                    self.handler(update)
-                except Exception as e:
-                    print(f"Something went terribly wrong processing update {update['update_id']}:")
-                    traceback.print_exc()
+            fresh = [x for x in updates if x['update_id'] > self._last_submitted]
+            if not fresh:
+                # Everything we got back is still being handled; wait for some of it to finish rather than spinning.
+                self.dispatcher.wait_for_progress(1)
+                continue
+            for update in fresh:
+                self._last_submitted = update['update_id']
+                with tracing.start_trace('update', update_id=update['update_id']):
+                    tracing.record_span('getUpdates', start, end, batch=len(updates))
+                    self.dispatcher.submit(update)
+        self.dispatcher.stop()
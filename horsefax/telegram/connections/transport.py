@@ -0,0 +1,116 @@
+import random
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ..exceptions import CircuitOpenError
+
+
+class Backoff:
+    """
+    Exponential backoff with full jitter: the nth retry waits somewhere between zero and `base * 2**n` seconds, capped
+    at `cap`.
+    """
+    def __init__(self, base: float = 0.5, cap: float = 30) -> None:
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests after `threshold` consecutive failures. Once `cooldown` seconds have passed a single request
+    is let through to test the water; if it succeeds, requests flow normally again.
+    """
+    def __init__(self, threshold: int = 5, cooldown: float = 30) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None  # type: Optional[float]
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def before(self) -> None:
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self._trial or time.monotonic() - self.opened_at < self.cooldown:
+                raise CircuitOpenError()
+            self._trial = True
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+# Requests that can safely be sent twice. Anything else is only retried if we know it never reached Telegram.
+IDEMPOTENT_ENDPOINTS = frozenset(['getUpdates', 'getMe', 'getChat', 'getChatMember', 'getChatAdministrators',
+                                  'getChatMembersCount', 'getFile', 'getUserProfilePhotos', 'getWebhookInfo',
+                                  'setWebhook', 'deleteWebhook'])
+
+
+class Transport:
+    """
+    The HTTP layer underneath :class:`.TelegramConnection`.
+
+    :param pool_size: How many connections to keep open to Telegram.
+    :param keep_alive: Whether to reuse connections between requests.
+    :param connect_timeout: How long to wait to establish a connection.
+    :param read_timeout: How long to wait for a response, unless overridden in `timeouts`.
+    :param timeouts: Per-endpoint `(connect, read)` timeouts.
+    :param retries: How many times to retry a failed request.
+    :param backoff: How long to wait between retries.
+    :param breaker: Used to fail fast while Telegram is unreachable.
+    """
+    def __init__(self, pool_size: int = 10, keep_alive: bool = True, connect_timeout: float = 5,
+                 read_timeout: float = 30, timeouts: Optional[Dict[str, Tuple[float, float]]] = None,
+                 retries: int = 3, backoff: Optional[Backoff] = None,
+                 breaker: Optional[CircuitBreaker] = None) -> None:
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+        self.default_timeout = (connect_timeout, read_timeout)
+        self.timeouts = timeouts or {}
+        self.retries = retries
+        self.backoff = backoff or Backoff()
+        self.breaker = breaker or CircuitBreaker()
+
+    def post(self, url: str, endpoint: str, timeout=None, **kwargs) -> requests.Response:
+        if timeout is None:
+            timeout = self.timeouts.get(endpoint, self.default_timeout)
+        idempotent = endpoint in IDEMPOTENT_ENDPOINTS
+        attempt = 0
+        while True:
+            self.breaker.before()
+            try:
+                response = self.session.post(url, timeout=timeout, **kwargs)
+            except requests.RequestException as e:
+                self.breaker.failure()
+                # A connect timeout means the request never left; anything else might have been acted on.
+                if attempt >= self.retries or not (idempotent or isinstance(e, requests.ConnectTimeout)):
+                    raise
+            else:
+                if response.status_code < 500:
+                    self.breaker.success()
+                    return response
+                self.breaker.failure()
+                if attempt >= self.retries or not idempotent:
+                    return response
+            time.sleep(self.backoff.delay(attempt))
+            attempt += 1
@@ -0,0 +1,128 @@
+import hmac
+import http.server
+import json
+import secrets
+import socketserver
+import threading
+from typing import Optional
+
+from horsefax import tracing
+from . import TelegramConnection, MessageHandler
+
+
+class _WebhookServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, connection: 'WebhookConnection') -> None:
+        super().__init__(address, _WebhookRequestHandler)
+        self.connection = connection
+
+
+class _WebhookRequestHandler(http.server.BaseHTTPRequestHandler):
+    server = None  # type: _WebhookServer
+    # Far bigger than any update Telegram sends.
+    MAX_BODY = 1 << 20
+
+    def do_POST(self):
+        connection = self.server.connection
+        if self.path != connection.path:
+            self._respond(404)
+            return
+        if not connection.check_secret(self.headers.get('X-Telegram-Bot-Api-Secret-Token')):
+            self._respond(403)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self._respond(400)
+            return
+        if length > self.MAX_BODY:
+            self._respond(413)
+            return
+        try:
+            update = json.loads(self.rfile.read(max(length, 0)).decode('utf-8'))
+        except ValueError:
+            self._respond(400)
+            return
+        if not isinstance(update, dict) or 'update_id' not in update:
+            self._respond(400)
+            return
+        # Telegram redelivers anything we don't acknowledge, so we acknowledge once the update is queued, and not if
+        # we're shutting down and it can't be.
+        with tracing.start_trace('update', update_id=update['update_id']):
+            taken = connection.dispatcher.submit(update)
+        self._respond(200 if taken else 503)
+
+    def _respond(self, code: int) -> None:
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookConnection(TelegramConnection):
+    """
+    Receives updates from Telegram as HTTP POSTs to an embedded web server, instead of long polling for them.
+
+    :param url: The public HTTPS URL Telegram should deliver updates to. If omitted, the webhook is assumed to have
+                been registered some other way and only the server is started.
+    :param host: The address to bind the embedded server to.
+    :param port: The port to bind the embedded server to.
+    :param secret: The secret token Telegram must present with each update. Anyone could post updates otherwise, so
+                   if it's omitted one is made up to register the webhook with, and if there's no `url` to register
+                   it's an error.
+    :param path: The path updates are POSTed to.
+    """
+    PUSHED = True
+
+    def __init__(self, token: str, handler: MessageHandler, url: Optional[str] = None, host: str = '0.0.0.0',
+                 port: int = 8443, secret: Optional[str] = None, path: str = '/', **kwargs) -> None:
+        super().__init__(token, handler, **kwargs)
+        if secret is None:
+            if url is None:
+                raise ValueError("A webhook registered some other way needs its secret token to be given")
+            secret = secrets.token_urlsafe(32)
+        self.url = url
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self.path = path
+        self.server = None  # type: Optional[_WebhookServer]
+        self.thread = None  # type: Optional[threading.Thread]
+
+    def connect(self):
+        self.dispatcher.start()
+        self.server = _WebhookServer((self.host, self.port), self)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        if self.url is not None:
+            params = {"url": self.url}
+            allowed_updates = self.subscriptions()
+            if allowed_updates is not None:
+                params["allowed_updates"] = allowed_updates
+            params["secret_token"] = self.secret
+            self.send("setWebhook", params)
+
+    @property
+    def connected(self) -> bool:
+        return self.server is not None
+
+    @property
+    def address(self):
+        """The address the embedded server is actually listening on."""
+        return self.server.server_address
+
+    def disconnect(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+        self.dispatcher.stop()
+
+    def check_secret(self, token: Optional[str]) -> bool:
+        if token is None:
+            return False
+        return hmac.compare_digest(token.encode('utf-8'), self.secret.encode('utf-8'))
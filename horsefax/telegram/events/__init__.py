@@ -1,15 +1,44 @@
 from abc import ABCMeta, abstractmethod
+from enum import Enum
+
+
+class ExecutionMode(Enum):
+    """
+    Where a handler runs when its event is broadcast.
+    """
+    #: On the broadcasting thread, before the broadcast moves on to the next handler.
+    INLINE = 'inline'
+    #: On a shared thread pool; the broadcast doesn't wait for it.
+    THREAD = 'thread'
+    #: On a shared process pool; the broadcast doesn't wait for it. The handler and the event's arguments must be
+    #: picklable.
+    PROCESS = 'process'
+
+
+class QueuePolicy(Enum):
+    """
+    What a bounded event queue does with a new event when it is full.
+    """
+    #: Make the broadcaster wait until there's room.
+    BLOCK = 'block'
+    #: Throw away the oldest queued event to make room.
+    DROP_OLDEST = 'drop_oldest'
+    #: Write the overflow to a temporary file, and read it back in order as room frees up.
+    SPILL = 'spill'
 
 
 class BaseEventHandler(metaclass=ABCMeta):
     @abstractmethod
-    def register_handler(self, event, handler):
+    def register_handler(self, event, handler, mode=ExecutionMode.INLINE, timeout=None):
         """
         Register a handler for an event.
 
         :param event: The event to be handled. This can be any object, as long as it's hashable.
         :param handler: A callback function to be called when the event is triggered. The arguments are dependent
                         on the event.
+        :param mode: Where the handler should run.
+        :param timeout: How many seconds the handler may take. An offloaded handler that hasn't started by then is
+                        cancelled, and one that hasn't finished is abandoned. Either way it counts as timed out.
         :return: A handle that can be passed to :meth:`unregister_handler` to remove the registration.
         """
         pass
@@ -24,23 +53,49 @@ class BaseEventHandler(metaclass=ABCMeta):
         pass
 
     @abstractmethod
-    def wait_for_event(self, event, timeout=10):
+    def wait_for_event(self, event, timeout=10, key=None):
         """
         A blocking wait for an event to be fired.
 
         :param event: The event to wait on.
         :param timeout: How long to wait before raising :exc:`.TimeoutError`
+        :param key: If given, only wait for an occurrence with this key. See :meth:`expect_event`.
         :return: The arguments that were passed to :meth:`broadcast_event`.
         """
         pass
 
     @abstractmethod
-    def queue_events(self, event):
+    def set_event_key(self, event, key):
+        """
+        Set how to work out the key of each occurrence of an event, for the benefit of :meth:`expect_event`.
+
+        :param event: The event.
+        :param key: Called with the event's arguments; returns a hashable key.
+        """
+        pass
+
+    @abstractmethod
+    def expect_event(self, event, key, timeout=10):
+        """
+        Wait, without blocking, for an occurrence of an event with a particular key. However many expectations are
+        outstanding, matching them costs one lookup per broadcast.
+
+        :param event: The event to wait on. It must have had a key function set with :meth:`set_event_key`.
+        :param key: The key to wait for.
+        :param timeout: How long to wait before the result becomes :exc:`.TimeoutError`.
+        :return: A :class:`concurrent.futures.Future` resolving to the event's argument.
+        """
+        pass
+
+    @abstractmethod
+    def queue_events(self, event, maxsize=0, policy=QueuePolicy.BLOCK):
         """
         Returns a :class:`BaseEventQueue` from which events can be read as they arrive, even if the arrive faster
         than they are removed.
 
         :param event: The events to add to the queue.
+        :param maxsize: How many events may be held in memory. Zero means no limit.
+        :param policy: What to do when `maxsize` is reached.
         :return: An event queue.
         :rtype: BaseEventQueue
         """
@@ -62,8 +117,8 @@ class BaseEventQueue(metaclass=ABCMeta):
     @abstractmethod
     def close(self):
         """
-        Stop adding events to this queue. It is illegal to call :meth:`get` or iterate over this queue after calling
-        :meth:`close`.
+        Stop adding events to this queue. Events already queued can still be read, after which iteration stops and
+        :meth:`get` raises :exc:`.TimeoutError` immediately.
         """
         pass
 
@@ -74,9 +129,20 @@ class BaseEventQueue(metaclass=ABCMeta):
         """
         pass
 
+    @abstractmethod
+    def get_many(self, max_items, max_wait):
+        """
+        Get a batch of events. Blocks until `max_items` events are available or `max_wait` seconds have passed,
+        whichever comes first.
+
+        :return: A list of between zero and `max_items` events.
+        """
+        pass
+
     @abstractmethod
     def __iter__(self):
         """
-        Iterate over events in the queue. Blocks if no more items are available.
+        Iterate over events in the queue. Blocks if no more items are available, and stops once the queue is closed
+        and empty.
         """
         pass
@@ -1,4 +1,5 @@
-from .threaded import ThreadedEventHandler
+from . import ExecutionMode, QueuePolicy
+from .threaded import ThreadedEventHandler, _BlockingEventWait, _QueuedEventWait
 
 
 class EventSourceMixin(object):
@@ -6,17 +7,19 @@ class EventSourceMixin(object):
     A convenient mixin to save on repeatedly exposing generic event handler functionality.
     """
     def __init__(self):
-        self.__handler = ThreadedEventHandler()
+        self.__handler = ThreadedEventHandler(name=type(self).__name__)
 
-    def register_handler(self, event, handler):
+    def register_handler(self, event, handler, mode=ExecutionMode.INLINE, timeout=None):
         """
         Registers a handler to be triggered by an event
 
         :param event: The event to handle
         :param handler: The handler callable.
+        :param mode: Where the handler should run.
+        :param timeout: How long the handler may take, in seconds.
         :return: A handle that can be used to unregister the handler.
         """
-        return self.__handler.register_handler(event, handler)
+        return self.__handler.register_handler(event, handler, mode=mode, timeout=timeout)
 
     def unregister_handler(self, handle):
         """
@@ -26,15 +29,53 @@ class EventSourceMixin(object):
         """
         self.__handler.unregister_handler(handle)
 
-    def wait_for_event(self, event, timeout=10):
+    def wait_for_event(self, event, timeout=10, key=None):
         """
         Block waiting for the given event. Returns the event params.
 
         :param event: The event to handle.
         :return: The event params.
         :param timeout: The maximum time to wait before raising :exc:`.TimeoutError`.
+        :param key: If given, only wait for an occurrence of the event with this key.
         """
-        return self.__handler.wait_for_event(event, timeout=timeout)
+        if key is not None:
+            return self.__handler.wait_for_event(event, timeout=timeout, key=key)
+        # Registered through our own register_handler, so that subclasses see the handler like any other.
+        return _BlockingEventWait(self, event).wait(timeout=timeout)
+
+    def expect_event(self, event, key, timeout=10):
+        """
+        Wait in the background for an occurrence of the given event with the given key.
+
+        :param event: The event to wait for.
+        :param key: The key to wait for.
+        :param timeout: The maximum time to wait before the result becomes :exc:`.TimeoutError`.
+        :return: A :class:`concurrent.futures.Future` resolving to the event params.
+        """
+        return self.__handler.expect_event(event, key, timeout=timeout)
+
+    def _set_event_key(self, event, key):
+        self.__handler.set_event_key(event, key)
+
+    def queue_events(self, event, maxsize=0, policy=QueuePolicy.BLOCK):
+        """
+        Queue up occurrences of the given event to be read at leisure.
+
+        :param event: The event to queue.
+        :param maxsize: How many events to hold in memory. Zero means no limit.
+        :param policy: What to do when `maxsize` is reached.
+        :return: A :class:`.BaseEventQueue`.
+        """
+        return _QueuedEventWait(self, event, maxsize=maxsize, policy=policy)
 
     def _broadcast_event(self, event, *args):
         return self.__handler.broadcast_event(event, *args)
+
+    def handler_stats(self):
+        """
+        :return: A list of :class:`.HandlerStats`, one per registered handler.
+        """
+        return self.__handler.handler_stats()
+
+    def _registered_events(self):
+        return self.__handler.registered_events()
@@ -1,42 +1,237 @@
+import collections
+import io
+import pickle
+import tempfile
 import threading
-import queue
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 
-from . import BaseEventHandler, BaseEventQueue
+from horsefax import metrics, tracing
+from . import BaseEventHandler, BaseEventQueue, ExecutionMode, QueuePolicy
+from .timer import timer
+
+EVENT_SECONDS = metrics.histogram('horsefax_event_seconds', "Time spent broadcasting each event to its handlers.",
+                                  ['source', 'event'])
+HANDLER_TIMEOUTS = metrics.counter('horsefax_handler_timeouts_total',
+                                   "Handlers that ran past their timeout: cancelled before they started, abandoned "
+                                   "while still running on a pool, or inline and overran.", ['event', 'outcome'])
+
+HandlerStats = collections.namedtuple('HandlerStats', ['handle', 'event', 'mode', 'calls', 'failures', 'timeouts'])
+
+_executors = {}
+_executor_lock = threading.Lock()
+# Workers in each pool. None is as many as there are CPUs.
+_pool_sizes = {ExecutionMode.THREAD: 8, ExecutionMode.PROCESS: None}
+
+
+def set_pool_size(mode, workers):
+    """
+    Set how many offloaded handlers can run at once in `mode`'s pool. An abandoned handler keeps its worker until it
+    finishes, so allow for some. This must be called before any handler runs in that pool.
+    """
+    if mode not in _pool_sizes:
+        raise ValueError(f"{mode.value.capitalize()} handlers don't run on a pool")
+    with _executor_lock:
+        if mode in _executors:
+            raise ValueError(f"The {mode.value} pool has already started")
+        _pool_sizes[mode] = workers
+
+
+def _executor(mode):
+    with _executor_lock:
+        if mode not in _executors:
+            if mode is ExecutionMode.THREAD:
+                _executors[mode] = ThreadPoolExecutor(max_workers=_pool_sizes[mode])
+            else:
+                _executors[mode] = ProcessPoolExecutor(max_workers=_pool_sizes[mode])
+        return _executors[mode]
+
+
+def _event_label(event):
+    return event if isinstance(event, str) else metrics.OTHER
+
+
+def _run_traced(context, handler, *args):
+    with tracing.resume(context, 'offload queue'):
+        return handler(*args)
+
+
+class _Registration(object):
+    __slots__ = ('handle', 'event', 'handler', 'mode', 'timeout', 'active', 'calls', 'failures', 'timeouts', '_lock')
+
+    def __init__(self, handle, event, handler, mode, timeout):
+        self.handle = handle
+        self.event = event
+        self.handler = handler
+        self.mode = mode
+        self.timeout = timeout
+        self.active = True
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def run(self, args):
+        with self._lock:
+            self.calls += 1
+        if self.mode is ExecutionMode.INLINE:
+            start = time.monotonic()
+            try:
+                self.handler(*args)
+            except Exception:
+                self._failed()
+            if self.timeout is not None and time.monotonic() - start > self.timeout:
+                # There's no stopping an inline handler, but it should still show up as having overrun.
+                self._timed_out('overran')
+            return
+        if self.mode is ExecutionMode.THREAD:
+            # Traces can follow a handler to another thread, but not to another process.
+            context = tracing.capture()
+            future = _executor(self.mode).submit(_run_traced, context, self.handler, *args)
+        else:
+            context = None
+            future = _executor(self.mode).submit(self.handler, *args)
+        if self.timeout is not None:
+            deadline = timer.schedule(self.timeout, lambda: self._expire(future))
+            future.add_done_callback(lambda x: timer.cancel(deadline))
+        if context is not None:
+            future.add_done_callback(lambda x: context.release())
+        future.add_done_callback(self._finished)
+
+    def _finished(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            with self._lock:
+                self.failures += 1
+            print(f"Handler for {self.event!r} failed:")
+            traceback.print_exception(type(future.exception()), future.exception(), future.exception().__traceback__)
+
+    def _expire(self, future):
+        if future.cancel():
+            self._timed_out('cancelled')
+        elif not future.done():
+            print(f"Handler for {self.event!r} is taking longer than {self.timeout}s; abandoning it.")
+            self._timed_out('abandoned')
+
+    def _failed(self):
+        with self._lock:
+            self.failures += 1
+        print(f"Handler for {self.event!r} failed:")
+        traceback.print_exc()
+
+    def _timed_out(self, outcome):
+        with self._lock:
+            self.timeouts += 1
+        HANDLER_TIMEOUTS.labels(_event_label(self.event), outcome).inc()
+
+    def stats(self):
+        return HandlerStats(self.handle, self.event, self.mode, self.calls, self.failures, self.timeouts)
 
 
 class ThreadedEventHandler(BaseEventHandler):
     """
     A threaded implementation of :class:`.BaseEventHandler`.
+
+    Each event's handlers are kept in a tuple that is replaced, never modified, when handlers come and go. Broadcasts
+    can therefore iterate over whatever tuple is current without taking a lock; a handler unregistered partway through
+    a broadcast is skipped if it hasn't been reached yet.
+
+    A handler that raises is reported and counted, and doesn't stop the rest from running.
+
+    :param name: What to call this handler's events in metrics.
     """
-    def __init__(self):
+    def __init__(self, name='events'):
+        self.name = name
         self._handlers = {}
         self._handle_map = {}
         self._counter = 0
-        self._handler_lock = threading.RLock()
+        self._handler_lock = threading.Lock()
+        self._event_keys = {}
+        self._waiters = {}
+        self._waiter_lock = threading.Lock()
 
-    def register_handler(self, event, handler):
+    def register_handler(self, event, handler, mode=ExecutionMode.INLINE, timeout=None):
         with self._handler_lock:
             self._counter += 1
-            self._handlers.setdefault(event, {})[self._counter] = handler
-            self._handle_map[self._counter] = event
+            registration = _Registration(self._counter, event, handler, mode, timeout)
+            self._handlers[event] = self._handlers.get(event, ()) + (registration,)
+            self._handle_map[self._counter] = (event, registration)
             return self._counter
 
     def unregister_handler(self, handle):
         with self._handler_lock:
             if handle not in self._handle_map:
                 return
-            del self._handlers[self._handle_map[handle]][handle]
-            del self._handle_map[handle]
+            event, registration = self._handle_map.pop(handle)
+            registration.active = False
+            remaining = tuple(x for x in self._handlers[event] if x is not registration)
+            if remaining:
+                self._handlers[event] = remaining
+            else:
+                del self._handlers[event]
+
+    def registered_events(self):
+        """
+        :return: The events that currently have at least one handler.
+        """
+        return set(self._handlers)
+
+    def handler_stats(self):
+        with self._handler_lock:
+            registrations = [x for _, x in self._handle_map.values()]
+        return [x.stats() for x in registrations]
 
-    def wait_for_event(self, event, timeout=10):
+    def wait_for_event(self, event, timeout=10, key=None):
+        if key is not None:
+            return self.expect_event(event, key, timeout=timeout).result()
         return _BlockingEventWait(self, event).wait(timeout=timeout)
 
-    def queue_events(self, event):
-        return _QueuedEventWait(self, event)
+    def set_event_key(self, event, key):
+        self._event_keys[event] = key
+
+    def expect_event(self, event, key, timeout=10):
+        if event not in self._event_keys:
+            raise ValueError(f"Event {event!r} has no key function")
+        future = Future()
+        with self._waiter_lock:
+            waiter = [future, None]
+            self._waiters.setdefault(event, {}).setdefault(key, []).append(waiter)
+            waiter[1] = timer.schedule(timeout, lambda: self._expire_waiter(event, key, waiter))
+        return future
+
+    def _expire_waiter(self, event, key, waiter):
+        with self._waiter_lock:
+            waiters = self._waiters.get(event, {}).get(key)
+            if waiters is None or waiter not in waiters:
+                return
+            waiters.remove(waiter)
+            if not waiters:
+                del self._waiters[event][key]
+        if not waiter[0].done():
+            waiter[0].set_exception(TimeoutError())
+
+    def _resolve_waiters(self, event, args):
+        key = self._event_keys[event](*args)
+        with self._waiter_lock:
+            waiters = self._waiters[event].pop(key, None)
+        if waiters is None:
+            return
+        for future, expiry in waiters:
+            timer.cancel(expiry)
+            if not future.done():
+                future.set_result(args[0] if len(args) == 1 else args)
+
+    def queue_events(self, event, maxsize=0, policy=QueuePolicy.BLOCK):
+        return _QueuedEventWait(self, event, maxsize=maxsize, policy=policy)
 
     def broadcast_event(self, event, *args):
-        for handler in list(self._handlers.get(event, {}).values()):
-            handler(*args)
+        start = time.perf_counter()
+        if self._waiters.get(event):
+            self._resolve_waiters(event, args)
+        for registration in self._handlers.get(event, ()):
+            if registration.active:
+                registration.run(args)
+        EVENT_SECONDS.labels(self.name, _event_label(event)).observe(time.perf_counter() - start)
 
 
 class _BlockingEventWait(object):
@@ -47,33 +242,122 @@ class _BlockingEventWait(object):
         self.handle = self.event_handler.register_handler(event, self.handle_result)
 
     def handle_result(self, *args):
+        if self.block.is_set():
+            return
         self.result, = args
-        self.event_handler.unregister_handler(self.handle)
         self.block.set()
 
     def wait(self, timeout=10):
-        if not self.block.wait(timeout=timeout):
-            raise TimeoutError()
+        try:
+            if not self.block.wait(timeout=timeout):
+                raise TimeoutError()
+        finally:
+            self.event_handler.unregister_handler(self.handle)
         return self.result
 
 
+class _SpillFile(object):
+    """
+    A FIFO of pickled events in a temporary file.
+    """
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.read_position = 0
+        self.count = 0
+
+    def push(self, item):
+        self.file.seek(0, io.SEEK_END)
+        pickle.dump(item, self.file)
+        self.count += 1
+
+    def pop(self):
+        self.file.seek(self.read_position)
+        item = pickle.load(self.file)
+        self.read_position = self.file.tell()
+        self.count -= 1
+        if self.count == 0:
+            self.file.seek(0)
+            self.file.truncate()
+            self.read_position = 0
+        return item
+
+
 class _QueuedEventWait(BaseEventQueue):
-    def __init__(self, events, event):
-        self.queue = queue.Queue()
+    def __init__(self, events, event, maxsize=0, policy=QueuePolicy.BLOCK):
+        self.items = collections.deque()
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self._spill = None
+        self._closed = False
+        self._condition = threading.Condition()
         self.event_handler = events
         self.handle = self.event_handler.register_handler(event, self._handle_event)
 
+    def _full(self):
+        return self.maxsize and len(self.items) >= self.maxsize
+
     def _handle_event(self, arg):
-        self.queue.put(arg)
+        with self._condition:
+            if self.policy is QueuePolicy.SPILL and (self._full() or (self._spill and self._spill.count)):
+                # Once anything has spilled, everything after it has to as well or it'd come out of order.
+                if self._spill is None:
+                    self._spill = _SpillFile()
+                self._spill.push(arg)
+                return
+            if self._full():
+                if self.policy is QueuePolicy.DROP_OLDEST:
+                    self.items.popleft()
+                    self.dropped += 1
+                else:
+                    while self._full() and not self._closed:
+                        self._condition.wait()
+                    if self._closed:
+                        return
+            self.items.append(arg)
+            self._condition.notify_all()
+
+    def _pop(self):
+        item = self.items.popleft()
+        if self._spill is not None:
+            while self._spill.count and not self._full():
+                self.items.append(self._spill.pop())
+        self._condition.notify_all()
+        return item
 
     def close(self):
         self.event_handler.unregister_handler(self.handle)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
 
     def get(self, timeout=10):
-        try:
-            return self.queue.get(timeout=timeout)
-        except queue.Empty:
-            raise TimeoutError()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._condition:
+            while not self.items:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if self._closed or (remaining is not None and remaining <= 0):
+                    raise TimeoutError()
+                self._condition.wait(remaining)
+            return self._pop()
+
+    def get_many(self, max_items, max_wait):
+        deadline = time.monotonic() + max_wait
+        batch = []
+        with self._condition:
+            while len(batch) < max_items:
+                if self.items:
+                    batch.append(self._pop())
+                    continue
+                remaining = deadline - time.monotonic()
+                if self._closed or remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+        return batch
 
     def __iter__(self):
-        yield self.get()
+        while True:
+            try:
+                yield self.get(timeout=None)
+            except TimeoutError:
+                return
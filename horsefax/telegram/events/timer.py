@@ -0,0 +1,67 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+from typing import Callable, List, Optional
+
+
+class _Entry(object):
+    __slots__ = ('when', 'callback', 'cancelled')
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+
+class SharedTimer(object):
+    """
+    Runs callbacks after a delay, all from one background thread, so that deadlines don't each need a thread of their
+    own. Callbacks should be quick; anything slow holds up every other callback.
+    """
+    def __init__(self):
+        self._heap = []  # type: List
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def schedule(self, delay: float, callback: Callable[[], None]) -> _Entry:
+        """
+        Call `callback` in `delay` seconds.
+
+        :return: Something that can be passed to :meth:`cancel`.
+        """
+        entry = _Entry(time.monotonic() + delay, callback)
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            heapq.heappush(self._heap, (entry.when, next(self._sequence), entry))
+            self._condition.notify()
+        return entry
+
+    def cancel(self, entry: _Entry) -> None:
+        # Cancelled entries are left in the heap and skipped when they come up.
+        entry.cancelled = True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    if not self._heap:
+                        self._condition.wait()
+                    elif self._heap[0][0] > now:
+                        self._condition.wait(self._heap[0][0] - now)
+                    else:
+                        entry = heapq.heappop(self._heap)[2]
+                        if not entry.cancelled:
+                            break
+            try:
+                entry.callback()
+            except Exception:
+                traceback.print_exc()
+
+
+timer = SharedTimer()
@@ -1,2 +1,19 @@
 class TelegramError(Exception):
     pass
+
+
+class RateLimitedError(TelegramError):
+    """
+    Telegram refused a request because we're sending too fast. It should not be retried for `retry_after` seconds.
+    """
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f"Rate limited; retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(TelegramError):
+    """
+    Too many recent requests to Telegram have failed, so we aren't trying for the time being.
+    """
+    def __init__(self) -> None:
+        super().__init__("Telegram appears to be unreachable; not sending requests for now")
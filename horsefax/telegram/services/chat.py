@@ -1,7 +1,9 @@
+from concurrent.futures import Future
 from enum import Enum
 from typing import Union, Optional
 from .. import Telegram
 from ..types import Chat, User, Message
+from .outbound import OutboundQueue
 
 
 class ChatService:
@@ -10,11 +12,17 @@ class ChatService:
         MARKDOWN = 'Markdown'
         HTML = 'HTML'
 
-    def __init__(self, telegram: Telegram) -> None:
+    def __init__(self, telegram: Telegram, **outbound_args) -> None:
         self.telegram = telegram
+        self.outbound = OutboundQueue(telegram.connection, **outbound_args)
 
     def message(self, target: Union[Chat, User, int], message: str, parsing: ParseMode=ParseMode.NONE,
-                silent=False, preview=True, reply_to: Optional[Union[int, Message]]=None):
+                silent=False, preview=True, reply_to: Optional[Union[int, Message]]=None) -> Future:
+        """
+        Queue a message to be sent. This returns immediately; the message is sent as soon as rate limits allow.
+
+        :return: A future resolving to the sent message as returned by Telegram.
+        """
         if isinstance(target, Chat):
             target = target.id
         elif isinstance(target, User):
@@ -35,4 +43,4 @@ class ChatService:
         if reply_to is not None:
             command['reply_to'] = reply_to
 
-        self.telegram.connection.send("sendMessage", command)
+        return self.outbound.enqueue(target, "sendMessage", command)
@@ -1,8 +1,11 @@
 from typing import Tuple, List
 
+from horsefax import tracing
 from .. import Telegram
+from ..events import ExecutionMode
 from ..events.mixin import EventSourceMixin
-from ..types import Message, TextMessage
+from ..types import Message, TextMessage, TextEntity
+from .router import CommandRouter
 
 
 class Command:
@@ -12,12 +15,45 @@ class Command:
         self.args = args
 
 
+class UnknownCommand(Command):
+    """
+    A command nobody has registered. `addressed` is true if it was explicitly sent to us with an @botname suffix.
+    """
+    def __init__(self, message: TextMessage, command: str, args: List[str], addressed: bool,
+                 router: CommandRouter) -> None:
+        super().__init__(message, command, args)
+        self.addressed = addressed
+        self._router = router
+
+    @property
+    def suggestions(self) -> List[str]:
+        return self._router.suggest(self.command)
+
+
 class CommandService(EventSourceMixin):
+    # Broadcast with an :class:`UnknownCommand` when a command doesn't match anything registered.
+    UNKNOWN_COMMAND = object()
+
     def __init__(self, telegram: Telegram) -> None:
         super().__init__()
         self.telegram = telegram
+        self.router = CommandRouter()
+        self._handle_commands = {}
         self.telegram.register_handler("message", self.handle_message)
 
+    def register_handler(self, event, handler, mode=ExecutionMode.INLINE, timeout=None):
+        handle = super().register_handler(event, handler, mode=mode, timeout=timeout)
+        if isinstance(event, str):
+            self.router.add(event)
+            self._handle_commands[handle] = event
+        return handle
+
+    def unregister_handler(self, handle):
+        super().unregister_handler(handle)
+        command = self._handle_commands.pop(handle, None)
+        if command is not None:
+            self.router.discard(command)
+
     def handle_message(self, message: Message):
         if not isinstance(message, TextMessage):
             return
@@ -26,11 +62,33 @@ class CommandService(EventSourceMixin):
             return
         if text[0] != '/':
             return
-        parts = text.split()
-        command = parts[0][1:]
-        if '@' in command:
-            command, target = command.split('@', maxsplit=1)
-            if target != self.telegram.user.username:
+        length = self._command_length(message)
+        name, _, target = text[1:length].partition('@')
+        if not name:
+            return
+        if target and target.lower() != self.telegram.user.username.lower():
+            return
+        args = text[length:].split()
+
+        command = self.router.resolve(name)
+        with tracing.span('command', command=command or name, known=command is not None):
+            if command is None:
+                self._broadcast_event(self.UNKNOWN_COMMAND,
+                                      UnknownCommand(message, name, args, bool(target), self.router))
                 return
+            self._broadcast_event(command, Command(message, command, args))
 
-        self._broadcast_event(command, Command(message, command, parts[1:]))
+    @staticmethod
+    def _command_length(message: TextMessage) -> int:
+        for entity in message.entities:
+            if entity.offset != 0:
+                continue
+            try:
+                if entity.type is TextEntity.Type.BOT_COMMAND:
+                    return entity.length
+            except ValueError:
+                # Some entity type we don't know about.
+                pass
+            break
+        parts = message.text.split(maxsplit=1)
+        return len(parts[0])
@@ -0,0 +1,199 @@
+import collections
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, Union
+
+from horsefax import metrics, tracing
+from ..connections import TelegramConnection
+from ..exceptions import RateLimitedError
+
+SEND_SECONDS = metrics.histogram('horsefax_send_seconds', "Time taken to send each request to Telegram.",
+                                 ['endpoint'])
+SEND_WAIT_SECONDS = metrics.histogram('horsefax_send_queue_seconds',
+                                      "Time requests spend queued before being sent, including rate limiting.",
+                                      ['endpoint'])
+SEND_FAILURES = metrics.counter('horsefax_send_failures_total', "Requests Telegram refused or that failed to send.",
+                                ['endpoint', 'reason'])
+
+
+class TokenBucket:
+    """
+    Allows `rate` actions per second on average, with bursts of up to `capacity`. It starts out full at `now`, which
+    defaults to :func:`time.monotonic`.
+    """
+    def __init__(self, rate: float, capacity: float, now: Optional[float] = None) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """How long until a token will be available."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+# endpoint, params, future, when it was queued, trace context
+_Request = Tuple[str, Dict[str, Any], Future, float, Optional[tracing.Context]]
+
+
+class _ChatQueue:
+    def __init__(self, bucket: TokenBucket) -> None:
+        self.bucket = bucket
+        self.pending = collections.deque()  # type: Deque[_Request]
+        self.scheduled = False
+        self.blocked_until = 0.0
+
+
+class OutboundQueue:
+    """
+    Sends requests to Telegram in the background, keeping within Telegram's flood limits.
+
+    Requests to any one chat are sent in the order they were queued, no faster than that chat's limit allows. Requests
+    to different chats are sent in parallel, subject to an overall limit. If Telegram tells us to back off anyway, the
+    request is retried once it says we may.
+
+    :param connection: The connection to send requests on.
+    :param workers: How many requests may be in flight at once.
+    :param global_rate: Messages per second across all chats.
+    :param private_rate: Messages per second to any one private chat.
+    :param group_rate: Messages per second to any one group.
+    :param burst: How many messages a chat may receive in a burst before its rate limit applies.
+    :param clock: Gives the time in seconds, for working out rate limits.
+    """
+    def __init__(self, connection: TelegramConnection, workers: int = 4, global_rate: float = 30,
+                 private_rate: float = 1, group_rate: float = 20 / 60, burst: float = 3,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.connection = connection
+        self._clock = clock
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self._global = TokenBucket(global_rate, global_rate, clock())
+        self._chats = {}  # type: Dict[int, _ChatQueue]
+        self._ready = []  # type: List[Tuple[float, int, int]]
+        self._sequence = itertools.count()
+        self._enqueued = itertools.count(1)
+        self._lock = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def enqueue(self, chat_id: int, endpoint: str, params: Dict[str, Any]) -> Future:
+        """
+        Queue a request to be sent to the given chat.
+
+        :return: A future that resolves to the response once the request has been sent.
+        """
+        future = Future()  # type: Future
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            if next(self._enqueued) % 1000 == 0:
+                self._forget_idle_chats()
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                # Group and channel IDs are negative.
+                rate = self.group_rate if chat_id < 0 else self.private_rate
+                chat = self._chats[chat_id] = _ChatQueue(TokenBucket(rate, self.burst, self._clock()))
+            chat.pending.append((endpoint, params, future, self._clock(), tracing.capture()))
+            if not chat.scheduled:
+                chat.scheduled = True
+                self._schedule(chat_id, chat.blocked_until)
+        return future
+
+    def _forget_idle_chats(self) -> None:
+        # Once a chat has nothing queued and a full bucket, there's nothing about it worth remembering.
+        now = self._clock()
+        for chat_id in [k for k, v in self._chats.items() if not v.scheduled and v.bucket.full(now)
+                        and v.blocked_until <= now]:
+            del self._chats[chat_id]
+
+    def _schedule(self, chat_id: int, when: float) -> None:
+        heapq.heappush(self._ready, (when, next(self._sequence), chat_id))
+        self._lock.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                while True:
+                    now = self._clock()
+                    ready = self._next_ready(now)
+                    if isinstance(ready, tuple):
+                        break
+                    self._lock.wait(ready)
+            chat_id, request = ready
+            SEND_WAIT_SECONDS.labels(request[0]).observe(now - request[3])
+            self._pool.submit(self._send, chat_id, request)
+
+    def _next_ready(self, now: float) -> Union[Tuple[int, _Request], Optional[float]]:
+        """
+        Find the next request that may be sent at `now`, taking the tokens for it. Must be called with the lock held.
+
+        :return: (chat ID, request) if there is one. Otherwise, how long until there might be, or None if nothing is
+                 waiting to be sent.
+        """
+        while self._ready:
+            when, _, chat_id = self._ready[0]
+            if when > now:
+                return when - now
+            heapq.heappop(self._ready)
+            chat = self._chats[chat_id]
+            delay = max(self._global.delay(now), chat.bucket.delay(now))
+            if delay > 0:
+                self._schedule(chat_id, now + delay)
+                continue
+            self._global.take(now)
+            chat.bucket.take(now)
+            return chat_id, chat.pending[0]
+        return None
+
+    def _send(self, chat_id: int, request: _Request) -> None:
+        endpoint, params, future, queued, context = request
+        with tracing.resume(context, 'outbound queue'), tracing.span('send', endpoint=endpoint):
+            self._send_traced(chat_id, endpoint, params, future)
+
+    def _send_traced(self, chat_id: int, endpoint: str, params: Dict[str, Any], future: Future) -> None:
+        start = time.perf_counter()
+        try:
+            result = self.connection.send(endpoint, params)
+        except RateLimitedError as e:
+            SEND_FAILURES.labels(endpoint, 'rate_limited').inc()
+            # Leave the request at the head of the queue, and come back to it when Telegram lets us.
+            with self._lock:
+                chat = self._chats[chat_id]
+                chat.pending[0] = (endpoint, params, future, chat.pending[0][3], tracing.capture())
+                chat.blocked_until = self._clock() + e.retry_after
+                self._schedule(chat_id, chat.blocked_until)
+            return
+        except Exception as e:
+            SEND_FAILURES.labels(endpoint, 'error').inc()
+            print(f"Failed to send {endpoint} to {chat_id}: {e}")
+            future.set_exception(e)
+        else:
+            SEND_SECONDS.labels(endpoint).observe(time.perf_counter() - start)
+            future.set_result(result)
+        with self._lock:
+            chat = self._chats[chat_id]
+            chat.pending.popleft()
+            if chat.pending:
+                self._schedule(chat_id, chat.blocked_until)
+            else:
+                chat.scheduled = False
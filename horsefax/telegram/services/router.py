@@ -0,0 +1,90 @@
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+class _Node:
+    __slots__ = ('children', 'names')
+
+    def __init__(self) -> None:
+        self.children = {}  # type: Dict[str, _Node]
+        # The registered spellings of the command ending here, and how many registrations each has.
+        self.names = {}  # type: Dict[str, int]
+
+
+class CommandRouter:
+    """
+    A case-insensitive trie of command names. Lookups cost one step per character of the command, however many
+    commands are registered.
+    """
+    def __init__(self) -> None:
+        self._root = _Node()
+        self._lock = threading.Lock()
+
+    def add(self, name: str) -> None:
+        with self._lock:
+            node = self._root
+            for c in name.lower():
+                child = node.children.get(c)
+                if child is None:
+                    child = node.children[c] = _Node()
+                node = child
+            node.names[name] = node.names.get(name, 0) + 1
+
+    def discard(self, name: str) -> None:
+        with self._lock:
+            path = []  # type: List[Tuple[_Node, str]]
+            node = self._root
+            for c in name.lower():
+                child = node.children.get(c)
+                if child is None:
+                    return
+                path.append((node, c))
+                node = child
+            if name not in node.names:
+                return
+            node.names[name] -= 1
+            if node.names[name] > 0:
+                return
+            del node.names[name]
+            # Prune any branch that no longer leads anywhere.
+            for parent, c in reversed(path):
+                child = parent.children[c]
+                if child.names or child.children:
+                    break
+                del parent.children[c]
+
+    def resolve(self, name: str) -> Optional[str]:
+        """
+        :return: The registered spelling of `name`, preferring an exact match, or None if it isn't registered.
+        """
+        node = self._root
+        for c in name.lower():
+            node = node.children.get(c)
+            if node is None:
+                return None
+        if name in node.names:
+            return name
+        for registered in node.names:
+            return registered
+        return None
+
+    def suggest(self, name: str, limit: int = 3, max_distance: int = 2) -> List[str]:
+        """
+        :return: Up to `limit` registered commands within `max_distance` edits of `name`, closest first.
+        """
+        name = name.lower()
+        results = []  # type: List[Tuple[int, str]]
+        first_row = list(range(len(name) + 1))
+        # Walk the trie computing one row of the edit distance table per node, abandoning branches that can no longer
+        # come within range.
+        stack = [(child, c, first_row) for c, child in self._root.children.items()]
+        while stack:
+            node, c, previous = stack.pop()
+            row = [previous[0] + 1]
+            for i in range(1, len(name) + 1):
+                row.append(min(row[i - 1] + 1, previous[i] + 1, previous[i - 1] + (name[i - 1] != c)))
+            if row[-1] <= max_distance:
+                results.extend((row[-1], x) for x in node.names)
+            if min(row) <= max_distance:
+                stack.extend((child, c, row) for c, child in node.children.items())
+        return [x for _, x in sorted(results)[:limit]]
@@ -1,286 +1,351 @@
 import datetime
 from dateutil.tz import tzutc
 from enum import Enum
-from typing import Optional, Dict, Any, Callable, TypeVar, Type
+import itertools
+from typing import Optional, Dict, Any, Callable, TypeVar, Type, Generic, List, Tuple
+
+from .cache import LRUCache
 
 __all__ = ['Message', 'TextMessage', 'AudioMessage', 'DocumentMessage', 'GameMessage', 'PhotoMessage', 'StickerMessage',
            'VideoMessage', 'VideoNoteMessage', 'UsersJoinedMessage', 'UserLeftMessage', 'NewChatTitleMessage',
            'NewChatPhotoMessage', 'DeleteChatPhotoMessage', 'GroupChatCreatedMessage', 'SupergroupChatCreatedMessage',
            'ChannelChatCreatedMessage', 'ChatMigrateToIDMessage', 'ChatMigrateFromIDMessage', 'MessagePinnedMessage',
-           'InvoiceMessage', 'ContactMessage', 'LocationMessage', 'VenueMessage', 'User', 'PhotoSize', 'TextEntity',
-           'Chat']
+           'InvoiceMessage', 'ContactMessage', 'LocationMessage', 'VenueMessage', 'AnimationMessage', 'PollMessage',
+           'DiceMessage', 'User', 'PhotoSize', 'TextEntity', 'PollOption', 'Chat']
 
 T = TypeVar('T')
-S = TypeVar('S')
-
-
-def _optional(constructor: Callable[[S], T], value: Optional[S]) -> Optional[T]:
-    if value:
-        return constructor(value)
-    else:
-        return None
 
 
 def _from_ts(t: float) -> datetime.datetime:
     return datetime.datetime.fromtimestamp(t, tz=tzutc())
 
 
-class Message:
+_REQUIRED = object()
+
+
+class _Field(Generic[T]):
+    """
+    An attribute of a raw view that is decoded from the underlying dict the first time it is read, and cached in the
+    view's ``__dict__`` after that, where later reads find it without coming back here. It can also be assigned to,
+    which replaces the decoded value.
+
+    :param path: Where to find the value, as dot-separated keys.
+    :param convert: Applied to the value found, if there is one.
+    :param default: What to use if the value is missing. If not given, the value is required.
+    :param many: The value is a list, and `convert` should be applied to each item. A missing list is empty.
+    """
+    def __init__(self, path: str, convert: Optional[Callable[[Any], Any]] = None, default: Any = _REQUIRED,
+                 many: bool = False) -> None:
+        self.decode = self._compile(path.split('.'), convert, default, many)
+        self.name = None  # type: Optional[str]
+
+    @staticmethod
+    def _compile(keys: List[str], convert, default, many) -> Callable[[Dict[str, Any]], T]:
+        if many and default is _REQUIRED:
+            default = None
+        if len(keys) == 1 and convert is None:
+            key = keys[0]
+            if default is _REQUIRED:
+                return lambda p: p[key]
+            return lambda p: p.get(key, default)
+        if len(keys) == 1 and not many:
+            key = keys[0]
+            if default is _REQUIRED:
+                return lambda p: convert(p[key])
+
+            def decode_one(p):
+                value = p.get(key)
+                return default if value is None else convert(value)
+            return decode_one
+
+        def decode(p):
+            value = p
+            for key in keys:
+                if default is _REQUIRED:
+                    value = value[key]
+                else:
+                    value = value.get(key)
+                    if value is None:
+                        return [] if many else default
+            if convert is None:
+                return value
+            if many:
+                return [convert(x) for x in value]
+            return convert(value)
+        return decode
+
+    # There's deliberately no __set__, so that a value in the instance's __dict__ takes precedence over this.
+    def __get__(self, instance, owner) -> T:
+        if instance is None:
+            return self
+        value = instance.__dict__[self.name] = self.decode(instance._raw)
+        return value
+
+
+class _Computed(_Field[T]):
+    """
+    A :class:`_Field` that doesn't fit the usual schema, decoded by an arbitrary function of the raw dict.
+    """
+    def __init__(self, decode: Callable[[Dict[str, Any]], T]) -> None:
+        self.decode = decode
+        self.name = None
+
+
+# Maps each key that identifies a kind of message to (priority, class). Where a message has more than one such key,
+# the lowest priority wins; this is declaration order.
+_MESSAGE_KINDS = {}  # type: Dict[str, Tuple[int, type]]
+_kind_priority = itertools.count()
+
+
+class _RawViewType(type):
+    def __new__(mcs, name, bases, namespace, kind: Optional[Tuple[str, ...]] = None):
+        fields = {k: v for k, v in namespace.items() if isinstance(v, _Field)}
+        namespace.setdefault('__slots__', ())
+        cls = super().__new__(mcs, name, bases, namespace)
+        for k, field in fields.items():
+            field.name = k
+        if kind is not None:
+            priority = next(_kind_priority)
+            for key in kind:
+                _MESSAGE_KINDS[key] = (priority, cls)
+        return cls
+
+    def __init__(cls, name, bases, namespace, kind=None):
+        super().__init__(name, bases, namespace)
+
+
+class _RawView(metaclass=_RawViewType):
+    """
+    A read-mostly view over a dict from the Bot API. Nothing is decoded until it's asked for. Views that are never
+    read from don't get a ``__dict__`` at all.
+    """
+    __slots__ = ('_raw', '__dict__')
+
     def __init__(self, p: Dict[str, Any]) -> None:
-        self.message_id = p['message_id']  # type: int
-        self.sender = User(p['from'])
-        self.date = _from_ts(p['date'])
-        self.chat = Chat(p['chat'])
-        self.forward_from = _optional(User, p.get('forward_from'))
-        self.forward_from_chat = _optional(Chat, p.get('forward_from_chat'))
-        self.forward_from_message_id = p.get('forward_from_message_id', None)  # type: Optional[int]
-        self.forward_date = _optional(_from_ts, p.get('forward_date'))
-        self.reply_to_message = _optional(Message, p.get('reply_to_message'))
-        self.edit_date = _optional(_from_ts, p.get('edit_date'))
+        self._raw = p
+
+
+class Message(_RawView):
+    message_id = _Field('message_id')  # type: _Field[int]
+    sender = _Field('from', lambda x: User.intern(x))  # type: _Field[User]
+    date = _Field('date', _from_ts)  # type: _Field[datetime.datetime]
+    chat = _Field('chat', lambda x: Chat.intern(x))  # type: _Field[Chat]
+    forward_from = _Field('forward_from', lambda x: User.intern(x), default=None)  # type: _Field[Optional[User]]
+    forward_from_chat = _Field('forward_from_chat', lambda x: Chat.intern(x), default=None)  # type: _Field[Optional[Chat]]
+    forward_from_message_id = _Field('forward_from_message_id', default=None)  # type: _Field[Optional[int]]
+    forward_date = _Field('forward_date', _from_ts, default=None)  # type: _Field[Optional[datetime.datetime]]
+    reply_to_message = _Field('reply_to_message', lambda x: Message(x), default=None)  # type: _Field[Optional[Message]]
+    edit_date = _Field('edit_date', _from_ts, default=None)  # type: _Field[Optional[datetime.datetime]]
+    # Somewhere for consumers of the message to keep notes about it.
+    context = _Computed(lambda p: {})  # type: _Field[Dict[str, Any]]
 
     @classmethod
-    def from_update(cls, update):
-        mapping = {
-            'text': TextMessage,
-            'audio': AudioMessage,
-            'document': DocumentMessage,
-            'game': GameMessage,
-            'photo': PhotoMessage,
-            'sticker': StickerMessage,
-            'video': VideoMessage,
-            'video_note': VideoNoteMessage,
-            'new_chat_members': UsersJoinedMessage,
-            'new_chat_member': _one_user_joined_message,
-            'left_chat_member': UserLeftMessage,
-            'contact': ContactMessage,
-            'location': LocationMessage,
-            'venue': VenueMessage,
-            'new_chat_title': NewChatTitleMessage,
-            'new_chat_photo': NewChatPhotoMessage,
-            'delete_chat_photo': DeleteChatPhotoMessage,
-            'group_chat_created': GroupChatCreatedMessage,
-            'supergroup_chat_created': SupergroupChatCreatedMessage,
-            'channel_chat_created': ChannelChatCreatedMessage,
-            'migrate_to_chat_id': ChatMigrateToIDMessage,
-            'migrate_from_chat_id': ChatMigrateFromIDMessage,
-            'pinned_message': MessagePinnedMessage,
-            'invoice': InvoiceMessage,
-        }
-        for k, v in mapping.items():
-            if k in update:
-                return v(update)
-        return Message(update)
-
-
-class TextMessage(Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        self.text = p['text']  # type: str
-        self.entities = [TextEntity(x) for x in p.get('entities', [])]
+    def from_update(cls, update: Dict[str, Any]) -> 'Message':
+        best = None
+        for key in update:
+            kind = _MESSAGE_KINDS.get(key)
+            if kind is not None and (best is None or kind[0] < best[0]):
+                best = kind
+        if best is None:
+            return Message(update)
+        return best[1](update)
+
+
+class TextMessage(Message, kind=('text',)):
+    text = _Field('text')  # type: _Field[str]
+    entities = _Field('entities', lambda x: TextEntity(x), many=True)  # type: _Field[List[TextEntity]]
 
     def __str__(self) -> str:
         return f"{self.sender.first_name}: {self.text}"
 
 
 class FileMixin:
-    pass
+    __slots__ = ()
+
+
+# Animations also carry a 'document' key for older clients, so this must be declared before DocumentMessage.
+class AnimationMessage(FileMixin, Message, kind=('animation',)):
+    file_id = _Field('animation.file_id')  # type: _Field[str]
+    file_unique_id = _Field('animation.file_unique_id', default=None)  # type: _Field[Optional[str]]
+    width = _Field('animation.width')  # type: _Field[int]
+    height = _Field('animation.height')  # type: _Field[int]
+    duration = _Field('animation.duration')  # type: _Field[int]
+    thumbnail = _Field('animation.thumb', lambda x: PhotoSize(x), default=None)  # type: _Field[Optional[PhotoSize]]
+    caption = _Field('caption', default=None)  # type: _Field[Optional[str]]
+    file_name = _Field('animation.file_name', default=None)  # type: _Field[Optional[str]]
+    mime_type = _Field('animation.mime_type', default=None)  # type: _Field[Optional[str]]
+    file_size = _Field('animation.file_size', default=None)  # type: _Field[Optional[int]]
 
 
-class AudioMessage(FileMixin, Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        audio = p['audio']  # type: Dict[str, Any]
-        self.file_id = audio['file_id']  # type: str
-        self.duration = audio['duration']  # type: int
-        self.performer = audio.get('performer', None)  # type: Optional[str]
-        self.title = audio.get('title', None)  # type: Optional[str]
-        self.mime_type = audio.get('mime_type', None)  # type: Optional[str]
-        self.file_size = audio.get('file_size', None)  # type: Optional[int]
+class AudioMessage(FileMixin, Message, kind=('audio',)):
+    file_id = _Field('audio.file_id')  # type: _Field[str]
+    file_unique_id = _Field('audio.file_unique_id', default=None)  # type: _Field[Optional[str]]
+    duration = _Field('audio.duration')  # type: _Field[int]
+    performer = _Field('audio.performer', default=None)  # type: _Field[Optional[str]]
+    title = _Field('audio.title', default=None)  # type: _Field[Optional[str]]
+    mime_type = _Field('audio.mime_type', default=None)  # type: _Field[Optional[str]]
+    file_size = _Field('audio.file_size', default=None)  # type: _Field[Optional[int]]
 
 
-class DocumentMessage(FileMixin, Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        doc = p['document']  # type: Dict[str, Any]
-        self.file_id = doc['file_id']
-        self.thumbnail = _optional(PhotoSize, p.get('thumb'))
-        self.caption = p.get('caption', None)  # type: Optional[str]
-        self.file_name = doc.get('file_name', None)  # type: Optional[str]
-        self.mime_type = doc.get('mime_type', None)  # type: Optional[str]
-        self.file_size = doc.get('file_size', None)  # type: Optional[int]
+class DocumentMessage(FileMixin, Message, kind=('document',)):
+    file_id = _Field('document.file_id')  # type: _Field[str]
+    file_unique_id = _Field('document.file_unique_id', default=None)  # type: _Field[Optional[str]]
+    thumbnail = _Field('document.thumb', lambda x: PhotoSize(x), default=None)  # type: _Field[Optional[PhotoSize]]
+    caption = _Field('caption', default=None)  # type: _Field[Optional[str]]
+    file_name = _Field('document.file_name', default=None)  # type: _Field[Optional[str]]
+    mime_type = _Field('document.mime_type', default=None)  # type: _Field[Optional[str]]
+    file_size = _Field('document.file_size', default=None)  # type: _Field[Optional[int]]
 
 
-class GameMessage(Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        game = p['game']  # type: Dict[str, Any]
-        self.title = game['title']  # type: str
-        self.description = game['description']  # type: str
-        self.photo = [PhotoSize(x) for x in game['photo']]
-        self.text = game.get('text', None)  # type: Optional[str]
-        self.text_entities = [TextEntity(x) for x in game.get('message_entities', [])]
-        # animation not implemented.
+class GameMessage(Message, kind=('game',)):
+    title = _Field('game.title')  # type: _Field[str]
+    description = _Field('game.description')  # type: _Field[str]
+    photo = _Field('game.photo', lambda x: PhotoSize(x), many=True)  # type: _Field[List[PhotoSize]]
+    text = _Field('game.text', default=None)  # type: _Field[Optional[str]]
+    text_entities = _Field('game.message_entities', lambda x: TextEntity(x), many=True)  # type: _Field[List[TextEntity]]
+    # animation not implemented.
 
 
-class PhotoMessage(Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        self.photo = [PhotoSize(x) for x in p['photo']]
-        self.caption = p.get('caption', None)  # type: Optional[str]
+class PhotoMessage(Message, kind=('photo',)):
+    photo = _Field('photo', lambda x: PhotoSize(x), many=True)  # type: _Field[List[PhotoSize]]
+    caption = _Field('caption', default=None)  # type: _Field[Optional[str]]
 
 
-class StickerMessage(FileMixin, Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        sticker = p['sticker']  # type: Dict[str, Any]
-        self.file_id = sticker['file_id']  # type: str
-        self.width = sticker['width']  # type: int
-        self.height = sticker['height']  # type: int
-        self.thumb = _optional(PhotoSize, sticker.get('thumb'))
-        self.emoji = sticker.get('emoji', None)  # type: Optional[str]
-        self.file_size = sticker.get('file_size', None)  # type: Optional[int]
+class StickerMessage(FileMixin, Message, kind=('sticker',)):
+    file_id = _Field('sticker.file_id')  # type: _Field[str]
+    file_unique_id = _Field('sticker.file_unique_id', default=None)  # type: _Field[Optional[str]]
+    width = _Field('sticker.width')  # type: _Field[int]
+    height = _Field('sticker.height')  # type: _Field[int]
+    thumb = _Field('sticker.thumb', lambda x: PhotoSize(x), default=None)  # type: _Field[Optional[PhotoSize]]
+    emoji = _Field('sticker.emoji', default=None)  # type: _Field[Optional[str]]
+    file_size = _Field('sticker.file_size', default=None)  # type: _Field[Optional[int]]
 
 
-class VideoMessage(FileMixin, Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        video = p['video']  # type: Dict[str, Any]
-        self.caption = p.get('caption', None)  # type: Dict[str, Any]
-        self.file_id = video['file_id']  # type: str
-        self.width = video['width']  # type: int
-        self.height = video['height']  # type: int
-        self.duration = video['duration']  # type: int
-        self.thumbnail = _optional(PhotoSize, video.get('thumb'))
-        self.mime_type = video.get('mime_type', None)  # type: Optional[str]
-        self.file_size = video.get('file_size', None)  # type: Optional[int]
-
-
-class VideoNoteMessage(FileMixin, Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        video = p['video_note']  # type: Dict[str, Any]
-        self.file_id = video['file_id']  # type: str
-        self.length = video['length']  # type: int
-        self.duration = video['duration']  # type: int
-        self.thumbnail = _optional(PhotoSize, video.get('thumb'))
-        self.file_size = video.get('file_size', None)  # type: int
+class VideoMessage(FileMixin, Message, kind=('video',)):
+    caption = _Field('caption', default=None)  # type: _Field[Optional[str]]
+    file_id = _Field('video.file_id')  # type: _Field[str]
+    file_unique_id = _Field('video.file_unique_id', default=None)  # type: _Field[Optional[str]]
+    width = _Field('video.width')  # type: _Field[int]
+    height = _Field('video.height')  # type: _Field[int]
+    duration = _Field('video.duration')  # type: _Field[int]
+    thumbnail = _Field('video.thumb', lambda x: PhotoSize(x), default=None)  # type: _Field[Optional[PhotoSize]]
+    mime_type = _Field('video.mime_type', default=None)  # type: _Field[Optional[str]]
+    file_size = _Field('video.file_size', default=None)  # type: _Field[Optional[int]]
 
 
-class UsersJoinedMessage(Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        self.users = [User(x) for x in p['new_chat_members']]
+class VideoNoteMessage(FileMixin, Message, kind=('video_note',)):
+    file_id = _Field('video_note.file_id')  # type: _Field[str]
+    file_unique_id = _Field('video_note.file_unique_id', default=None)  # type: _Field[Optional[str]]
+    length = _Field('video_note.length')  # type: _Field[int]
+    duration = _Field('video_note.duration')  # type: _Field[int]
+    thumbnail = _Field('video_note.thumb', lambda x: PhotoSize(x), default=None)  # type: _Field[Optional[PhotoSize]]
+    file_size = _Field('video_note.file_size', default=None)  # type: _Field[Optional[int]]
 
 
-class UserLeftMessage(Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        self.user = User(p['left_chat_member'])
+# Older versions of the Bot API only sent a single new_chat_member.
+class UsersJoinedMessage(Message, kind=('new_chat_members', 'new_chat_member')):
+    users = _Computed(lambda p: [User.intern(x) for x in p['new_chat_members']] if 'new_chat_members' in p
+                      else [User.intern(p['new_chat_member'])])  # type: _Field[List[User]]
 
 
-class NewChatTitleMessage(Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        self.title = p['new_chat_title']  # type: str
+class UserLeftMessage(Message, kind=('left_chat_member',)):
+    user = _Field('left_chat_member', lambda x: User.intern(x))  # type: _Field[User]
 
 
-class NewChatPhotoMessage(Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        self.photo = [PhotoSize(x) for x in p['new_chat_photo']]
+class ContactMessage(Message, kind=('contact',)):
+    phone_number = _Field('contact.phone_number')  # type: _Field[str]
+    first_name = _Field('contact.first_name')  # type: _Field[str]
+    last_name = _Field('contact.last_name', default=None)  # type: _Field[Optional[str]]
+    telegram_user_id = _Field('contact.user_id', default=None)  # type: _Field[Optional[int]]
 
 
-class DeleteChatPhotoMessage(Message):
-    pass
+# Venues also carry a 'location' key, so this must be declared before LocationMessage.
+class VenueMessage(Message, kind=('venue',)):
+    longitude = _Field('venue.location.longitude')  # type: _Field[float]
+    latitude = _Field('venue.location.latitude')  # type: _Field[float]
+    title = _Field('venue.title')  # type: _Field[str]
+    address = _Field('venue.address')  # type: _Field[str]
+    foursquare_id = _Field('venue.foursquare_id', default=None)  # type: _Field[Optional[str]]
 
 
-class GroupChatCreatedMessage(Message):
-    pass
+class LocationMessage(Message, kind=('location',)):
+    longitude = _Field('location.longitude')  # type: _Field[float]
+    latitude = _Field('location.latitude')  # type: _Field[float]
+
+
+class NewChatTitleMessage(Message, kind=('new_chat_title',)):
+    title = _Field('new_chat_title')  # type: _Field[str]
 
 
-class SupergroupChatCreatedMessage(Message):
+class NewChatPhotoMessage(Message, kind=('new_chat_photo',)):
+    photo = _Field('new_chat_photo', lambda x: PhotoSize(x), many=True)  # type: _Field[List[PhotoSize]]
+
+
+class DeleteChatPhotoMessage(Message, kind=('delete_chat_photo',)):
     pass
 
 
-class ChannelChatCreatedMessage(Message):
+class GroupChatCreatedMessage(Message, kind=('group_chat_created',)):
     pass
 
 
-class ChatMigrateToIDMessage(Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        self.id = p['migrate_to_chat_id']  # type: int
+class SupergroupChatCreatedMessage(Message, kind=('supergroup_chat_created',)):
+    pass
 
 
-class ChatMigrateFromIDMessage(Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        self.id = p['migrate_from_chat_id']  # type: int
+class ChannelChatCreatedMessage(Message, kind=('channel_chat_created',)):
+    pass
 
 
-class MessagePinnedMessage(Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        self.message = Message(p['pinned_message'])
+class ChatMigrateToIDMessage(Message, kind=('migrate_to_chat_id',)):
+    id = _Field('migrate_to_chat_id')  # type: _Field[int]
 
 
-class InvoiceMessage(Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        invoice = p['invoice']  # type: Dict[str, Any]
-        self.title = invoice['title']  # type: str
-        self.description = invoice['description']  # type: str
-        self.start_param = invoice['start_parameter']  # type: str
-        self.currency = invoice['currency']  # type: str
-        self.total_amount = invoice['total_amount']  # type: int
+class ChatMigrateFromIDMessage(Message, kind=('migrate_from_chat_id',)):
+    id = _Field('migrate_from_chat_id')  # type: _Field[int]
 
 
-def _one_user_joined_message(message: Dict[str, Any]) -> UsersJoinedMessage:
-    message = message.copy()
-    message['new_chat_members'] = [message['new_chat_member']]
-    del message['new_chat_member']
-    return UsersJoinedMessage(message)
+class MessagePinnedMessage(Message, kind=('pinned_message',)):
+    message = _Field('pinned_message', lambda x: Message(x))  # type: _Field[Message]
 
 
-class ContactMessage(Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        contact = p['contact']  # type: Dict[str, Any]
-        self.phone_number = contact['phone_number']  # type: str
-        self.first_name = contact['first_name']  # type: str
-        self.last_name = contact.get('last_name', None)  # type: Optional[str]
-        self.telegram_user_id = contact.get('user_id', None)  # type: Optional[int]
+class InvoiceMessage(Message, kind=('invoice',)):
+    title = _Field('invoice.title')  # type: _Field[str]
+    description = _Field('invoice.description')  # type: _Field[str]
+    start_param = _Field('invoice.start_parameter')  # type: _Field[str]
+    currency = _Field('invoice.currency')  # type: _Field[str]
+    total_amount = _Field('invoice.total_amount')  # type: _Field[int]
 
 
-class LocationMessage(Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        location = p['location']  # type: Dict[str, Any]
-        self.longitude = location['longitude']  # type: int
-        self.latitude = location['latitude']  # type: int
+class PollMessage(Message, kind=('poll',)):
+    poll_id = _Field('poll.id')  # type: _Field[str]
+    question = _Field('poll.question')  # type: _Field[str]
+    options = _Field('poll.options', lambda x: PollOption(x), many=True)  # type: _Field[List[PollOption]]
+    is_closed = _Field('poll.is_closed', default=False)  # type: _Field[bool]
 
 
-class VenueMessage(Message):
-    def __init__(self, p: Dict[str, Any]) -> None:
-        super().__init__(p)
-        venue = p['venue']
-        location = venue['location']  # type: Dict[str, Any]
-        self.longitude = location['longitude']  # type: int
-        self.latitude = location['latitude']  # type: int
-        self.title = location['title']  # type: str
-        self.address = location['address']  # type: str
-        self.foursquare_id = location.get('foursquare_id')  # type: Optional[int]
+class DiceMessage(Message, kind=('dice',)):
+    emoji = _Field('dice.emoji', default='🎲')  # type: _Field[str]
+    value = _Field('dice.value')  # type: _Field[int]
 
 
 class PhotoSize:
+    __slots__ = ('file_id', 'file_unique_id', 'width', 'height', 'file_size')
+
     def __init__(self, p: Dict[str, Any]) -> None:
         self.file_id = p['file_id']  # type: str
+        self.file_unique_id = p.get('file_unique_id', None)  # type: Optional[str]
         self.width = p['width']  # type: int
         self.height = p['height']  # type: int
         self.file_size = p.get('file_size', None)  # type: Optional[int]
 
 
-class TextEntity:
+class PollOption(_RawView):
+    text = _Field('text')  # type: _Field[str]
+    voter_count = _Field('voter_count', default=0)  # type: _Field[int]
+
+
+class TextEntity(_RawView):
     class Type(Enum):
         MENTION = 'mention'
         HASHTAG = 'hashtag'
@@ -294,35 +359,76 @@ class TextEntity:
         TEXT_LINK = 'text_link'
         TEXT_MENTION = 'text_mention'
 
-    def __init__(self, properties: Dict[str, Any]) -> None:
-        self.type = self.Type(properties['type'])
-        self.offset = properties['offset']  # type: int
-        self.length = properties['length']  # type: int
-        self.url = properties.get('url')  # type: Optional[str]
-        self.user = _optional(User, properties.get('user'))
+    type = _Field('type', lambda x: TextEntity.Type(x))  # type: _Field[TextEntity.Type]
+    # What Telegram calls the type, for types newer than TextEntity.Type.
+    raw_type = _Field('type')  # type: _Field[str]
+    offset = _Field('offset')  # type: _Field[int]
+    length = _Field('length')  # type: _Field[int]
+    url = _Field('url', default=None)  # type: _Field[Optional[str]]
+    user = _Field('user', lambda x: User.intern(x), default=None)  # type: _Field[Optional[User]]
 
 
-class User:
+class _Interned:
+    """
+    An immutable value that is shared between every message mentioning the same thing, for as long as what we're told
+    about it stays the same. Two instances from :meth:`intern` are the same object exactly when nothing has changed.
+    """
+    __slots__ = ('fingerprint',)
+    _FINGERPRINT = ()  # type: Tuple[str, ...]
+    _cache = None  # type: LRUCache
+
+    @classmethod
+    def intern(cls, properties: Dict[str, Any]):
+        fingerprint = tuple(map(properties.get, cls._FINGERPRINT))
+        existing = cls._cache.get(properties['id'])
+        if existing is not None and existing.fingerprint == fingerprint:
+            return existing
+        instance = cls(properties)
+        cls._cache.put(instance.id, instance)
+        return instance
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __setstate__(self, state):
+        # Slotted objects are pickled as (None, {slot: value}).
+        for key, value in state[1].items():
+            object.__setattr__(self, key, value)
+
+
+class User(_Interned):
+    __slots__ = ('id', 'first_name', 'last_name', 'username', 'language_code')
+    _FINGERPRINT = ('first_name', 'last_name', 'username', 'language_code')
+    _cache = LRUCache(4096)  # type: LRUCache[int, User]
+
     def __init__(self, properties: Dict[str, Any]) -> None:
-        self.id = properties['id']  # type: int
-        self.first_name = properties['first_name']  # type: str
-        self.last_name = properties.get('last_name', None)  # type: Optional[str]
-        self.username = properties.get('username', None)  # type: Optional[str]
-        self.language_code = properties.get('language_code', None)  # type: Optional[str]
+        _set = object.__setattr__
+        _set(self, 'id', properties['id'])
+        _set(self, 'first_name', properties['first_name'])
+        _set(self, 'last_name', properties.get('last_name', None))
+        _set(self, 'username', properties.get('username', None))
+        _set(self, 'language_code', properties.get('language_code', None))
+        _set(self, 'fingerprint', tuple(map(properties.get, self._FINGERPRINT)))
 
 
-class Chat:
+class Chat(_Interned):
     class Type(Enum):
         PRIVATE = 'private'
         GROUP = 'group'
         SUPERGROUP = 'supergroup'
         CHANNEL = 'channel'
 
+    __slots__ = ('id', 'type', 'title', 'username', 'first_name', 'last_name', 'all_members_are_administrators')
+    _FINGERPRINT = ('type', 'title', 'username', 'first_name', 'last_name', 'all_members_are_administrators')
+    _cache = LRUCache(1024)  # type: LRUCache[int, Chat]
+
     def __init__(self, properties: Dict[str, Any]) -> None:
-        self.id = properties['id']  # type: int
-        self.type = self.Type(properties['type'])
-        self.title = properties.get('title', None)  # type: Optional[str]
-        self.username = properties.get('username', None)  # type: Optional[str]
-        self.first_name = properties.get('first_name', None)  # type: Optional[str]
-        self.last_name = properties.get('last_name', None)  # type: Optional[str]
-        self.all_members_are_administrators = properties.get('all_members_are_administrators', False)  # type: bool
+        _set = object.__setattr__
+        _set(self, 'id', properties['id'])
+        _set(self, 'type', self.Type(properties['type']))
+        _set(self, 'title', properties.get('title', None))
+        _set(self, 'username', properties.get('username', None))
+        _set(self, 'first_name', properties.get('first_name', None))
+        _set(self, 'last_name', properties.get('last_name', None))
+        _set(self, 'all_members_are_administrators', properties.get('all_members_are_administrators', False))
+        _set(self, 'fingerprint', tuple(map(properties.get, self._FINGERPRINT)))
@@ -0,0 +1,265 @@
+"""
+Lightweight tracing of updates as they pass through the bot, written to a JSON-lines file for offline inspection.
+
+A trace is started for a sampled fraction of updates with :func:`start_trace`. Code along the way marks out stages
+with :func:`span`; when no trace is active on the current thread, this costs a single thread-local lookup. Work that
+moves to another thread takes the trace with it by calling :func:`capture` before the hand-off and :func:`resume` on
+the other side::
+
+    with tracing.start_trace('update', update_id=123):
+        context = tracing.capture()
+        queue.put((update, context))
+
+    # ...on some worker thread...
+    update, context = queue.get()
+    with tracing.resume(context, 'queued'), tracing.span('handle'):
+        ...
+
+A trace is written out once every span in it has finished and every captured context has been resumed and left, or
+released.
+"""
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from typing import Any, Dict, IO, List, Optional
+
+_local = threading.local()
+_ids = itertools.count(1)
+_rate = 0.0
+_path = None  # type: Optional[str]
+_file = None  # type: Optional[IO[str]]
+_file_lock = threading.Lock()
+
+
+def configure(path: Optional[str], rate: float) -> None:
+    """
+    :param path: The file to append finished traces to.
+    :param rate: The fraction of traces to record, from 0 (tracing is off) to 1 (everything).
+    """
+    global _path, _rate, _file
+    with _file_lock:
+        if _file is not None:
+            _file.close()
+            _file = None
+        _path = path
+        _rate = rate if path else 0.0
+
+
+class _Trace:
+    __slots__ = ('trace_id', 'wall', 'started', 'spans', 'holds', 'lock')
+
+    def __init__(self) -> None:
+        self.trace_id = f'{os.getpid():x}-{next(_ids):x}'
+        self.wall = time.time()
+        self.started = time.perf_counter()
+        self.spans = []  # type: List[_Span]
+        self.holds = 0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self.lock:
+            self.holds += 1
+
+    def release(self) -> None:
+        with self.lock:
+            self.holds -= 1
+            if self.holds:
+                return
+        _write(self)
+
+
+class _Span:
+    __slots__ = ('trace', 'span_id', 'parent', 'name', 'start', 'end', 'attrs', 'thread')
+
+    def __init__(self, trace: _Trace, parent: Optional['_Span'], name: str, attrs: Dict[str, Any],
+                 start: Optional[float] = None) -> None:
+        self.trace = trace
+        self.parent = parent
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter() if start is None else start
+        self.end = None  # type: Optional[float]
+        self.thread = threading.current_thread().name
+        with trace.lock:
+            self.span_id = len(trace.spans) + 1
+            trace.spans.append(self)
+
+    def to_json(self, started: float) -> Dict[str, Any]:
+        return {'id': self.span_id,
+                'parent': self.parent.span_id if self.parent is not None else None,
+                'name': self.name,
+                'start_ms': round((self.start - started) * 1000, 3),
+                'duration_ms': round(((self.end or self.start) - self.start) * 1000, 3),
+                'thread': self.thread,
+                'attrs': self.attrs}
+
+
+class _NullScope:
+    def __enter__(self) -> '_NullScope':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+    def set(self, **attrs) -> None:
+        pass
+
+
+_NULL = _NullScope()
+
+
+class _SpanScope:
+    __slots__ = ('trace', 'parent', 'name', 'attrs', 'span')
+
+    def __init__(self, trace: _Trace, parent: Optional[_Span], name: str, attrs: Dict[str, Any]) -> None:
+        self.trace = trace
+        self.parent = parent
+        self.name = name
+        self.attrs = attrs
+        self.span = None  # type: Optional[_Span]
+
+    def __enter__(self) -> '_SpanScope':
+        self.trace.acquire()
+        self.span = _Span(self.trace, self.parent, self.name, self.attrs)
+        _local.span = self.span
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.span.end = time.perf_counter()
+        if exc_type is not None:
+            self.span.attrs['error'] = exc_type.__name__
+        _local.span = self.parent
+        self.trace.release()
+
+    def set(self, **attrs) -> None:
+        """Add attributes to the span."""
+        self.span.attrs.update(attrs)
+
+
+class Context:
+    """
+    A trace captured on one thread to be resumed on another. See :func:`capture`.
+    """
+    __slots__ = ('span', 'captured', '_released')
+
+    def __init__(self, span: _Span) -> None:
+        self.span = span
+        self.captured = time.perf_counter()
+        self._released = False
+        span.trace.acquire()
+
+    def release(self) -> None:
+        """
+        Give up on resuming this context. Only needed if it will never be passed to :func:`resume`.
+        """
+        with self.span.trace.lock:
+            if self._released:
+                return
+            self._released = True
+        self.span.trace.release()
+
+
+class _ResumeScope:
+    __slots__ = ('context', 'name', 'previous')
+
+    def __init__(self, context: Context, name: Optional[str]) -> None:
+        self.context = context
+        self.name = name
+
+    def __enter__(self) -> '_ResumeScope':
+        self.previous = getattr(_local, 'span', None)
+        span = self.context.span
+        if self.name is not None:
+            waited = _Span(span.trace, span, self.name, {}, start=self.context.captured)
+            waited.end = time.perf_counter()
+        _local.span = span
+        return self
+
+    def __exit__(self, *exc) -> None:
+        _local.span = self.previous
+        self.context.release()
+
+    def set(self, **attrs) -> None:
+        pass
+
+
+def start_trace(name: str, **attrs):
+    """
+    Start a new trace on this thread, if it's picked by sampling. If a trace is already active, this starts a span
+    within it instead.
+    """
+    parent = getattr(_local, 'span', None)
+    if parent is not None:
+        return _SpanScope(parent.trace, parent, name, attrs)
+    if _rate <= 0 or random.random() >= _rate:
+        return _NULL
+    return _SpanScope(_Trace(), None, name, attrs)
+
+
+def span(name: str, **attrs):
+    """
+    Time a ``with`` block as a span of the current trace. Does nothing if there isn't one.
+    """
+    parent = getattr(_local, 'span', None)
+    if parent is None:
+        return _NULL
+    return _SpanScope(parent.trace, parent, name, attrs)
+
+
+def record_span(name: str, start: float, end: float, **attrs) -> None:
+    """
+    Add a span that has already finished to the current trace, with times taken from :func:`time.perf_counter`.
+    """
+    parent = getattr(_local, 'span', None)
+    if parent is None:
+        return
+    recorded = _Span(parent.trace, parent, name, attrs, start=start)
+    recorded.end = end
+
+
+def capture() -> Optional[Context]:
+    """
+    :return: The current trace, to be passed to :func:`resume` on another thread, or None if there isn't one.
+    """
+    current = getattr(_local, 'span', None)
+    if current is None:
+        return None
+    return Context(current)
+
+
+def resume(context: Optional[Context], name: Optional[str] = None):
+    """
+    Continue a captured trace on this thread for the duration of a ``with`` block.
+
+    :param context: From :func:`capture`. If None, this does nothing.
+    :param name: If given, the time between capturing and resuming is recorded as a span with this name.
+    """
+    if context is None:
+        return _NULL
+    return _ResumeScope(context, name)
+
+
+def _write(trace: _Trace) -> None:
+    global _file
+    spans = trace.spans
+    # Spans recorded after the fact, like the request an update arrived in, can start before the trace itself.
+    started = min(x.start for x in spans)
+    line = json.dumps({'trace_id': trace.trace_id,
+                       'name': spans[0].name,
+                       'start': trace.wall - (trace.started - started),
+                       'duration_ms': round((max(x.end or x.start for x in spans) - started) * 1000, 3),
+                       'spans': [x.to_json(started) for x in spans]},
+                      default=str)
+    with _file_lock:
+        if _path is None:
+            return
+        try:
+            if _file is None:
+                _file = open(_path, 'a', encoding='utf-8')
+            _file.write(line + '\n')
+            _file.flush()
+        except OSError as e:
+            print(f"Couldn't write trace: {e}")
@@ -0,0 +1,130 @@
+"""
+How much lazy decoding saves over decoding every field up front, for the common case of a command check that only
+reads the first character of a message's text. Run from the top of the repository::
+
+    PYTHONPATH=. python tests/bench/bench_decode.py --before REV [--updates N]
+
+"Eager" is the message classes from before they were made lazy, which decoded everything in their constructors. They're
+read out of git at revision REV, which should be from before that change. "Lazy, tracked" reads what the tracking
+module does of every message. "Lazy, all read" is the worst case for the lazy classes, where every field ends up being
+read anyway.
+"""
+import argparse
+import copy
+import operator
+import os
+import subprocess
+import timeit
+import tracemalloc
+import types
+from typing import Any, Callable, Dict, List
+
+from horsefax.telegram.types import Message, _Field, _RawView
+
+
+def person(n: int) -> Dict[str, Any]:
+    """One of a few dozen people, who are always described the same way."""
+    n %= 40
+    return {'id': 100 + n, 'is_bot': False, 'first_name': f'Pony {n}', 'last_name': 'Pony', 'username': f'pony{n}',
+            'language_code': 'en'}
+
+
+def make_update(i: int) -> Dict[str, Any]:
+    """A text reply in a group, with an entity."""
+    original = {'message_id': i - 1, 'date': 1500000000 + i - 1, 'text': 'the message being replied to',
+                'chat': {'id': -1001, 'type': 'supergroup', 'title': 'Ponies'}, 'from': person(i - 1)}
+    return {'message_id': i, 'date': 1500000000 + i, 'text': '/roll 2d6 for initiative',
+            'chat': {'id': -1001, 'type': 'supergroup', 'title': 'Ponies'}, 'from': person(i),
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 5}],
+            'reply_to_message': original}
+
+
+_readers = {}  # type: Dict[type, Callable[[Any], Any]]
+
+
+def decode_everything(value: Any) -> None:
+    """Read every field of a view, and of every view in it."""
+    if isinstance(value, list):
+        for item in value:
+            decode_everything(item)
+    elif isinstance(value, _RawView):
+        read = _readers.get(type(value))
+        if read is None:
+            # Two of the same name so that the getter always returns a tuple.
+            names = [name for cls in type(value).__mro__ for name, field in vars(cls).items()
+                     if isinstance(field, _Field)]
+            read = _readers[type(value)] = operator.attrgetter(names[0], *names)
+        for item in read(value):
+            if isinstance(item, (list, _RawView)):
+                decode_everything(item)
+
+
+def load_eager(revision: str) -> types.ModuleType:
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    source = subprocess.check_output(['git', 'show', f'{revision}:horsefax/telegram/types.py'], cwd=root)
+    module = types.ModuleType('eager_types')
+    exec(compile(source, f'{revision}:horsefax/telegram/types.py', 'exec'), module.__dict__)
+    return module
+
+
+def lazy(update: Dict[str, Any]) -> Any:
+    message = Message.from_update(update)
+    message.text[0]
+    return message
+
+
+def lazy_tracked(update: Dict[str, Any]) -> Any:
+    # What TrackingModule reads, of the message and what it replies to.
+    message = Message.from_update(update)
+    for seen in (message, message.reply_to_message):
+        seen.message_id, seen.sender, seen.chat, seen.date, seen.forward_from, seen.edit_date, seen.reply_to_message
+    for entity in message.entities:
+        entity.type, entity.offset, entity.length, entity.url, entity.user
+    message.text[0]
+    return message
+
+
+def lazy_all_read(update: Dict[str, Any]) -> Any:
+    message = Message.from_update(update)
+    decode_everything(message)
+    message.text[0]
+    return message
+
+
+def measure(name: str, decode: Callable[[Dict[str, Any]], Any], updates: List[Dict[str, Any]]) -> None:
+    # Each run needs its own copies, or decoded values cached in the views would be shared.
+    batches = [copy.deepcopy(updates) for _ in range(5)]
+    seconds = min(timeit.repeat(lambda: [decode(x) for x in batches.pop()], number=1, repeat=5))
+    fresh = copy.deepcopy(updates)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [decode(x) for x in fresh]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(x.size_diff for x in after.compare_to(before, 'filename'))
+    print(f"{name:>14}: {seconds / len(updates) * 1e6:6.2f}us and {size / len(kept):6.0f}B per update")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare lazy and eager message decoding.")
+    parser.add_argument('--updates', type=int, default=20000)
+    parser.add_argument('--before', required=True,
+                        help="Revision to take the eager classes from, such as the parent of the commit that made "
+                             "decoding lazy")
+    args = parser.parse_args()
+    eager_types = load_eager(args.before)
+
+    def eager(update: Dict[str, Any]) -> Any:
+        message = eager_types.Message.from_update(update)
+        message.text[0]
+        return message
+
+    updates = [make_update(i) for i in range(1, args.updates + 1)]
+    measure('eager', eager, updates)
+    measure('lazy', lazy, updates)
+    measure('lazy, tracked', lazy_tracked, updates)
+    measure('lazy, all read', lazy_all_read, updates)
+
+
+if __name__ == '__main__':
+    main()
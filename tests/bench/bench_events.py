@@ -0,0 +1,134 @@
+"""
+Stress tests for ThreadedEventHandler, reporting throughput and checking nothing goes wrong under contention. Run from
+the top of the repository::
+
+    PYTHONPATH=. python tests/bench/bench_events.py [--seconds S] [--threads N] [--events E] [--maxsize M]
+
+The first part has threads broadcasting while others register, unregister and wait for handlers, and checks that no
+handler fails, is called after being unregistered, or is left registered. The second has threads broadcasting into a
+bounded queue under each QueuePolicy while one reader drains it in batches, and checks that BLOCK and SPILL lose
+nothing and keep each broadcaster's events in order. The exit status is non-zero if any check fails.
+"""
+import argparse
+import collections
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from horsefax.telegram.events import QueuePolicy
+from horsefax.telegram.events.threaded import ThreadedEventHandler
+
+
+def churn(seconds: float, threads: int) -> List[str]:
+    events = ThreadedEventHandler('bench')
+    stop = threading.Event()
+    calls = [0] * threads
+    problems = []  # type: List[str]
+
+    def count(i):
+        calls[i] += 1
+
+    def broadcaster(i: int) -> None:
+        events.register_handler('tick', lambda: count(i))
+        while not stop.is_set():
+            events.broadcast_event('tick')
+            events.broadcast_event('value', i)
+
+    def registrar(i: int) -> None:
+        while not stop.is_set():
+            unregistered = threading.Event()
+
+            def handler(value):
+                if unregistered.is_set():
+                    problems.append(f"handler called after being unregistered by registrar {i}")
+
+            handle = events.register_handler('value', handler)
+            events.unregister_handler(handle)
+            unregistered.set()
+            try:
+                events.wait_for_event('value', timeout=0.01)
+            except TimeoutError:
+                pass
+
+    workers = [threading.Thread(target=broadcaster, args=(i,)) for i in range(threads)]
+    workers += [threading.Thread(target=registrar, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    time.sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+
+    total = sum(calls)
+    failures = sum(x.failures for x in events.handler_stats())
+    leaked = len(events.handler_stats()) - threads
+    print(f"churn: {total:,} handler calls in {seconds}s ({total / seconds:,.0f}/s), {failures} failures, "
+          f"{leaked} leaked registrations")
+    if failures:
+        problems.append(f"{failures} handler failures")
+    if leaked:
+        problems.append(f"{leaked} registrations left behind")
+    return problems
+
+
+def queued(policy: QueuePolicy, threads: int, per_thread: int, maxsize: int) -> List[str]:
+    events = ThreadedEventHandler('bench')
+    queue = events.queue_events('item', maxsize=maxsize, policy=policy)
+    received = []  # type: List[Tuple[int, int]]
+    peak_spilled = 0
+
+    def broadcaster(i: int) -> None:
+        for n in range(per_thread):
+            events.broadcast_event('item', (i, n))
+
+    workers = [threading.Thread(target=broadcaster, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    while any(x.is_alive() for x in workers) or queue.items:
+        # Read slowly enough that the queue fills up and the policy has something to do.
+        received.extend(queue.get_many(max_items=maxsize // 2 or 1, max_wait=0.01))
+        if queue._spill is not None:
+            peak_spilled = max(peak_spilled, queue._spill.count)
+    for worker in workers:
+        worker.join()
+    received.extend(queue.get_many(max_items=threads * per_thread, max_wait=0.1))
+    elapsed = time.perf_counter() - start
+    queue.close()
+
+    sent = threads * per_thread
+    print(f"{policy.name.lower():>11}: {len(received):,} of {sent:,} events in {elapsed:.2f}s "
+          f"({len(received) / elapsed:,.0f}/s), {queue.dropped:,} dropped, at most {peak_spilled:,} spilled")
+    problems = []
+    latest = collections.defaultdict(lambda: -1)  # type: Dict[int, int]
+    for i, n in received:
+        if n <= latest[i]:
+            problems.append(f"{policy.name}: broadcaster {i}'s event {n} came after {latest[i]}")
+            break
+        latest[i] = n
+    if policy is not QueuePolicy.DROP_OLDEST and len(received) != sent:
+        problems.append(f"{policy.name}: lost {sent - len(received)} events")
+    if policy is QueuePolicy.DROP_OLDEST and len(received) + queue.dropped != sent:
+        problems.append(f"{policy.name}: {sent - len(received) - queue.dropped} events unaccounted for")
+    return problems
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Stress the threaded event handler.")
+    parser.add_argument('--seconds', type=float, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--events', type=int, default=20000, help="Events per broadcaster in the queue tests")
+    parser.add_argument('--maxsize', type=int, default=100)
+    args = parser.parse_args()
+
+    problems = churn(args.seconds, args.threads)
+    for policy in QueuePolicy:
+        problems += queued(policy, args.threads, args.events, args.maxsize)
+    for problem in problems:
+        print(f"FAILED: {problem}")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+An in-memory SQLite database, and stand-ins for the bot, for testing the modules that keep data. Pony maps tables once
+per process, so every test shares the one database; :func:`fresh_database` empties it.
+"""
+import time
+from enum import Enum
+from unittest import mock
+
+from pony.orm import *
+from typing import Any, Dict, List, Optional, Tuple
+
+from horsefax.bot.db import db, EnumConverter
+from horsefax.bot.search import SearchIndex, SQLiteSearchIndex
+from horsefax.telegram.types import Message
+# Everything with tables has to be imported before the tables are mapped.
+from horsefax.bot import checkpoint
+from horsefax.bot.modules import aliases, archive, chatstats, collections, groups, madlib, tracking
+
+
+def fresh_database() -> None:
+    if db.provider is None:
+        db.bind('sqlite', ':memory:')
+        db.provider.converter_classes.append((Enum, EnumConverter))
+        db.generate_mapping(create_tables=True)
+        return
+    with db_session:
+        for table in (SearchIndex.TABLE, SQLiteSearchIndex.KEYS):
+            db.execute(f'DROP TABLE IF EXISTS {db.provider.quote_name(table)}')
+    db.drop_all_tables(with_all_data=True)
+    db.create_tables()
+
+
+class FakeTelegram:
+    def register_handler(self, event, handler, **kwargs) -> None:
+        pass
+
+
+class FakeTools:
+    def register_command(self, name, handler, **kwargs) -> None:
+        pass
+
+
+class FakeBot:
+    def __init__(self) -> None:
+        self.telegram = FakeTelegram()
+        self.modules = {}  # type: Dict[str, Any]
+        self.sent = []  # type: List[Tuple[int, str]]
+
+    def message(self, chat, text, **kwargs) -> None:
+        self.sent.append((chat.id, text))
+
+
+def load(module_class, bot: FakeBot, name: str, **kwargs) -> Any:
+    """Load a module as `name`, without starting its background thread."""
+    with mock.patch.object(module_class, '_run', create=True):
+        module = module_class(bot, FakeTools(), **kwargs)
+    bot.modules[name] = module
+    return module
+
+
+def update(message_id: int, chat_id: int = -1, sender: int = 1, date: Optional[float] = None,
+           text: Optional[str] = 'hello', **fields) -> Dict[str, Any]:
+    """:return: A message as Telegram would send it."""
+    message = {'message_id': message_id, 'date': int(date if date is not None else time.time()),
+               'chat': {'id': chat_id, 'type': 'group', 'title': f'Group {chat_id}'},
+               'from': {'id': sender, 'first_name': f'User {sender}', 'is_bot': False}}
+    if text is not None:
+        message['text'] = text
+    message.update(fields)
+    return message
+
+
+def message(*args, **kwargs) -> Message:
+    return Message.from_update(update(*args, **kwargs))
@@ -0,0 +1,49 @@
+import shutil
+import tempfile
+import time
+import unittest
+
+from pony.orm import *
+
+from horsefax.bot.modules.archive import ArchiveModule
+from horsefax.bot.modules.chatstats import ChatActivity, ChatStatsModule
+from horsefax.bot.modules.tracking import TelegramMessage, TrackingModule
+from .database import FakeBot, fresh_database, load, message, update
+
+
+class ArchiveModuleTest(unittest.TestCase):
+    def setUp(self):
+        fresh_database()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.bot = FakeBot()
+        self.tracking = load(TrackingModule, self.bot, 'tracking', batch=1000, interval=1000, search=True)
+        load(ChatStatsModule, self.bot, 'chatstats')
+
+    def state(self):
+        with db_session:
+            logged = set(select((m.chat.id, m.id) for m in TelegramMessage))
+            counted = sum(x.messages for x in ChatActivity)
+            found = [x.id for x in self.tracking.search_index.search(-1, 'old', 10)]
+        archived = [x['id'] for x in self.archive.iter_messages() if (x['chat'], x['id']) not in logged]
+        return logged, counted, found, archived
+
+    def test_archived_message_seen_again(self):
+        old = update(1, date=time.time() - 60 * 86400, text='an old message')
+        self.tracking.handle_message(message(**old))
+        self.tracking.flush()
+        self.archive = load(ArchiveModule, self.bot, 'archive', hot_days=30, directory=self.directory)
+        self.assertEqual(self.archive.archive_old_messages(), 1)
+        self.assertEqual(self.state(), (set(), 1, [1], [1]))
+
+        # As though the update it came in was handled again.
+        self.tracking.handle_message(message(**old))
+        self.tracking.flush()
+        self.tracking.handle_message(message(2, text='a reply', reply_to_message=old))
+        self.tracking.flush()
+        self.assertEqual(self.archive.archive_old_messages(), 0)
+        self.assertEqual(self.state(), ({(-1, 2)}, 2, [1], [1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+from horsefax.telegram.cache import RotatingBloomFilter
+
+
+class RotatingBloomFilterTest(unittest.TestCase):
+    def test_covers_from_start(self):
+        bloom = RotatingBloomFilter(100)
+        self.assertFalse(bloom.covers(0))
+        for i in range(50):
+            bloom.add(i, 10 + i)
+        bloom.start(10)
+        self.assertTrue(bloom.covers(10))
+        self.assertFalse(bloom.covers(9))
+        self.assertIn(49, bloom)
+
+    def test_warm_up_past_capacity(self):
+        # Loading more than every generation can hold forgets the oldest, so coverage can't start where asked.
+        bloom = RotatingBloomFilter(10, generations=2)
+        for i in range(35):
+            bloom.add(i, 100 + i)
+        bloom.start(100)
+        self.assertFalse(bloom.covers(100))
+        self.assertFalse(bloom.covers(119))
+        self.assertTrue(bloom.covers(120))
+        for i in range(20, 35):
+            self.assertIn(i, bloom)
+
+    def test_rotation_after_start(self):
+        bloom = RotatingBloomFilter(10, generations=2)
+        bloom.start(0)
+        for i in range(25):
+            bloom.add(i, i)
+        self.assertFalse(bloom.covers(9))
+        self.assertTrue(bloom.covers(10))
+
+
+if __name__ == '__main__':
+    unittest.main()
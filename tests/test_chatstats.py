@@ -0,0 +1,63 @@
+import shutil
+import tempfile
+import time
+import unittest
+
+from pony.orm import *
+
+from horsefax.bot.modules.archive import ArchiveModule
+from horsefax.bot.modules.chatstats import ChatActivity, ChatStatsModule, ChatTally
+from horsefax.bot.modules.tracking import TrackingModule
+from .database import FakeBot, fresh_database, load, message
+
+DAY = 86400
+
+
+def sticker(file_id: str, emoji: str):
+    return {'file_id': file_id, 'width': 512, 'height': 512, 'emoji': emoji}
+
+
+class ChatStatsModuleTest(unittest.TestCase):
+    def setUp(self):
+        fresh_database()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.bot = FakeBot()
+        self.tracking = load(TrackingModule, self.bot, 'tracking', batch=1000, interval=1000)
+        self.stats = load(ChatStatsModule, self.bot, 'chatstats')
+
+    def track(self, *messages) -> None:
+        for x in messages:
+            self.tracking.handle_message(x)
+        self.tracking.flush()
+
+    @db_session
+    def rollups(self):
+        activity = {(x.chat, x.day, x.user): (x.messages, x.kinds, x.hours) for x in ChatActivity.select()}
+        tallies = {(x.chat, x.day, x.kind, x.key): (x.label, x.uses) for x in ChatTally.select()}
+        return activity, tallies
+
+    def test_counted_as_logged_matches_rebuild(self):
+        now = time.time()
+        self.track(message(1, date=now - 60 * DAY, text='old news 🐴'),
+                   message(2, date=now - 60 * DAY, sender=2, text=None, sticker=sticker('a', '🐴')))
+        self.archive = load(ArchiveModule, self.bot, 'archive', hot_days=30, directory=self.directory)
+        self.assertEqual(self.archive.archive_old_messages(), 2)
+        # Spread over two chats, a few days and hours, and several kinds of message.
+        self.track(message(3, date=now - 2 * DAY, text='hi 🌈🌈'),
+                   message(4, date=now - 2 * DAY + 3600, sender=2, text=None, sticker=sticker('a', '🐴')),
+                   message(5, date=now - DAY, sender=2, text=None, sticker=sticker('b', '⭐')))
+        self.track(message(6, date=now, text='👍'),
+                   message(1, chat_id=-2, date=now, sender=3),
+                   message(2, chat_id=-2, date=now, sender=3, text=None,
+                           photo=[{'file_id': 'p', 'width': 90, 'height': 90}], caption='🌈'))
+        counted = self.rollups()
+        self.assertEqual(sum(x[0] for x in counted[0].values()), 8)
+        self.assertEqual(sum(v[1] for k, v in counted[1].items() if k[2:] == ('sticker', 'a')), 2)
+
+        self.assertEqual(self.stats.rebuild(), 8)
+        self.assertEqual(self.rollups(), counted)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import contextlib
+import io
+import unittest
+from unittest import mock
+
+from pony.orm import *
+
+from horsefax.bot.checkpoint import DatabaseOffsetStore, HandledUpdate, UpdateOffset
+from .database import fresh_database
+
+
+class _Stop(BaseException):
+    pass
+
+
+class DatabaseOffsetStoreTest(unittest.TestCase):
+    def setUp(self):
+        fresh_database()
+
+    def saved(self):
+        with db_session:
+            row = UpdateOffset.get(name='telegram')
+            return row and row.offset, set(select(x.id for x in HandledUpdate))
+
+    def test_failed_write_is_retried(self):
+        store = DatabaseOffsetStore()
+        store.record(10, 12)
+        with mock.patch.object(UpdateOffset, 'get', side_effect=OperationalError(Exception('database is locked'))):
+            with self.assertRaises(OperationalError):
+                store.flush()
+        self.assertEqual(self.saved(), (None, set()))
+        store.flush()
+        self.assertEqual(self.saved(), (10, {12}))
+
+    def test_run_survives_a_failed_write(self):
+        store = DatabaseOffsetStore(interval=0)
+        errors = [RuntimeError('database is locked'), _Stop()]
+        with mock.patch.object(store, 'flush', side_effect=errors) as flush, \
+                contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaises(_Stop):
+                store._run()
+        self.assertEqual(flush.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
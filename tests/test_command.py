@@ -0,0 +1,50 @@
+import threading
+import unittest
+from types import SimpleNamespace
+
+from horsefax.telegram.services.command import CommandService
+from horsefax.telegram.types import Message
+
+
+class _FakeTelegram:
+    user = SimpleNamespace(username='horsefaxbot')
+
+    def register_handler(self, event, handler, **kwargs):
+        pass
+
+
+def _message(text: str) -> Message:
+    return Message.from_update({'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'group', 'title': 'G'},
+                                'from': {'id': 2, 'first_name': 'A', 'is_bot': False}, 'text': text})
+
+
+class CommandServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.commands = CommandService(_FakeTelegram())
+
+    def test_queued_commands_are_routed(self):
+        queue = self.commands.queue_events('ping')
+        self.commands.handle_message(_message('/PING now'))
+        command = queue.get(timeout=1)
+        self.assertEqual((command.command, command.args), ('ping', ['now']))
+        queue.close()
+        self.assertIsNone(self.commands.router.resolve('ping'))
+
+    def test_waited_for_commands_are_routed(self):
+        result = []
+        waiter = threading.Thread(target=lambda: result.append(self.commands.wait_for_event('ping', timeout=5)))
+        waiter.start()
+        for _ in range(100):
+            if self.commands.router.resolve('ping') is not None:
+                break
+            waiter.join(0.01)
+        else:
+            self.fail("The wait was never routed")
+        self.commands.handle_message(_message('/ping'))
+        waiter.join()
+        self.assertEqual(result[0].command, 'ping')
+        self.assertIsNone(self.commands.router.resolve('ping'))
+
+
+if __name__ == '__main__':
+    unittest.main()
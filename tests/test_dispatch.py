@@ -0,0 +1,61 @@
+import threading
+import time
+import unittest
+
+from horsefax.telegram.connections.dispatch import UpdateDispatcher
+
+
+def _update(update_id: int, chat_id: int = 1) -> dict:
+    return {'update_id': update_id, 'message': {'message_id': update_id, 'chat': {'id': chat_id}}}
+
+
+class UpdateDispatcherTest(unittest.TestCase):
+    def dispatcher(self, **kwargs) -> UpdateDispatcher:
+        self.handled = []
+        dispatcher = UpdateDispatcher(lambda x: self.handled.append(x['update_id']), workers=0, **kwargs)
+        dispatcher.start()
+        return dispatcher
+
+    def test_polled_repeats_are_skipped(self):
+        dispatcher = self.dispatcher()
+        for update_id in (10, 11, 11, 10, 12):
+            dispatcher.submit(_update(update_id))
+        self.assertEqual(self.handled, [10, 11, 12])
+        self.assertEqual(dispatcher.committed, 12)
+
+    def test_pushed_out_of_order(self):
+        dispatcher = self.dispatcher(pushed=True)
+        dispatcher.submit(_update(11))
+        dispatcher.submit(_update(10))
+        self.assertEqual(self.handled, [11, 10])
+        self.assertEqual(dispatcher.committed, 11)
+
+    def test_pushed_repeats_are_skipped(self):
+        dispatcher = self.dispatcher(pushed=True)
+        for update_id in (11, 10, 11, 10, 9):
+            dispatcher.submit(_update(update_id))
+        self.assertEqual(self.handled, [11, 10, 9])
+
+    def test_stop_waits_for_updates_in_flight(self):
+        handled = []
+        started = threading.Event()
+
+        def handler(update):
+            started.set()
+            time.sleep(0.2)
+            handled.append(update['update_id'])
+
+        dispatcher = UpdateDispatcher(handler, workers=2)
+        dispatcher.start()
+        self.assertTrue(dispatcher.submit(_update(1)))
+        started.wait(5)
+        dispatcher.stop()
+        self.assertEqual(handled, [1])
+        self.assertEqual(dispatcher.committed, 1)
+        # Left for Telegram to deliver again.
+        self.assertFalse(dispatcher.submit(_update(2)))
+        self.assertEqual(dispatcher.committed, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+import contextlib
+import io
+import threading
+import time
+import unittest
+
+from horsefax.telegram.events import ExecutionMode, QueuePolicy
+from horsefax.telegram.events.threaded import HANDLER_TIMEOUTS, ThreadedEventHandler, set_pool_size
+
+
+class EventQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.events = ThreadedEventHandler()
+
+    def broadcast(self, *items):
+        for x in items:
+            self.events.broadcast_event('update', x)
+
+    def test_drop_oldest(self):
+        queue = self.events.queue_events('update', maxsize=2, policy=QueuePolicy.DROP_OLDEST)
+        self.broadcast(1, 2, 3, 4)
+        self.assertEqual(queue.get_many(10, 0), [3, 4])
+        self.assertEqual(queue.dropped, 2)
+
+    def test_block(self):
+        queue = self.events.queue_events('update', maxsize=1, policy=QueuePolicy.BLOCK)
+        self.broadcast(1)
+        broadcaster = threading.Thread(target=self.broadcast, args=(2, 3))
+        broadcaster.start()
+        broadcaster.join(0.1)
+        self.assertTrue(broadcaster.is_alive())
+        self.assertEqual([queue.get(), queue.get(), queue.get()], [1, 2, 3])
+        broadcaster.join(1)
+        self.assertFalse(broadcaster.is_alive())
+
+    def test_close_releases_blocked_broadcaster(self):
+        queue = self.events.queue_events('update', maxsize=1, policy=QueuePolicy.BLOCK)
+        self.broadcast(1)
+        broadcaster = threading.Thread(target=self.broadcast, args=(2,))
+        broadcaster.start()
+        broadcaster.join(0.1)
+        queue.close()
+        broadcaster.join(1)
+        self.assertFalse(broadcaster.is_alive())
+        self.assertEqual(list(queue), [1])
+        self.assertNotIn('update', self.events.registered_events())
+
+    def test_spill(self):
+        queue = self.events.queue_events('update', maxsize=2, policy=QueuePolicy.SPILL)
+        self.broadcast(1, 2, 3, 4)
+        self.assertEqual(len(queue.items), 2)
+        self.assertEqual(queue.get(), 1)
+        # Anything arriving while there's still some spilled has to go after it.
+        self.broadcast(5)
+        self.assertEqual(queue.get_many(10, 0), [2, 3, 4, 5])
+        self.broadcast(6)
+        self.assertEqual(queue.get(), 6)
+        self.assertEqual(queue.dropped, 0)
+
+    def test_get_many(self):
+        queue = self.events.queue_events('update')
+        self.broadcast(1, 2, 3, 4, 5)
+        self.assertEqual(queue.get_many(3, 0), [1, 2, 3])
+        # Returns what there is once the wait is over.
+        start = time.monotonic()
+        self.assertEqual(queue.get_many(3, 0.1), [4, 5])
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        self.assertEqual(queue.get_many(3, 0), [])
+        # Returns as soon as the batch is full.
+        threading.Timer(0.05, self.broadcast, args=(6, 7)).start()
+        start = time.monotonic()
+        self.assertEqual(queue.get_many(2, 5), [6, 7])
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_iteration(self):
+        queue = self.events.queue_events('update')
+        self.broadcast(1, 2)
+        threading.Timer(0.05, queue.close).start()
+        self.assertEqual(list(queue), [1, 2])
+        with self.assertRaises(TimeoutError):
+            queue.get(timeout=None)
+
+
+class EventWaitTest(unittest.TestCase):
+    def setUp(self):
+        self.events = ThreadedEventHandler()
+        self.events.set_event_key('message', lambda x: (x['chat'], x['user']))
+
+    def message(self, chat, user):
+        message = {'chat': chat, 'user': user}
+        self.events.broadcast_event('message', message)
+        return message
+
+    def test_waiter_matches_its_own_key(self):
+        handled = []
+        self.events.register_handler('message', handled.append)
+        first = self.events.expect_event('message', (-1, 1))
+        second = self.events.expect_event('message', (-1, 1))
+        other = self.events.expect_event('message', (-2, 1))
+        self.message(-1, 2)
+        self.message(-2, 2)
+        self.assertFalse(any(x.done() for x in (first, second, other)))
+        expected = self.message(-1, 1)
+        self.assertEqual((first.result(0), second.result(0)), (expected, expected))
+        self.assertFalse(other.done())
+        # Handlers still see everything.
+        self.assertEqual(len(handled), 3)
+        self.assertEqual(list(self.events._waiters['message']), [(-2, 1)])
+
+    def test_wait_for_event_with_key(self):
+        threading.Timer(0.05, self.message, args=(-1, 2)).start()
+        threading.Timer(0.1, self.message, args=(-1, 1)).start()
+        self.assertEqual(self.events.wait_for_event('message', timeout=5, key=(-1, 1)), {'chat': -1, 'user': 1})
+
+    def test_key_needs_a_key_function(self):
+        with self.assertRaises(ValueError):
+            self.events.expect_event('update', 1)
+
+    def test_timed_out_waiter_cleaned_up(self):
+        waiting = self.events.expect_event('message', (-1, 1), timeout=0.05)
+        self.assertIsInstance(waiting.exception(5), TimeoutError)
+        self.assertEqual(self.events._waiters['message'], {})
+        # Too late to count.
+        self.message(-1, 1)
+        self.assertIsInstance(waiting.exception(0), TimeoutError)
+        with self.assertRaises(TimeoutError):
+            self.events.wait_for_event('message', timeout=0.05, key=(-1, 1))
+        self.assertEqual(self.events._waiters['message'], {})
+
+    def test_timed_out_wait_unregistered(self):
+        with self.assertRaises(TimeoutError):
+            self.events.wait_for_event('update', timeout=0.05)
+        self.assertEqual(self.events.registered_events(), set())
+        self.assertEqual(self.events.handler_stats(), [])
+
+
+class HandlerTimeoutTest(unittest.TestCase):
+    def test_abandoned_handler_reported(self):
+        events = ThreadedEventHandler()
+        release = threading.Event()
+        self.addCleanup(release.set)
+        handle = events.register_handler('slow', lambda x: release.wait(5), mode=ExecutionMode.THREAD, timeout=0.05)
+        abandoned = HANDLER_TIMEOUTS.labels('slow', 'abandoned')
+        before = abandoned.value
+        with contextlib.redirect_stdout(io.StringIO()):
+            events.broadcast_event('slow', 1)
+            deadline = time.monotonic() + 5
+            while events.handler_stats()[0].timeouts == 0 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(events.handler_stats()[0][3:], (1, 0, 1))
+        self.assertEqual(abandoned.value, before + 1)
+        events.unregister_handler(handle)
+        self.assertEqual(events.handler_stats(), [])
+
+    def test_pool_size_set_before_use(self):
+        events = ThreadedEventHandler()
+        ran = threading.Event()
+        events.register_handler('event', lambda: ran.set(), mode=ExecutionMode.THREAD)
+        events.broadcast_event('event')
+        self.assertTrue(ran.wait(5))
+        with self.assertRaises(ValueError):
+            set_pool_size(ExecutionMode.THREAD, 4)
+        with self.assertRaises(ValueError):
+            set_pool_size(ExecutionMode.INLINE, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import contextlib
+import io
+import unittest
+from unittest import mock
+
+from horsefax.telegram.exceptions import RateLimitedError, TelegramError
+from horsefax.telegram.services.chat import ChatService
+from horsefax.telegram.services.outbound import OutboundQueue, TokenBucket
+from horsefax.telegram.types import Chat, Message
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class FakeConnection:
+    """Answers each request with what it was sent, unless told to fail it."""
+    def __init__(self) -> None:
+        self.sent = []
+        self.failures = []
+
+    def send(self, endpoint, params):
+        self.sent.append((endpoint, params))
+        if self.failures:
+            failure = self.failures.pop(0)
+            if failure is not None:
+                raise failure
+        return {'endpoint': endpoint, **params}
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(2, 3, now=0)
+        for _ in range(3):
+            self.assertEqual(bucket.delay(0), 0)
+            bucket.take(0)
+        self.assertEqual(bucket.delay(0), 0.5)
+        self.assertEqual(bucket.delay(0.25), 0.25)
+        self.assertEqual(bucket.delay(0.5), 0)
+        bucket.take(0.5)
+        self.assertFalse(bucket.full(1))
+        self.assertTrue(bucket.full(2))
+        # It never holds more than its capacity.
+        self.assertTrue(bucket.full(100))
+        for _ in range(3):
+            bucket.take(100)
+        self.assertEqual(bucket.delay(100), 0.5)
+
+
+class OutboundQueueTest(unittest.TestCase):
+    """
+    Drives the queue a step at a time with a fake clock, as its background thread would, rather than running that
+    thread.
+    """
+    def setUp(self):
+        self.clock = FakeClock()
+        self.connection = FakeConnection()
+        patcher = mock.patch.object(OutboundQueue, '_run')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.queue = OutboundQueue(self.connection, workers=1, global_rate=2, private_rate=1, group_rate=0.5,
+                                   burst=2, clock=self.clock)
+
+    def enqueue(self, chat_id, text):
+        return self.queue.enqueue(chat_id, 'sendMessage', {'chat_id': chat_id, 'text': text})
+
+    def step(self):
+        """
+        :return: The chat and text of the next request that can be sent now, having sent it; or else how long until
+                 there might be one.
+        """
+        with self.queue._lock:
+            ready = self.queue._next_ready(self.clock.now)
+        if not isinstance(ready, tuple):
+            return ready
+        chat_id, request = ready
+        self.queue._send(chat_id, request)
+        return chat_id, request[1]['text']
+
+    def test_chats_in_order_and_within_limits(self):
+        futures = [self.enqueue(-1, 'a'), self.enqueue(-1, 'b'), self.enqueue(-1, 'c'), self.enqueue(5, 'd'),
+                   self.enqueue(6, 'e')]
+        # Each chat's burst, within the overall burst of two.
+        self.assertEqual(self.step(), (-1, 'a'))
+        self.assertEqual(self.step(), (5, 'd'))
+        # The overall limit is two a second, and chats take turns.
+        self.assertEqual(self.step(), 0.5)
+        self.clock.now += 0.5
+        self.assertEqual(self.step(), (6, 'e'))
+        self.assertEqual(self.step(), 0.5)
+        self.clock.now += 0.5
+        self.assertEqual(self.step(), (-1, 'b'))
+        # The group's burst is used up, and it gets a message every two seconds after that.
+        self.assertEqual(self.step(), 1)
+        self.clock.now += 1
+        self.assertEqual(self.step(), (-1, 'c'))
+        self.assertIsNone(self.step())
+        self.assertEqual([x.result(0)['text'] for x in futures], ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual([x[1]['text'] for x in self.connection.sent], ['a', 'd', 'e', 'b', 'c'])
+
+    def test_rate_limited_request_retried(self):
+        self.connection.failures = [RateLimitedError(30)]
+        first, second = self.enqueue(5, 'a'), self.enqueue(5, 'b')
+        other = self.enqueue(6, 'c')
+        self.assertEqual(self.step(), (5, 'a'))
+        self.assertFalse(first.done())
+        # Other chats carry on meanwhile.
+        self.assertEqual(self.step(), (6, 'c'))
+        self.assertEqual(self.step(), 30)
+        self.clock.now += 29
+        self.assertEqual(self.step(), 1)
+        self.clock.now += 1
+        # Still in order.
+        self.assertEqual(self.step(), (5, 'a'))
+        self.assertEqual(self.step(), (5, 'b'))
+        self.assertEqual((first.result(0)['text'], second.result(0)['text'], other.result(0)['text']),
+                         ('a', 'b', 'c'))
+
+    def test_failed_request_not_retried(self):
+        self.connection.failures = [TelegramError("Bad Request: chat not found")]
+        first, second = self.enqueue(5, 'a'), self.enqueue(5, 'b')
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(self.step(), (5, 'a'))
+        self.assertEqual(self.step(), (5, 'b'))
+        self.assertIsInstance(first.exception(0), TelegramError)
+        self.assertEqual(second.result(0)['text'], 'b')
+        self.assertEqual(len(self.connection.sent), 2)
+
+
+class FakeTelegram:
+    def __init__(self) -> None:
+        self.connection = FakeConnection()
+
+
+class ChatServiceTest(unittest.TestCase):
+    def test_message(self):
+        telegram = FakeTelegram()
+        chat = ChatService(telegram, workers=1)
+        reply_to = Message.from_update({'message_id': 7, 'date': 0, 'chat': {'id': -1, 'type': 'group'},
+                                        'text': 'hello'})
+        future = chat.message(Chat({'id': -1, 'type': 'group'}), "hi", parsing=ChatService.ParseMode.HTML,
+                              reply_to=reply_to)
+        self.assertEqual(future.result(5), {'endpoint': 'sendMessage', 'chat_id': -1, 'text': 'hi',
+                                            'disable_web_page_preview': False, 'disable_notification': False,
+                                            'parse_mode': 'HTML', 'reply_to': 7})
+        self.assertEqual(len(telegram.connection.sent), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
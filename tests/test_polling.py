@@ -0,0 +1,31 @@
+import unittest
+from unittest import mock
+
+from horsefax.telegram.connections.polling import LongPollingConnection
+from horsefax.telegram.exceptions import RateLimitedError
+
+
+class LongPollingConnectionTest(unittest.TestCase):
+    def test_rate_limited_poll_is_retried(self):
+        handled = []
+        connection = LongPollingConnection('token', lambda x: handled.append(x['update_id']), workers=0)
+        responses = [RateLimitedError(7), [{'update_id': 1, 'message': {'chat': {'id': 1}}}]]
+
+        def request(endpoint, **kwargs):
+            if not responses:
+                connection.disconnect()
+                return []
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        with mock.patch.object(connection, 'request', side_effect=request), \
+                mock.patch('horsefax.telegram.connections.polling.time.sleep') as sleep:
+            connection.run()
+        sleep.assert_called_once_with(7)
+        self.assertEqual(handled, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
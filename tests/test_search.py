@@ -0,0 +1,59 @@
+import datetime
+import unittest
+
+from dateutil.tz import tzutc
+from pony.orm import *
+
+from horsefax.bot.db import db
+from horsefax.bot.search import SQLiteSearchIndex, create_index
+from .database import fresh_database
+
+
+def _entry(message_id: int, text: str, chat_id: int = -1):
+    return chat_id, message_id, 1, datetime.datetime(2020, 1, 1, 12, message_id % 60, tzinfo=tzutc()), text
+
+
+class SQLiteSearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        fresh_database()
+
+    def found(self, terms: str, chat_id: int = -1):
+        with db_session:
+            return [(x.id, x.text) for x in create_index().search(chat_id, terms, 10)]
+
+    def test_add_and_search(self):
+        with db_session:
+            create_index().add([_entry(1, 'ponies are great'), _entry(2, 'great scott'), _entry(3, 'ponies!'),
+                                _entry(4, 'ponies elsewhere', chat_id=-2)])
+        self.assertEqual(sorted(self.found('ponies')), [(1, 'ponies are great'), (3, 'ponies!')])
+        self.assertEqual(self.found('GREAT ponies'), [(1, 'ponies are great')])
+        self.assertEqual(self.found('ponies', chat_id=-2), [(4, 'ponies elsewhere')])
+        self.assertEqual(self.found('"); DROP TABLE'), [])
+        self.assertEqual(self.found('scott'), [(2, 'great scott')])
+
+    def test_add_again(self):
+        with db_session:
+            create_index().add([_entry(1, 'ponies are great'), _entry(2, 'great scott')])
+        with db_session:
+            create_index().add([_entry(1, 'ponies are great'), _entry(1, 'ponies are great'),
+                                _entry(2, 'great ponies')])
+        self.assertEqual(sorted(self.found('ponies')), [(1, 'ponies are great'), (2, 'great ponies')])
+        self.assertEqual(self.found('scott'), [])
+
+    def test_keys_added_to_existing_index(self):
+        with db_session:
+            index = create_index()
+            index.add([_entry(1, 'ponies')])
+            # As though indexed twice before there were keys.
+            db.execute(f'DROP TABLE {index.keys}')
+            db.execute(f"INSERT INTO {index.table} (chat, id, sender, date, text) "
+                       f"VALUES (-1, 1, 1, '2020-01-01T12:00:00+00:00', 'ponies')")
+        self.assertEqual(self.found('ponies'), [(1, 'ponies')])
+        with db_session:
+            create_index().add([_entry(1, 'changed')])
+        self.assertEqual(self.found('ponies'), [])
+        self.assertEqual(self.found('changed'), [(1, 'changed')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import contextlib
+import io
+import unittest
+from unittest import mock
+
+from pony.orm import *
+
+from horsefax.bot.modules.tracking import TelegramChat, TelegramMessage, TelegramUser, TrackingModule
+from .database import FakeBot, fresh_database, load, message
+
+
+class TrackingModuleTest(unittest.TestCase):
+    def setUp(self):
+        fresh_database()
+        self.bot = FakeBot()
+        self.tracking = self.load()
+
+    def load(self, **kwargs) -> TrackingModule:
+        return load(TrackingModule, self.bot, 'tracking', batch=1000, interval=1000, **kwargs)
+
+    def track(self, *messages) -> None:
+        for x in messages:
+            self.tracking.handle_message(x)
+        self.tracking.flush()
+
+    @db_session
+    def logged(self):
+        return set(select(m.id for m in TelegramMessage))
+
+    @db_session
+    def members(self, chat_id: int = -1):
+        return set(select(u.id for c in TelegramChat for u in c.users if c.id == chat_id))
+
+    def test_message_logged_once(self):
+        self.track(message(1), message(2))
+        self.track(message(1), message(3))
+        # Starting afresh, with nothing remembered about what's been logged.
+        self.tracking = self.load()
+        self.track(message(2), message(3))
+        with db_session:
+            self.assertEqual(count(m for m in TelegramMessage), 3)
+
+    def test_bad_message_given_up_on(self):
+        self.tracking = self.load(max_attempts=2)
+        log_message = self.tracking._log_message
+
+        def fail_on_two(item, *args):
+            if item.message_id == 2:
+                raise ValueError("can't save this one")
+            return log_message(item, *args)
+
+        with mock.patch.object(self.tracking, '_log_message', side_effect=fail_on_two), \
+                contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            self.track(message(1), message(2), message(3))
+            self.assertEqual(self.logged(), {1, 3})
+            self.assertEqual(list(self.tracking.dead_letters), [])
+            self.assertEqual(len(self.tracking._pending), 1)
+            self.track(message(4))
+        self.assertEqual(self.logged(), {1, 3, 4})
+        self.assertEqual([x.message_id for x in self.tracking.dead_letters], [2])
+        self.assertTrue(self.tracking._pending.empty())
+
+    def test_unchanged_users_and_chats_not_saved(self):
+        self.track(message(1))
+        with db_session:
+            TelegramUser[1].first_name = 'Edited'
+            TelegramChat[-1].title = 'Edited'
+        self.track(message(2))
+        with db_session:
+            self.assertEqual((TelegramUser[1].first_name, TelegramChat[-1].title), ('Edited', 'Edited'))
+        self.track(message(3, **{'from': {'id': 1, 'first_name': 'Renamed', 'is_bot': False},
+                                 'chat': {'id': -1, 'type': 'group', 'title': 'Renamed'}}))
+        with db_session:
+            self.assertEqual((TelegramUser[1].first_name, TelegramChat[-1].title), ('Renamed', 'Renamed'))
+
+    def test_membership_removal(self):
+        self.track(message(1, sender=1), message(2, sender=2))
+        self.assertEqual(self.members(), {1, 2})
+        self.track(message(3, sender=2, text=None, left_chat_member={'id': 2, 'first_name': 'B', 'is_bot': False}))
+        self.assertEqual(self.members(), {1})
+        # Known to have left, so talking again has to add them back.
+        self.track(message(4, sender=2))
+        self.assertEqual(self.members(), {1, 2})
+        # Talking and leaving in the same batch.
+        self.track(message(5, sender=3),
+                   message(6, sender=3, text=None, left_chat_member={'id': 3, 'first_name': 'C', 'is_bot': False}))
+        self.assertEqual(self.members(), {1, 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import contextlib
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from pony.orm import *
+
+from horsefax.bot import transfer
+from horsefax.bot.modules.tracking import TelegramMessage, TrackingModule
+from .database import FakeBot, fresh_database, load, message, update
+
+
+def sticker(file_id: str):
+    return {'file_id': file_id, 'file_unique_id': f'unique-{file_id}', 'width': 512, 'height': 512, 'emoji': '🐴'}
+
+
+DESKTOP_EXPORT = {
+    'about': "Here is the data you requested.",
+    'chats': {
+        'about': "This is the list of all chats.",
+        'list': [
+            {'name': 'Ponies', 'type': 'private_supergroup', 'id': 42, 'messages': [
+                {'id': 1, 'type': 'message', 'date': '2020-01-01T12:00:00', 'date_unixtime': '1577880000',
+                 'from': 'A', 'from_id': 'user1', 'text': 'hello 1.5'},
+                {'id': 2, 'type': 'service', 'date': '2020-01-01T12:01:00', 'actor_id': 'user1', 'action': 'pin'},
+                {'id': 3, 'type': 'message', 'date': '2020-01-01T12:02:00', 'from': 'B', 'from_id': 'user2',
+                 'reply_to_message_id': 1, 'text': ['see ', {'type': 'bold', 'text': 'this'}],
+                 'photo': 'photos/photo_1.jpg', 'width': 800, 'height': 600},
+                {'id': 4, 'type': 'message', 'date': '2020-01-01T12:03:00', 'from': 'Channel',
+                 'from_id': 'channel5', 'text': 'posted as a channel'},
+            ]},
+            {'name': 'Saved Messages', 'type': 'saved_messages', 'id': 7, 'messages': [
+                {'id': 1, 'type': 'message', 'date': '2020-01-01T12:00:00', 'from': 'A', 'from_id': 'user1',
+                 'text': 'skipped'},
+            ]},
+        ]},
+    'left_chats': {'about': "Chats you've left.", 'list': [
+        {'name': 'Old group', 'type': 'private_group', 'id': 9, 'messages': [
+            {'id': 5, 'type': 'message', 'date': '2019-06-01T08:00:00', 'from': 'A', 'from_id': 1,
+             'text': 'bye', 'edited': '2019-06-01T08:05:00'},
+        ]},
+    ]},
+}
+
+
+class TransferTest(unittest.TestCase):
+    def setUp(self):
+        fresh_database()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_export_and_import(self):
+        bot = FakeBot()
+        tracking = load(TrackingModule, bot, 'tracking', batch=1000, interval=1000, search=True)
+        now = time.time()
+        for x in (message(1, text='first ponies'),
+                  message(2, sender=2, text=None, sticker=sticker('a')),
+                  message(3, sender=2, text='a reply', reply_to_message=update(1)),
+                  message(4, sender=3, text='forwarded', forward_from={'id': 4, 'first_name': 'D', 'is_bot': False},
+                          forward_date=int(now)),
+                  message(1, chat_id=-2, sender=3, text=None, sticker=sticker('a'), edit_date=int(now)),
+                  message(5, sender=1, text=None, left_chat_member={'id': 2, 'first_name': 'User 2', 'is_bot': False})):
+            tracking.handle_message(x)
+        tracking.flush()
+        path = os.path.join(self.directory, 'export.ndjson.gz')
+        # Small batches, so that paging through is tested too.
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            count = transfer.write_records(transfer.export_records(batch=2), f)
+        exported = list(transfer.read_records(path))
+        self.assertEqual(len(exported), count)
+
+        fresh_database()
+        counts = transfer.import_records(transfer.read_records(path), batch=3)
+        self.assertEqual(counts['TelegramStickerMessage'], 2)
+        self.assertEqual(counts['TelegramFile'], 1)
+        self.assertEqual(counts['skipped'], 0)
+        self.assertEqual(list(transfer.export_records()), exported)
+        with db_session:
+            self.assertEqual(TelegramMessage[(-1, 3)].reply_to.id, 1)
+            self.assertEqual(TelegramMessage[(-1, 4)].forward_from.id, 4)
+            self.assertEqual([x.id for x in transfer.create_index().search(-1, 'ponies', 10)], [1])
+
+        # Importing again changes nothing.
+        counts = transfer.import_records(transfer.read_records(path), batch=3)
+        self.assertEqual(counts['skipped'], count)
+        self.assertEqual(list(transfer.export_records()), exported)
+
+    def desktop_records(self, export, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return list(transfer.desktop_records(io.StringIO(json.dumps(export, indent=1)), **kwargs))
+
+    def test_desktop_export(self):
+        records = self.desktop_records(DESKTOP_EXPORT)
+        self.assertEqual([(x['entity'], x['id']) for x in records],
+                         [('TelegramChat', -10042), ('TelegramUser', 1), ('TelegramTextMessage', 1),
+                          ('TelegramUser', 2), ('TelegramFile', 'desktop:photos/photo_1.jpg'),
+                          ('TelegramPhotoMessage', 3),
+                          ('TelegramChat', -9), ('TelegramUser', 1), ('TelegramTextMessage', 5)])
+        self.assertEqual(records[2]['text'], 'hello 1.5')
+        self.assertEqual(records[5]['caption'], 'see this')
+        self.assertEqual(records[5]['reply_to'], [-10042, 1])
+        self.assertEqual(records[8]['edit_date'], '2019-06-01T08:05:00+00:00')
+        # Read a few characters at a time, so that values are split across reads.
+        with mock.patch.object(transfer._JSONReader, 'SIZE', 3):
+            self.assertEqual(self.desktop_records(DESKTOP_EXPORT), records)
+
+        counts = transfer.import_records(records)
+        self.assertEqual((counts['TelegramTextMessage'], counts['TelegramPhotoMessage']), (2, 1))
+        with db_session:
+            self.assertEqual(TelegramMessage[(-10042, 3)].reply_to.id, 1)
+
+    def test_desktop_export_of_one_chat(self):
+        chat = DESKTOP_EXPORT['chats']['list'][0]
+        records = self.desktop_records(chat, chat_id=-100)
+        self.assertEqual({x['chat'] for x in records if 'chat' in x}, {-100})
+        self.assertEqual(len(records), 6)
+        with mock.patch.object(transfer._JSONReader, 'SIZE', 1):
+            self.assertEqual(self.desktop_records(chat, chat_id=-100), records)
+        with self.assertRaises(ValueError):
+            self.desktop_records([chat])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+import unittest
+from unittest import mock
+
+import requests
+
+from horsefax.telegram.connections.transport import Backoff, CircuitBreaker, Transport
+from horsefax.telegram.exceptions import CircuitOpenError
+
+URL = 'https://api.telegram.org/botTOKEN/'
+
+
+def response(status: int) -> requests.Response:
+    result = requests.Response()
+    result.status_code = status
+    return result
+
+
+class FakeSession:
+    """Gives each of `outcomes` in turn: a status code to respond with, or an exception to raise."""
+    def __init__(self, *outcomes) -> None:
+        self.outcomes = list(outcomes)
+        self.posts = []
+
+    def post(self, url, **kwargs):
+        self.posts.append((url, kwargs))
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return response(outcome)
+
+
+class BackoffTest(unittest.TestCase):
+    def test_delay(self):
+        backoff = Backoff(base=0.5, cap=3)
+        with mock.patch('random.uniform', side_effect=lambda a, b: b):
+            self.assertEqual([backoff.delay(x) for x in range(5)], [0.5, 1, 2, 3, 3])
+        for attempt in range(5):
+            self.assertTrue(0 <= backoff.delay(attempt) <= 3)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('horsefax.telegram.connections.transport.time.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(threshold=3, cooldown=30)
+
+    def open(self):
+        for _ in range(3):
+            self.breaker.before()
+            self.breaker.failure()
+
+    def test_closed_until_threshold(self):
+        for _ in range(2):
+            self.breaker.before()
+            self.breaker.failure()
+        # A success starts the count again.
+        self.breaker.before()
+        self.breaker.success()
+        for _ in range(2):
+            self.breaker.before()
+            self.breaker.failure()
+        self.breaker.before()
+        self.breaker.failure()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before()
+
+    def test_half_open_trial_succeeds(self):
+        self.open()
+        self.now += 29
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before()
+        self.now += 1
+        # One request is let through, and nothing else until it's done.
+        self.breaker.before()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before()
+        self.breaker.success()
+        for _ in range(5):
+            self.breaker.before()
+
+    def test_half_open_trial_fails(self):
+        self.open()
+        self.now += 30
+        self.breaker.before()
+        self.breaker.failure()
+        # Open again, for another full cooldown.
+        self.now += 29
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before()
+        self.now += 1
+        self.breaker.before()
+
+
+class TransportTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('horsefax.telegram.connections.transport.time.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('horsefax.telegram.connections.transport.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.backoff = Backoff(base=1, cap=4)
+        self.transport = Transport(retries=3, backoff=self.backoff, breaker=CircuitBreaker(threshold=5, cooldown=30),
+                                   timeouts={'getUpdates': (5, 60)})
+
+    def post(self, endpoint: str, *outcomes) -> requests.Response:
+        self.transport.session = FakeSession(*outcomes)
+        with mock.patch.object(self.backoff, 'delay', side_effect=lambda x: 2 ** x):
+            return self.transport.post(URL + endpoint, endpoint)
+
+    def test_idempotent_request_retried(self):
+        result = self.post('getMe', requests.ConnectionError(), 502, 200)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(len(self.transport.session.posts), 3)
+        self.assertEqual([x[0][0] for x in self.sleep.call_args_list], [1, 2])
+        self.assertEqual(self.transport.breaker.failures, 0)
+
+    def test_retries_give_out(self):
+        self.assertEqual(self.post('getMe', 500, 500, 500, 500).status_code, 500)
+        self.assertEqual([x[0][0] for x in self.sleep.call_args_list], [1, 2, 4])
+
+    def test_client_errors_not_retried(self):
+        self.assertEqual(self.post('getMe', 429).status_code, 429)
+        self.assertEqual(self.post('sendMessage', 400).status_code, 400)
+        self.sleep.assert_not_called()
+
+    def test_send_only_retried_if_it_never_left(self):
+        self.assertEqual(self.post('sendMessage', requests.ConnectTimeout(), 200).status_code, 200)
+        self.assertEqual(self.post('sendMessage', 502).status_code, 502)
+        with self.assertRaises(requests.ReadTimeout):
+            self.post('sendMessage', requests.ReadTimeout())
+        self.assertEqual(self.sleep.call_count, 1)
+
+    def test_timeouts(self):
+        self.post('getUpdates', 200)
+        self.assertEqual(self.transport.session.posts[0][1]['timeout'], (5, 60))
+        self.post('getMe', 200)
+        self.assertEqual(self.transport.session.posts[0][1]['timeout'], (5, 30))
+
+    def test_circuit_breaker(self):
+        with self.assertRaises(requests.ConnectionError):
+            self.post('sendMessage', requests.ConnectionError())
+        # The fifth failure in a row, on the last retry.
+        self.assertEqual(self.post('getMe', 503, 503, 503, 503).status_code, 503)
+        # Open: nothing is sent, not even a retry.
+        with self.assertRaises(CircuitOpenError):
+            self.post('getMe', 200)
+        self.assertEqual(self.transport.session.posts, [])
+        # Half open: the trial request fails, so it's open again.
+        self.now += 30
+        with self.assertRaises(CircuitOpenError):
+            self.post('getMe', 502, 200)
+        self.assertEqual(len(self.transport.session.posts), 1)
+        # Half open again: this time the trial gets through, and it's closed.
+        self.now += 30
+        self.assertEqual(self.post('getMe', 200).status_code, 200)
+        self.assertEqual(self.post('getMe', 200).status_code, 200)
+        self.assertEqual(self.transport.breaker.failures, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
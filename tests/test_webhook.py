@@ -0,0 +1,60 @@
+import http.client
+import json
+import unittest
+from typing import Optional
+
+from horsefax.telegram.connections.webhook import WebhookConnection, _WebhookRequestHandler
+
+
+class WebhookConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.handled = []
+        self.connection = WebhookConnection('token', lambda x: self.handled.append(x['update_id']), host='127.0.0.1',
+                                            port=0, secret='sekrit', path='/hook', workers=0)
+        self.connection.connect()
+        self.addCleanup(self.connection.disconnect)
+
+    def post(self, body: bytes, path: str = '/hook', secret: str = 'sekrit', length: Optional[int] = None) -> int:
+        host, port = self.connection.address
+        client = http.client.HTTPConnection(host, port, timeout=5)
+        self.addCleanup(client.close)
+        client.putrequest('POST', path)
+        client.putheader('Content-Type', 'application/json')
+        client.putheader('Content-Length', str(len(body) if length is None else length))
+        if secret is not None:
+            client.putheader('X-Telegram-Bot-Api-Secret-Token', secret)
+        client.endheaders(body)
+        response = client.getresponse()
+        response.read()
+        return response.status
+
+    def test_update_is_handled(self):
+        self.assertEqual(self.post(json.dumps({'update_id': 5, 'message': {'chat': {'id': 1}}}).encode()), 200)
+        self.assertEqual(self.handled, [5])
+
+    def test_bad_requests_are_refused(self):
+        update = json.dumps({'update_id': 5}).encode()
+        self.assertEqual(self.post(update, secret=None), 403)
+        self.assertEqual(self.post(update, secret='wrong'), 403)
+        self.assertEqual(self.post(update, path='/elsewhere'), 404)
+        self.assertEqual(self.post(b'{not json'), 400)
+        self.assertEqual(self.post(b'[]'), 400)
+        # Claiming to be huge is enough; the body isn't read.
+        self.assertEqual(self.post(update, length=_WebhookRequestHandler.MAX_BODY + 1), 413)
+        self.assertEqual(self.handled, [])
+
+
+class WebhookSecretTest(unittest.TestCase):
+    def test_secret_is_made_up_when_registering(self):
+        connection = WebhookConnection('token', lambda x: None, url='https://example.com/', workers=0)
+        self.assertTrue(connection.secret)
+        self.assertFalse(connection.check_secret(None))
+        self.assertTrue(connection.check_secret(connection.secret))
+
+    def test_secret_is_required_otherwise(self):
+        with self.assertRaises(ValueError):
+            WebhookConnection('token', lambda x: None, workers=0)
+
+
+if __name__ == '__main__':
+    unittest.main()